@@ -1,15 +1,30 @@
+"""
+The application factory. Importing the package is cheap: the views,
+models and database modules are imported when an application is created,
+and modules only needed by some requests are imported on first use.
+"""
 from flask import Flask
-from config import app_config
-from flask_cors import CORS
 
 
-def create_app(config_name):
+def create_app(config_name='development'):
+    """Creates the application with the named configuration from config.py
+    ('development', 'testing' or 'production')"""
+    from flask_cors import CORS
+    from config import app_config
+    from app import instrumentation, journeys, metrics, models, serializers
+    from app.views import api
+
     application = Flask(__name__)
     CORS(application)
     application.config.from_object(app_config[config_name])
 
-    return application
-
+    models.init_app(application)
+    serializers.init_app(application)
+    journeys.init_app(application)
+    application.register_blueprint(api)
+    if application.config['DATABASE_INSTRUMENTATION']:
+        instrumentation.install(application)
+    if application.config['METRICS_ENABLED']:
+        metrics.install(application)
 
-app = create_app("development")
-from app.views import *
+    return application
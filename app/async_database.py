@@ -0,0 +1,299 @@
+"""
+This file contains the asynchronous counterpart of app.database_helper.
+It uses psycopg2's asynchronous connections driven by the asyncio event
+loop, so a coroutine waiting for Postgres lets other coroutines run and
+independent queries can be in flight at the same time.
+
+Asynchronous connections work in autocommit mode and do not support
+server side cursors or prepared statements; statements that must be
+atomic together are wrapped in an explicit transaction.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+import weakref
+
+import psycopg2
+import psycopg2.extensions
+from flask import current_app
+from app.database_pool import connection_params, notify_statement, \
+    PoolTimeout
+from app.database_helper import insert_sql, select_statement, \
+    update_statement, BUMP_VERSIONS_SQL
+
+logger = logging.getLogger('app.database')
+
+# Statements not reported to the statement listeners, like the commits
+# of synchronous connections
+TRANSACTION_CONTROL = frozenset(("BEGIN", "COMMIT", "ROLLBACK"))
+
+
+async def wait(conn):
+    """Waits until the pending operation of an async connection is done"""
+    loop = asyncio.get_event_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        future = loop.create_future()
+        fileno = conn.fileno()
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fileno, future.set_result, None)
+            try:
+                await future
+            finally:
+                loop.remove_reader(fileno)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fileno, future.set_result, None)
+            try:
+                await future
+            finally:
+                loop.remove_writer(fileno)
+        else:
+            raise psycopg2.OperationalError("poll() returned " + str(state))
+
+
+class AsyncConnectionPool:
+    """A pool of asynchronous connections belonging to one event loop"""
+
+    def __init__(self, params, maxconn=5, timeout=5.0):
+        self.params = params
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = []
+        self._size = 0
+        self._released = asyncio.Condition()
+
+    async def _connect(self):
+        params = dict(self.params)
+        conn = psycopg2.connect(async_=1, **params)
+        await wait(conn)
+        return conn
+
+    async def getconn(self):
+        """Borrows a connection, waiting up to timeout seconds for one"""
+        async with self._released:
+            while True:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if not conn.closed:
+                        return conn
+                    self._size -= 1
+
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+
+                try:
+                    await asyncio.wait_for(self._released.wait(),
+                                           self.timeout)
+                except asyncio.TimeoutError:
+                    raise PoolTimeout("no connection available after {}s"
+                                      .format(self.timeout))
+        try:
+            return await self._connect()
+        except Exception:
+            async with self._released:
+                self._size -= 1
+                self._released.notify()
+            raise
+
+    async def putconn(self, conn, close=False):
+        """Returns a borrowed connection to the pool"""
+        async with self._released:
+            if close or conn.closed or conn.isexecuting() or \
+                    conn.get_transaction_status() != \
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                self._size -= 1
+                if not conn.closed:
+                    conn.close()
+            else:
+                self._idle.append(conn)
+            self._released.notify()
+
+    async def closeall(self):
+        async with self._released:
+            for conn in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle = []
+
+
+_pools = weakref.WeakKeyDictionary()
+
+
+def get_async_pool():
+    """Returns the pool of the running event loop, creating it when needed"""
+    loop = asyncio.get_event_loop()
+    params = connection_params()
+    pool = _pools.get(loop)
+    if pool is None or pool.pid != os.getpid() or pool.params != params:
+        config = current_app.config
+        pool = AsyncConnectionPool(params,
+                                   config['ASYNC_DATABASE_POOL_MAX'],
+                                   config['DATABASE_POOL_TIMEOUT'])
+        _pools[loop] = pool
+    return pool
+
+
+async def close_async_pool():
+    """Closes the pool of the running event loop, if any"""
+    pool = _pools.pop(asyncio.get_event_loop(), None)
+    if pool is not None:
+        await pool.closeall()
+
+
+class AsyncDatabase:
+    """Asynchronous version of app.database_helper.Database with the same
+    insert/select/update methods, each of them a coroutine"""
+
+    def __init__(self):
+        self.pool = get_async_pool()
+
+    async def insert(self, table, columns, values, returning=None,
+                     bump=None):
+        """Inserts elements into a table given columns and values"""
+        sql = insert_sql(table, tuple(columns), returning)
+        return await self.execute_sql(sql, tuple(values), bump=bump)
+
+    async def select(self, table, columns, left_join=None, where=None,
+                     prepare=False, order_by=None, limit=None):
+        """Selects elements like Database.select. prepare is accepted for
+        compatibility and ignored"""
+        sql, params = select_statement(table, columns, left_join, where,
+                                       order_by, limit)
+        return await self.execute_sql(sql, params)
+
+    async def update(self, table, sett=None, where=None, increment=None,
+                     bump=None):
+        """Updates rows like Database.update"""
+        sql, params = update_statement(table, sett, where, increment)
+        return await self.execute_sql(sql, params, fetch=False, bump=bump)
+
+    async def execute_sql(self, sql, params=None, fetch=True, bump=None):
+        """Executes the sql statement and returns
+        the values from the database"""
+        return_val = None
+        try:
+            conn = await self.pool.getconn()
+            broken = False
+            try:
+                cur = conn.cursor()
+                try:
+                    if bump:
+                        await self._execute(cur, "BEGIN")
+                    await self._execute(cur, sql, params)
+                    if fetch:
+                        return_val = cur.fetchall()
+                    else:
+                        return_val = ['Empty data']
+                    if bump:
+                        await self._execute(cur, BUMP_VERSIONS_SQL,
+                                            (list(bump),))
+                        await self._execute(cur, "COMMIT")
+                except psycopg2.DatabaseError:
+                    if bump and not conn.closed:
+                        await self._execute(cur, "ROLLBACK")
+                    raise
+                finally:
+                    cur.close()
+            except psycopg2.OperationalError:
+                broken = True
+                raise
+            finally:
+                await self.pool.putconn(conn, close=broken)
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error("Error: %s", error)
+
+        return return_val
+
+    @staticmethod
+    async def _execute(cur, sql, params=None):
+        start = time.perf_counter()
+        cur.execute(sql, params)
+        await wait(cur.connection)
+        if sql in TRANSACTION_CONTROL:
+            return
+        statement = (sql, time.perf_counter() - start, cur.rowcount)
+        statements = _task_statements.get(current_task())
+        if statements is None:
+            notify_statement(*statement)
+        else:
+            statements.append(statement)
+
+
+_loops = {}  # application -> (pid, event loop)
+_loop_lock = threading.Lock()
+
+
+def _run_loop(app, loop):
+    # Before Python 3.5.3 get_event_loop only returns the loop set for
+    # the thread, even in the coroutines the loop runs
+    asyncio.set_event_loop(loop)
+    with app.app_context():
+        loop.run_forever()
+
+
+def _background_loop(app):
+    """Returns the event loop run for app by a daemon thread of this
+    process. The thread works in an application context of app"""
+    with _loop_lock:
+        pid, loop = _loops.get(app, (None, None))
+        if loop is None or pid != os.getpid():
+            # The thread running an inherited loop does not exist after fork
+            loop = asyncio.new_event_loop()
+            _loops[app] = (os.getpid(), loop)
+            thread = threading.Thread(target=_run_loop, args=(app, loop),
+                                      name="async-database", daemon=True)
+            thread.start()
+        return loop
+
+
+# Statements executed by the tasks of run_async. They are reported to
+# the statement listeners by the thread that called run_async, so that
+# the listeners see the request that caused them
+_task_statements = weakref.WeakKeyDictionary()
+
+try:
+    current_task = asyncio.current_task
+except AttributeError:  # Before Python 3.7
+    current_task = asyncio.Task.current_task
+
+
+async def _gather(coroutines):
+    loop = asyncio.get_event_loop()
+    statements = []
+    tasks = []
+    for coroutine in coroutines:
+        task = loop.create_task(coroutine)
+        _task_statements[task] = statements
+        tasks.append(task)
+    results = await asyncio.gather(*tasks)
+    return results, statements
+
+
+def run_async(*coroutines, timeout=None):
+    """
+    Runs coroutines concurrently and returns the list of their results.
+    Lets synchronous views wait for several independent lookups at once.
+    The coroutines run on one event loop shared by the threads of the
+    process, so they share its connection pool. They are cancelled and
+    concurrent.futures.TimeoutError is raised when they are not done after
+    timeout seconds, DATABASE_POOL_TIMEOUT by default.
+    """
+    if timeout is None:
+        timeout = current_app.config['DATABASE_POOL_TIMEOUT']
+    loop = _background_loop(current_app._get_current_object())
+    future = asyncio.run_coroutine_threadsafe(_gather(coroutines), loop)
+    try:
+        results, statements = future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+    for statement in statements:
+        notify_statement(*statement)
+    return results
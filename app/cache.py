@@ -0,0 +1,181 @@
+"""
+This file contains the read-through cache placed in front of the user and
+ride lookups. The cache stores database rows under string keys in a
+backend; an in-process LRU cache with a time to live is used by default.
+Other stores can be used by implementing CacheBackend.
+"""
+import abc
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheBackend(abc.ABC):
+    """Interface of the stores used by ReadThroughCache"""
+
+    @abc.abstractmethod
+    def get(self, key):
+        """Returns the value stored under key, None if there is none"""
+
+    @abc.abstractmethod
+    def set(self, key, value):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key):
+        pass
+
+    @abc.abstractmethod
+    def clear(self):
+        """Removes every value stored by this backend"""
+
+
+class NullCache(CacheBackend):
+    """Backend that stores nothing, used to turn caching off"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(CacheBackend):
+    """An in-process least recently used cache whose entries
+    expire ttl seconds after they were stored"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, expiry time)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache(CacheBackend):
+    """Backend for a Redis compatible server. client is any object with
+    the get, set (with ex), delete and scan_iter methods of redis-py.
+    Keys are stored under prefix, so the database can be shared"""
+
+    def __init__(self, client, ttl=60, prefix='ridemyway:',
+                 clear_batch_size=500):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.clear_batch_size = clear_batch_size
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        """Deletes the keys under the prefix, leaving the other keys of
+        the database alone"""
+        pattern = re.sub(r'([*?\[\]\\])', r'\\\1', self.prefix) + '*'
+        keys = []
+        for key in self.client.scan_iter(match=pattern,
+                                         count=self.clear_batch_size):
+            keys.append(key)
+            if len(keys) >= self.clear_batch_size:
+                self.client.delete(*keys)
+                keys = []
+        if keys:
+            self.client.delete(*keys)
+
+
+class ReadThroughCache:
+    """Loads missing values through a loader function and
+    counts how often values were found in the backend"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        """Returns the value of key, calling loader() to get it from the
+        database when it is not cached. None is never cached"""
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = loader()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        """Removes keys whose values have changed in the database"""
+        for key in keys:
+            self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Returns the hit and miss counters and the hit rate"""
+        hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': float(hits) / total if total else 0.0}
+
+
+def build_cache(config):
+    """Creates the cache described by the CACHE_* configuration values"""
+    backend = config['CACHE_BACKEND']
+    if backend == 'lru':
+        store = LRUCache(config['CACHE_SIZE'], config['CACHE_TTL'])
+    elif backend == 'redis':
+        import redis
+        store = RedisCache(redis.StrictRedis.from_url(config['CACHE_URL']),
+                           config['CACHE_TTL'])
+    elif backend == 'none':
+        store = NullCache()
+    else:
+        raise ValueError('Unknown cache backend: ' + str(backend))
+    return ReadThroughCache(store)
@@ -0,0 +1,62 @@
+"""
+This file contains the write-behind counters of the rides taken and given
+by the users. Accepting a ride request appends increments to the
+ride_counter_log table instead of updating the rows of the passenger and
+the driver, which are contended when a popular driver accepts many
+requests. flush() adds the logged increments to the users table with one
+aggregated UPDATE per user. It runs after a write once COUNTER_FLUSH_SIZE
+increments were logged by this process or COUNTER_FLUSH_INTERVAL seconds
+have passed since the last flush.
+
+Readers that need exact totals add the logged increments to the values
+in the users table, see User.get_user_totals.
+"""
+import threading
+import time
+from flask import current_app
+from app.database_helper import Database
+
+# Moves every logged increment into the users table and returns the
+# usernames whose counters changed. The log entries are deleted in the
+# same statement, so an increment is never counted twice
+FLUSH_SQL = """
+    WITH moved AS (
+      DELETE FROM ride_counter_log
+      RETURNING user_id, rides_taken, rides_given
+    ), totals AS (
+      SELECT user_id, sum(rides_taken) AS taken, sum(rides_given) AS given
+      FROM moved GROUP BY user_id
+    )
+    UPDATE users
+    SET rides_taken = rides_taken + totals.taken,
+        rides_given = rides_given + totals.given
+    FROM totals
+    WHERE users.user_id = totals.user_id
+    RETURNING users.username
+    """
+
+_lock = threading.Lock()
+_pending = 0  # Increments logged by this process since the last flush
+_last_flush = time.time()
+
+
+def logged(count):
+    """Notes that count increments were logged.
+    Returns whether the log should be flushed now"""
+    global _pending
+    with _lock:
+        _pending += count
+        config = current_app.config
+        return _pending >= config['COUNTER_FLUSH_SIZE'] or \
+            time.time() - _last_flush >= config['COUNTER_FLUSH_INTERVAL']
+
+
+def flush():
+    """Adds the logged increments to the users table.
+    Returns the usernames whose counters changed"""
+    global _pending, _last_flush
+    with _lock:
+        _pending = 0
+        _last_flush = time.time()
+    data_returned = Database().execute_sql(FLUSH_SQL)
+    return [row[0] for row in data_returned or []]
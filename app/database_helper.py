@@ -1,81 +1,350 @@
+import hashlib
+import logging
+import uuid
 import psycopg2
-import os
-from configure_database import config
-from app.database_setup import create_tables
-from app import app
+from psycopg2.extras import execute_values
+from functools import lru_cache
+from flask import current_app
+from app.database_pool import get_pool, PoolTimeout
+
+logger = logging.getLogger('app.database')
+
+
+@lru_cache(maxsize=256)
+def insert_sql(table, columns, returning=None):
+    """Builds the parameterized INSERT statement for a table and columns"""
+    placeholders = ", ".join(["%s"] * len(columns))
+    sql = "INSERT INTO " + table + " (" + ", ".join(columns) + ")" + \
+          " VALUES (" + placeholders + ")"
+    if returning:
+        sql = sql + " RETURNING " + returning
+    return sql
+
+
+@lru_cache(maxsize=256)
+def insert_many_sql(table, columns, returning=None):
+    """Builds the multi-row INSERT statement used with execute_values"""
+    sql = "INSERT INTO " + table + " (" + ", ".join(columns) + ")" + \
+          " VALUES %s"
+    if returning:
+        sql = sql + " RETURNING " + returning
+    return sql
+
+
+@lru_cache(maxsize=256)
+def select_sql(table, columns, left_join=None, where_keys=(),
+               order_by=None, limit=False, null_keys=()):
+    """Builds the parameterized SELECT statement.
+    where_keys is the sorted tuple of keys of the where dictionary,
+    null_keys those of its keys whose value is None,
+    and limit tells whether a LIMIT placeholder is added"""
+    if not isinstance(columns, str):
+        columns = ", ".join(columns)
+    sql = "SELECT " + columns + " FROM " + table
+    if left_join:
+        sql = sql + " LEFT JOIN " + left_join
+    if where_keys or null_keys:
+        sql = sql + " WHERE " + where_sql(where_keys, null_keys)
+    if order_by:
+        sql = sql + " ORDER BY " + order_by
+    if limit:
+        sql = sql + " LIMIT %s"
+    return sql
+
+
+@lru_cache(maxsize=256)
+def update_sql(table, set_keys=(), increment_keys=(), where_keys=()):
+    """Builds the parameterized UPDATE statement"""
+    assignments = [key + " = %s" for key in set_keys]
+    assignments += [key + " = " + key + " + %s" for key in increment_keys]
+    sql = "UPDATE " + table + " SET " + ", ".join(assignments)
+    if where_keys:
+        sql = sql + " WHERE " + where_sql(where_keys)
+    return sql
+
+
+def where_sql(where_keys, null_keys=()):
+    """
+    Turns the keys of a where dictionary into a condition.
+    A key is either a column name, compared with =,
+    or a column name followed by an operator e.g. 'r.ride_id >'.
+    The columns of null_keys are compared with IS NULL
+    """
+    conditions = []
+    for key in where_keys:
+        if " " in key:
+            conditions.append(key + " %s")
+        else:
+            conditions.append(key + " = %s")
+    for key in null_keys:
+        if " " in key:
+            raise ValueError("{} cannot be compared with None".format(key))
+        conditions.append(key + " IS NULL")
+    return " AND ".join(conditions)
+
+
+def select_statement(table, columns, left_join=None, where=None,
+                     order_by=None, limit=None):
+    """
+    Returns the SELECT statement and its parameters.
+    where is a dictionary of column names (optionally followed by an
+    operator) to values. A column whose value is None must be NULL;
+    None cannot be compared with an operator.
+    """
+    where = where or {}
+    where_keys = tuple(sorted(key for key, value in where.items()
+                              if value is not None))
+    null_keys = tuple(sorted(key for key, value in where.items()
+                             if value is None))
+    sql = select_sql(table, columns, left_join, where_keys,
+                     order_by, limit is not None, null_keys)
+    params = [where[key] for key in where_keys]
+    if limit is not None:
+        params.append(limit)
+    return sql, params
+
+
+def update_statement(table, sett=None, where=None, increment=None):
+    """
+    Returns the UPDATE statement and its parameters. sett maps columns to
+    new values and increment maps columns to the amount they should be
+    increased by
+    """
+    sett = sett or {}
+    increment = increment or {}
+    where = where or {}
+    set_keys = tuple(sorted(sett))
+    increment_keys = tuple(sorted(increment))
+    where_keys = tuple(sorted(where))
+    sql = update_sql(table, set_keys, increment_keys, where_keys)
+    params = [sett[key] for key in set_keys] + \
+             [increment[key] for key in increment_keys] + \
+             [where[key] for key in where_keys]
+    return sql, params
+
+
+@lru_cache(maxsize=256)
+def prepared_statement(sql):
+    """Returns the name and the $n style text used to PREPARE a statement"""
+    name = "rmw_" + hashlib.md5(sql.encode()).hexdigest()[:16]
+    parts = sql.split("%s")
+    text = parts[0]
+    for i, part in enumerate(parts[1:], start=1):
+        text = text + "$" + str(i) + part
+    return name, text, len(parts) - 1
+
+
+# Bumps the version markers of collections whose rows have changed
+BUMP_VERSIONS_SQL = """
+    INSERT INTO collection_versions (name, version)
+    SELECT name, 1 FROM unnest(%s::varchar[]) AS name
+    ON CONFLICT (name) DO UPDATE
+    SET version = collection_versions.version + 1, updated_at = now()
+    """
+
+# Reads the version of a collection whose marker may be split into several
+# rows, as the sum of their versions and the last time one of them changed
+COLLECTION_VERSION_SQL = """
+    SELECT coalesce(sum(version), 0), max(updated_at)
+    FROM collection_versions WHERE name = ANY(%s)
+    """
+
+
+def marker_names(collection):
+    """Returns the names of the version markers of a collection, which is
+    either the name of its only marker or a tuple of them"""
+    if isinstance(collection, str):
+        return [collection]
+    return list(collection)
 
 
 class Database:
     """This class contains helper methods for connecting to the database"""
 
     def __init__(self):
-        """Initiates connection to the database"""
-        params = config()
-        if app.config['TESTING']:
-            params['database'] = 'ridemywaydb_testing'
-
-        create_tables()
-        if 'DATABASE_URL' in os.environ:
-            database_url = os.environ['DATABASE_URL']
-            print(database_url)
-            self.conn = psycopg2.connect(database_url,
-                                         sslmode='require')
-        else:
-            self.conn = psycopg2.connect(**params)
-        self.cur = self.conn.cursor()
+        """Prepares the helper. Connections are borrowed from the
+        process wide pool when a statement is executed.
+        The schema is created by app.database_setup.migrate"""
+        self.pool = get_pool()
+        self.use_prepared = current_app.config['DATABASE_PREPARE_STATEMENTS']
 
-    def insert(self, table, columns, values, returning=None):
+    def insert(self, table, columns, values, returning=None, bump=None):
         """
         Inserts elements into a table given columns and values
         Returns the values returned after executing the sql statement
         """
-        columns = str(columns).replace("\'", "")
-        values = str(values)
-        sql = "INSERT INTO " + table + " " + columns + " VALUES " + values
-        if returning:
-            sql = sql + " RETURNING " + returning
+        sql = insert_sql(table, tuple(columns), returning)
+
+        return_val = self.execute_sql(sql, tuple(values), bump=bump)
+        return return_val
+
+    def insert_many(self, table, columns, rows, returning=None, bump=None):
+        """
+        Inserts several rows with one multi-row INSERT statement.
+        Returns the values returned for the rows, in the order given
+        """
+        sql = insert_many_sql(table, tuple(columns), returning)
+        return_val = None
+        try:
+            with self.pool.connection() as conn:
+                cur = conn.cursor()
+                try:
+                    execute_values(cur, sql, rows, page_size=len(rows))
+                    if returning:
+                        return_val = cur.fetchall()
+                    else:
+                        return_val = ['Empty data']
+                    self.bump_versions(cur, bump)
+                    conn.commit()
+                finally:
+                    cur.close()
+        except PoolTimeout:
+            # A busy pool is not an empty result, see the 503 handler
+            raise
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error("Error: %s", error)
 
-        return_val = self.execute_sql(sql)
         return return_val
 
-    def select(self, table, columns, left_join=None, where=None):
+    def select(self, table, columns, left_join=None, where=None,
+               prepare=False, order_by=None, limit=None):
         """
-        Selects elements in the database using the select statement
+        Selects elements in the database using the select statement.
+        where is a dictionary of column names (optionally followed by an
+        operator) to values, see select_statement.
+        Set prepare for hot lookups so the statement is planned once
+        per connection.
         """
-        columns = str(columns).replace("\'", "")
-        sql = "SELECT " + columns + " FROM " + table
-        if left_join:
-            sql = sql + " LEFT JOIN " + left_join
-        if where:
-            sql = sql + " WHERE " + where
-
-        return_val = self.execute_sql(sql)
+        sql, params = select_statement(table, columns, left_join, where,
+                                       order_by, limit)
+
+        return_val = self.execute_sql(sql, params, prepare=prepare)
         return return_val
 
-    def update(self, table, sett, where=None):
-        sql = "UPDATE " + table + " SET " + sett
-        if where:
-            sql = sql + " WHERE " + where
+    def stream(self, table, columns, left_join=None, where=None,
+               order_by=None, batch_size=1000):
+        """
+        Like select, but yields the rows one at a time while reading them
+        from a server side cursor in batches of batch_size, so only one
+        batch is held in memory. The connection is borrowed until the
+        generator is exhausted or closed.
+        """
+        sql, params = select_statement(table, columns, left_join, where,
+                                       order_by)
+
+        with self.pool.connection() as conn:
+            cur = conn.cursor(name="rmw_stream_" + uuid.uuid4().hex)
+            cur.itersize = batch_size
+            try:
+                cur.execute(sql, params)
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+                cur.close()
+                conn.commit()
+            finally:
+                if not (cur.closed or conn.closed):
+                    cur.close()
 
-        return_val = self.execute_sql(sql, fetch=False)
+    def update(self, table, sett=None, where=None, increment=None,
+               bump=None):
+        """
+        Updates rows. sett maps columns to new values and increment
+        maps columns to the amount they should be increased by
+        """
+        sql, params = update_statement(table, sett, where, increment)
+
+        return_val = self.execute_sql(sql, params, fetch=False, bump=bump)
         return return_val
 
-    def execute_sql(self, sql, fetch=True):
+    def explain(self, sql, params=None, seqscan=True):
+        """
+        Returns the query plan of a statement as a list of lines.
+        Turning seqscan off shows whether an index can serve the query
+        even when the tables are too small for the planner to pick it.
+        """
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            try:
+                if not seqscan:
+                    cur.execute("SET LOCAL enable_seqscan = off")
+                cur.execute("EXPLAIN " + sql, params)
+                return [row[0] for row in cur.fetchall()]
+            finally:
+                cur.close()
+                conn.rollback()
+
+    def execute_sql(self, sql, params=None, fetch=True, prepare=False,
+                    bump=None):
         """Executes the sql statement and returns
-        the values from the database"""
+        the values from the database.
+        bump lists the collections whose version marker is increased
+        in the same transaction"""
         return_val = None
         try:
-            self.cur.execute(sql)
-            if fetch:
-                return_val = self.cur.fetchall()
-            else:
-                return_val = ['Empty data']
-            self.conn.commit()
-            self.cur.close()
+            with self.pool.connection() as conn:
+                cur = conn.cursor()
+                try:
+                    if prepare and self.use_prepared:
+                        self.execute_prepared(conn, cur, sql, params)
+                    else:
+                        cur.execute(sql, params)
+                    if fetch:
+                        return_val = cur.fetchall()
+                    else:
+                        return_val = ['Empty data']
+                    self.bump_versions(cur, bump)
+                    conn.commit()
+                finally:
+                    cur.close()
+        except PoolTimeout:
+            # A busy pool is not an empty result, see the 503 handler
+            raise
         except (Exception, psycopg2.DatabaseError) as error:
-            print("Error: ", error)
-        finally:
-            if self.conn is not None:
-                self.conn.close()
+            logger.error("Error: %s", error)
 
         return return_val
+
+    @staticmethod
+    def bump_versions(cur, names):
+        """Increases the version markers of the named collections"""
+        if names:
+            cur.execute(BUMP_VERSIONS_SQL, (list(names),))
+
+    def collection_version(self, collection):
+        """Returns the version of a collection and the time it last
+        changed, (0, None) for a collection that never changed.
+        collection is the name of its version marker or a tuple of them"""
+        data_returned = self.execute_sql(COLLECTION_VERSION_SQL,
+                                         (marker_names(collection),),
+                                         prepare=True)
+        if data_returned:
+            return tuple(data_returned[0])
+        return 0, None
+
+    @staticmethod
+    def execute_prepared(conn, cur, sql, params):
+        """
+        Executes sql through a server side prepared statement,
+        preparing it first if this connection has not seen it yet
+        """
+        name, text, count = prepared_statement(sql)
+        if conn.prepared is None:
+            # A previous failure left the prepared statements unknown
+            cur.execute("DEALLOCATE ALL")
+            conn.prepared = set()
+        try:
+            if name not in conn.prepared:
+                cur.execute("PREPARE " + name + " AS " + text)
+                conn.prepared.add(name)
+            if count:
+                cur.execute("EXECUTE " + name + " (" +
+                            ", ".join(["%s"] * count) + ")", params)
+            else:
+                cur.execute("EXECUTE " + name)
+        except psycopg2.DatabaseError:
+            conn.prepared = None
+            raise
@@ -0,0 +1,305 @@
+"""
+This file contains the connection pool used by the database helper.
+Connections are opened once per process and reused between queries
+instead of being opened and closed for every statement.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from configure_database import config
+from flask import current_app
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """Raised when no connection becomes available in time"""
+    pass
+
+
+# Functions called as listener(sql, duration, rowcount) after every
+# statement executed on a pooled connection
+_statement_listeners = ()
+
+
+def add_statement_listener(listener):
+    """Registers a function told about every executed statement"""
+    global _statement_listeners
+    _statement_listeners = _statement_listeners + (listener,)
+
+
+def remove_statement_listener(listener):
+    global _statement_listeners
+    _statement_listeners = tuple(item for item in _statement_listeners
+                                 if item is not listener)
+
+
+def notify_statement(sql, duration, rowcount):
+    """Tells the statement listeners that sql took duration seconds"""
+    for listener in _statement_listeners:
+        listener(sql, duration, rowcount)
+
+
+# Functions called as listener(duration) with the seconds spent waiting
+# for a connection each time one is borrowed through connection()
+_checkout_listeners = ()
+
+
+def add_checkout_listener(listener):
+    """Registers a function told how long borrowing a connection took"""
+    global _checkout_listeners
+    _checkout_listeners = _checkout_listeners + (listener,)
+
+
+def remove_checkout_listener(listener):
+    global _checkout_listeners
+    _checkout_listeners = tuple(item for item in _checkout_listeners
+                                if item is not listener)
+
+
+class ObservedCursor(psycopg2.extensions.cursor):
+    """Cursor that reports its statements to the statement listeners.
+    Nothing is measured while there are no listeners"""
+
+    def execute(self, query, vars=None):
+        if not _statement_listeners:
+            return super(ObservedCursor, self).execute(query, vars)
+        start = time.perf_counter()
+        try:
+            return super(ObservedCursor, self).execute(query, vars)
+        finally:
+            notify_statement(query, time.perf_counter() - start,
+                             self.rowcount)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers the statements prepared on it"""
+
+    def __init__(self, *args, **kwargs):
+        super(PooledConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+        self.cursor_factory = ObservedCursor
+
+
+def connection_params():
+    """Returns the arguments used to open a new connection"""
+    if 'DATABASE_URL' in os.environ:
+        return {'dsn': os.environ['DATABASE_URL'], 'sslmode': 'require'}
+
+    params = config()
+    if current_app.config['TESTING']:
+        params['database'] = 'ridemywaydb_testing'
+    return params
+
+
+class ConnectionPool:
+    """A thread safe pool of long lived database connections"""
+
+    def __init__(self, params, minconn=1, maxconn=10,
+                 timeout=5.0, idle_check=30.0):
+        self.params = params
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self.pid = os.getpid()
+        self._idle = []  # (connection, time it was returned)
+        self._used = set()
+        self._opening = 0  # slots reserved for connections being opened
+        self._lock = threading.Condition()
+        self._closed = False
+
+        with self._lock:
+            for _ in range(minconn):
+                self._idle.append((self._connect(), time.time()))
+
+    def _connect(self):
+        return psycopg2.connect(connection_factory=PooledConnection,
+                                **self.params)
+
+    def _healthy(self, conn, idle_since):
+        """Checks that an idle connection can still be used"""
+        if conn.closed:
+            return False
+        if time.time() - idle_since < self.idle_check:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Borrows a connection, waiting up to timeout seconds for one.
+        The lock is only held to reserve a connection or a free slot, so
+        opening or checking a connection does not hold up other threads"""
+        deadline = time.time() + self.timeout
+        while True:
+            conn, idle_since = self._reserve(deadline)
+            if conn is None:
+                return self._open_reserved()
+            if self._healthy(conn, idle_since):
+                return conn
+            with self._lock:
+                self._used.discard(conn)
+                self._lock.notify()
+            self._discard(conn)
+
+    def _reserve(self, deadline):
+        """Takes an idle connection, returned with the time it was
+        returned, or reserves a slot for a new one, returned as None"""
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    self._used.add(conn)
+                    return conn, idle_since
+
+                if len(self._used) + self._opening < self.maxconn:
+                    self._opening += 1
+                    return None, None
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout("no connection available after {}s"
+                                      .format(self.timeout))
+                self._lock.wait(remaining)
+
+    def _open_reserved(self):
+        """Opens a connection in a reserved slot, which is freed again
+        when the connection can not be opened"""
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._lock:
+                self._opening -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._opening -= 1
+            if not self._closed:
+                self._used.add(conn)
+                return conn
+        self._discard(conn)
+        raise psycopg2.pool.PoolError("connection pool is closed")
+
+    def putconn(self, conn, close=False):
+        """Returns a borrowed connection to the pool.
+        Unfinished transactions are rolled back and broken
+        connections are closed instead of being kept"""
+        with self._lock:
+            self._used.discard(conn)
+            if not (close or self._closed) and self._reset(conn):
+                self._idle.append((conn, time.time()))
+            else:
+                self._discard(conn)
+            self._lock.notify()
+
+    @staticmethod
+    def _reset(conn):
+        """Rolls back any open transaction, returns False if
+        the connection can not be reused"""
+        if conn.closed:
+            return False
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return True
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        try:
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def connection(self):
+        """Context manager that borrows a connection and gives it back"""
+        start = time.perf_counter()
+        conn = self.getconn()
+        for listener in _checkout_listeners:
+            listener(time.perf_counter() - start)
+        broken = False
+        try:
+            yield conn
+        except psycopg2.OperationalError:
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def closeall(self):
+        """Closes every connection owned by the pool"""
+        with self._lock:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            for conn in self._used:
+                self._discard(conn)
+            self._idle = []
+            self._used = set()
+            self._lock.notify_all()
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# Pools inherited from a parent process. They are kept referenced so the
+# connections are never garbage collected (and closed) in the child.
+_inherited = []
+
+
+def get_pool():
+    """
+    Returns the pool for this process, creating it when needed.
+    A worker forked from a process that already had a pool (for example
+    gunicorn with preload) gets a fresh pool; the inherited sockets belong
+    to the parent and are left untouched.
+    """
+    global _pool
+    params = connection_params()
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid() \
+            and pool.params == params:
+        return pool
+
+    with _pool_lock:
+        pool = _pool
+        if pool is not None and pool.pid == os.getpid() \
+                and pool.params == params:
+            return pool
+        if pool is not None and pool.pid == os.getpid():
+            pool.closeall()
+        elif pool is not None:
+            _inherited.append(pool)
+
+        _pool = ConnectionPool(params,
+                               current_app.config['DATABASE_POOL_MIN'],
+                               current_app.config['DATABASE_POOL_MAX'],
+                               current_app.config['DATABASE_POOL_TIMEOUT'],
+                               current_app.config['DATABASE_POOL_IDLE_CHECK'])
+        return _pool
+
+
+def close_pool():
+    """Closes the pool of this process, if any"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.closeall()
+        _pool = None
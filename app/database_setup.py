@@ -1,12 +1,24 @@
-import psycopg2
-from configure_database import config
-from app import app
+"""
+This file contains the database schema and the code that applies it.
+The schema is kept as a list of numbered migrations. Each migration is
+applied once and recorded in the schema_migrations table, so running
+the migrations again is cheap and safe.
+
+Run the migrations with:
+    python -m app.database_setup [--testing]
+"""
+import argparse
 import os
+import psycopg2
+from app import create_app
+from app.database_pool import get_pool
 
+# Arbitrary key for the advisory lock taken while migrating so that
+# several processes starting at the same time do not race each other
+MIGRATION_LOCK_ID = 872341
 
-def create_tables():
-    """Creates the necessary tables in the database if they do not exist"""
-    commands = (
+MIGRATIONS = (
+    (1, "Create users, rides and riderequests tables", (
         """
         CREATE TABLE IF NOT EXISTS users (
           user_id SERIAL PRIMARY KEY,
@@ -26,7 +38,7 @@ def create_tables():
           ON UPDATE CASCADE ON DELETE CASCADE,
           origin VARCHAR(255) NOT NULL,
           destination VARCHAR(255) NOT NULL,
-          price INTEGER NOT NULL 
+          price INTEGER NOT NULL
         )
         """,
         """
@@ -39,38 +51,204 @@ def create_tables():
           ON UPDATE CASCADE ON DELETE CASCADE,
           FOREIGN KEY (passenger_id)
           REFERENCES users(user_id)
-          ON UPDATE CASCADE ON DELETE CASCADE, 
+          ON UPDATE CASCADE ON DELETE CASCADE,
           accepted BOOLEAN,
           rejected BOOLEAN
         )
         """
-    )
+    )),
+    (2, "Index the username, ride owner and ride request lookups", (
+        # Earlier versions let several users sign up with the same name.
+        # They are merged into the first of them, which gets the rides,
+        # the requests and the ride counters of the others
+        """
+        CREATE TEMPORARY TABLE user_merges ON COMMIT DROP AS
+        SELECT user_id, kept_id FROM (
+          SELECT user_id, min(user_id) OVER (PARTITION BY username)
+                 AS kept_id
+          FROM users
+        ) users_by_name
+        WHERE user_id <> kept_id
+        """,
+        """
+        UPDATE rides r SET user_id = m.kept_id
+        FROM user_merges m WHERE r.user_id = m.user_id
+        """,
+        """
+        UPDATE riderequests r SET passenger_id = m.kept_id
+        FROM user_merges m WHERE r.passenger_id = m.user_id
+        """,
+        """
+        UPDATE users u
+        SET rides_taken = coalesce(u.rides_taken, 0) + merged.rides_taken,
+            rides_given = coalesce(u.rides_given, 0) + merged.rides_given
+        FROM (
+          SELECT m.kept_id, sum(coalesce(d.rides_taken, 0)) AS rides_taken,
+                 sum(coalesce(d.rides_given, 0)) AS rides_given
+          FROM user_merges m JOIN users d ON d.user_id = m.user_id
+          GROUP BY m.kept_id
+        ) merged
+        WHERE u.user_id = merged.kept_id
+        """,
+        """
+        DELETE FROM users u USING user_merges m WHERE u.user_id = m.user_id
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS users_username_key
+          ON users (username)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS rides_user_id_idx
+          ON rides (user_id, ride_id)
+        """,
+        # Earlier versions also let a passenger request a ride more than
+        # once. The request kept is the accepted one, else the rejected
+        # one, else the first one
+        """
+        DELETE FROM riderequests r USING (
+          SELECT request_id, row_number() OVER (
+                   PARTITION BY ride_id, passenger_id
+                   ORDER BY accepted IS TRUE DESC, rejected IS TRUE DESC,
+                            request_id) AS rank
+          FROM riderequests
+        ) ranked
+        WHERE r.request_id = ranked.request_id AND ranked.rank > 1
+        """,
+        """
+        ALTER TABLE riderequests
+          ADD CONSTRAINT riderequests_ride_passenger_key
+          UNIQUE (ride_id, passenger_id)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS riderequests_passenger_id_idx
+          ON riderequests (passenger_id)
+        """
+    )),
+    (3, "Index ride searches by origin, destination and price", (
+        """
+        CREATE INDEX IF NOT EXISTS rides_origin_lower_idx
+          ON rides (lower(origin) text_pattern_ops)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS rides_destination_lower_idx
+          ON rides (lower(destination) text_pattern_ops)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS rides_price_idx
+          ON rides (price, ride_id)
+        """
+    )),
+    (4, "Add version markers of the ride and ride request listings", (
+        """
+        CREATE TABLE IF NOT EXISTS collection_versions (
+          name VARCHAR(255) PRIMARY KEY,
+          version BIGINT NOT NULL,
+          updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+        )
+        """,
+    )),
+    (5, "Add the log of ride counter increments not yet added to users", (
+        """
+        CREATE TABLE IF NOT EXISTS ride_counter_log (
+          entry_id BIGSERIAL PRIMARY KEY,
+          user_id INTEGER NOT NULL,
+          FOREIGN KEY (user_id)
+          REFERENCES users(user_id)
+          ON UPDATE CASCADE ON DELETE CASCADE,
+          rides_taken INTEGER NOT NULL,
+          rides_given INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ride_counter_log_user_id_idx
+          ON ride_counter_log (user_id)
+        """
+    )),
+    (6, "Add the coordinates of the rides and index their origin by cell", (
+        """
+        ALTER TABLE rides
+          ADD COLUMN IF NOT EXISTS origin_lat DOUBLE PRECISION,
+          ADD COLUMN IF NOT EXISTS origin_lon DOUBLE PRECISION,
+          ADD COLUMN IF NOT EXISTS destination_lat DOUBLE PRECISION,
+          ADD COLUMN IF NOT EXISTS destination_lon DOUBLE PRECISION,
+          ADD COLUMN IF NOT EXISTS origin_cell INTEGER
+        """,
+        # Holds every column the nearby search reads from rides, so the
+        # distances are computed from the index alone
+        """
+        CREATE INDEX IF NOT EXISTS rides_origin_cell_idx
+          ON rides (origin_cell, origin_lat, origin_lon, ride_id)
+          WHERE origin_cell IS NOT NULL
+        """
+    )),
+)
+
 
-    conn = None
-    try:
-        # Read the connection parameters
-        params = config()
-        if app.config['TESTING']:
-            params['database'] = 'ridemywaydb_testing'
+def applied_versions(cur):
+    """Returns the migration versions already applied to the database"""
+    cur.execute("SELECT version FROM schema_migrations")
+    return set(row[0] for row in cur.fetchall())
 
-        if 'DATABASE_URL' in os.environ:
-            database_url = os.environ['DATABASE_URL']
-            print(database_url)
-            conn = psycopg2.connect(database_url,
-                                    sslmode='require')
-        else:
-            conn = psycopg2.connect(**params)
+
+def migrate():
+    """
+    Applies the migrations that have not been applied yet.
+    Returns the list of versions that were applied.
+    """
+    applied = []
+    with get_pool().connection() as conn:
         cur = conn.cursor()
+        try:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)",
+                        (MIGRATION_LOCK_ID,))
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                  version INTEGER PRIMARY KEY,
+                  description TEXT NOT NULL,
+                  applied_at TIMESTAMP NOT NULL DEFAULT now()
+                )
+                """)
+            done = applied_versions(cur)
+            for version, description, commands in MIGRATIONS:
+                if version in done:
+                    continue
+                for command in commands:
+                    cur.execute(command)
+                cur.execute("INSERT INTO schema_migrations "
+                            "(version, description) VALUES (%s, %s)",
+                            (version, description))
+                applied.append(version)
+            conn.commit()
+        except psycopg2.DatabaseError:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Apply the database migrations")
+    parser.add_argument('--testing', action='store_true',
+                        help="Migrate the testing database instead of the "
+                             "one of APP_SETTINGS")
+    args = parser.parse_args()
+    if args.testing:
+        config_name = 'testing'
+    else:
+        config_name = os.environ.get('APP_SETTINGS', 'development')
+    app = create_app(config_name)
+
+    with app.app_context():
+        applied = migrate()
+    if applied:
+        print("Applied migrations: " + ", ".join(map(str, applied)))
+    else:
+        print("Database schema is up to date")
+
 
-        # create the tables one by one
-        for command in commands:
-            cur.execute(command)
-        # close communication with the PostgreSQL database server
-        cur.close()
-        # commit the changes
-        conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        if conn is not None:
-            conn.close()
+if __name__ == '__main__':
+    main()
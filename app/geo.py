@@ -0,0 +1,66 @@
+"""
+This file contains the grid used to find the rides starting near a point.
+The earth is divided into cells of CELL_DEGREES by CELL_DEGREES degrees,
+numbered row by row from the south pole and the antimeridian. Every ride
+with coordinates stores the cell of its origin, which is indexed, so the
+rides within a radius are found by scanning the cells of a few rows
+instead of every ride.
+"""
+import math
+
+EARTH_RADIUS_KM = 6371.0
+CELLS_PER_DEGREE = 20  # Cells of 0.05 degrees, about 5.5 km north-south
+CELL_DEGREES = 1.0 / CELLS_PER_DEGREE
+ROWS = 180 * CELLS_PER_DEGREE
+COLUMNS = 360 * CELLS_PER_DEGREE
+
+
+def cell_of(lat, lon):
+    """Returns the number of the cell containing a point"""
+    row = min(int((lat + 90) * CELLS_PER_DEGREE), ROWS - 1)
+    column = int((lon + 180) * CELLS_PER_DEGREE) % COLUMNS
+    return row * COLUMNS + column
+
+
+def cell_ranges(lat, lon, radius_km):
+    """
+    Returns the (first, last) cell numbers of the ranges of cells covering
+    every point within radius_km of a point. There is one range for each
+    row of cells, or two when the covered columns wrap around the
+    antimeridian.
+    """
+    angle = radius_km / EARTH_RADIUS_KM
+    lat_span = math.degrees(angle)
+    first_row = max(int((lat - lat_span + 90) * CELLS_PER_DEGREE), 0)
+    last_row = min(int((lat + lat_span + 90) * CELLS_PER_DEGREE), ROWS - 1)
+
+    # The longitudes spanned are widest at the edge closest to a pole
+    widest = abs(lat) + lat_span
+    if widest >= 90 or angle >= math.pi / 2:
+        columns = [(0, COLUMNS - 1)]
+    else:
+        lon_span = math.degrees(
+            math.asin(min(1.0, math.sin(angle) /
+                          math.cos(math.radians(widest)))))
+        first = int(math.floor((lon - lon_span + 180) * CELLS_PER_DEGREE))
+        last = int(math.floor((lon + lon_span + 180) * CELLS_PER_DEGREE))
+        if last - first + 1 >= COLUMNS:
+            columns = [(0, COLUMNS - 1)]
+        elif first < 0:
+            columns = [(0, last), (first + COLUMNS, COLUMNS - 1)]
+        elif last >= COLUMNS:
+            columns = [(0, last - COLUMNS), (first, COLUMNS - 1)]
+        else:
+            columns = [(first, last)]
+
+    return [(row * COLUMNS + first, row * COLUMNS + last)
+            for row in range(first_row, last_row + 1)
+            for first, last in columns]
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Returns the great circle distance between two points"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
@@ -2,24 +2,39 @@
 This file contains helper functions to be used in the views.py
 It helps keep the codebase manageable
 """
-from app.models import User, Request, Ride
-from flask import abort, jsonify, make_response
+import hashlib
+import time
+from datetime import timedelta, timezone
+from app import journeys
+from app.models import User, Request, Ride, collection_version
+from app.validators import Validate
+from app.serializers import dumps, json_response
+from flask import current_app, abort, jsonify, make_response, request, \
+    Response, stream_with_context
+
+DECISION_MESSAGES = {
+    'accept': 'You have accepted this ride request',
+    'reject': 'You have rejected this ride request'
+}
 
 
 def sign_up_user(username, password, email):
     """Signs up a user"""
+    conflict = {
+        'error': 'Conflict',
+        'message': 'User already exists. Choose a different username'
+    }
     user = User.get_user(username)
     if user:
-        response = {
-            'error': 'Conflict',
-            'message': 'User already exists. Choose a different username'
-        }
-        return make_response(jsonify(response)), 409
+        return make_response(jsonify(conflict)), 409
 
     user = User(username=username)
     user.hash_password(password)
     user.email = email
     user_id = user.add_new_user()
+    if user_id is None:
+        # The unique username index rejected a concurrent sign up
+        return make_response(jsonify(conflict)), 409
 
     response = {
         'message': 'Signed up successfully',
@@ -55,22 +70,313 @@ def login_user(username, password):
     return make_response(jsonify(response)), 401
 
 
+def page_limit():
+    """Reads the limit query parameter used for pagination"""
+    limit = request.args.get('limit', current_app.config['DEFAULT_PAGE_SIZE'])
+    if not Validate.validate_int(limit) or int(limit) < 1:
+        abort(400, 'Make sure the limit is a positive integer')
+    return min(int(limit), current_app.config['MAX_PAGE_SIZE'])
+
+
+def page_arguments():
+    """
+    Reads the limit and after query parameters used for pagination.
+    after is the id of the last item of the previous page
+    """
+    after = request.args.get('after', None)
+    if after is not None and not Validate.validate_int(after):
+        abort(400, 'Make sure the after cursor is an integer')
+
+    if after is not None:
+        after = int(after)
+    return page_limit(), after
+
+
+def paginate(items, limit, cursor=None):
+    """
+    Splits the items fetched with limit + 1 into the page to return
+    and the cursor of the next page (None on the last page).
+    cursor computes the cursor from the last item, its id by default
+    """
+    if len(items) > limit:
+        items = items[:limit]
+        if cursor:
+            return items, cursor(items[-1])
+        return items, items[-1].id
+    return items, None
+
+
+def price_cursor(ride):
+    """Returns the cursor of a ride in a listing sorted by price"""
+    return '{}:{}'.format(ride.price, ride.id)
+
+
+def search_rides():
+    """Searches the ride offers with the filters in the query string"""
+    args = request.args
+    sort = args.get('sort', 'id')
+    if sort not in Ride.SORTS:
+        abort(400, 'Make sure sort is one of ' + ', '.join(sorted(Ride.SORTS)))
+
+    prices = []
+    for name in ('min_price', 'max_price'):
+        price = args.get(name, None)
+        if price is not None and not Validate.validate_int(price):
+            abort(400, 'Make sure the {} is an integer'.format(name))
+        prices.append(int(price) if price is not None else None)
+
+    after = args.get('after', None)
+    cursor = None
+    if sort != 'id':
+        # Rides sorted by price continue after a "price:ride_id" cursor
+        if after is not None:
+            parts = after.split(':')
+            if len(parts) != 2 or not all(map(Validate.validate_int, parts)):
+                abort(400, 'Make sure the after cursor is a price:id pair')
+            after = (int(parts[0]), int(parts[1]))
+        cursor = price_cursor
+    elif after is not None:
+        if not Validate.validate_int(after):
+            abort(400, 'Make sure the after cursor is an integer')
+        after = int(after)
+
+    limit = page_limit()
+    rides = Ride.search_rides(args.get('origin'), args.get('destination'),
+                              prices[0], prices[1], sort, after, limit + 1)
+    rides, next_cursor = paginate(rides, limit, cursor)
+    response = {
+        'rides': rides,
+        'next_cursor': next_cursor
+    }
+    return json_response(response)
+
+
+def nearby_rides():
+    """Lists the ride offers starting within the radius (in km) of the
+    point in the query string, closest first"""
+    args = request.args
+    val = Validate.validate_coordinates(args.get('lat'), args.get('lon'))
+    if not val[0]:
+        abort(400, val[1])
+
+    max_radius = current_app.config['NEARBY_MAX_RADIUS']
+    radius = args.get('radius', current_app.config['NEARBY_DEFAULT_RADIUS'])
+    try:
+        radius = float(radius)
+    except (TypeError, ValueError):
+        radius = None
+    if radius is None or not 0 < radius <= max_radius:
+        abort(400, 'Make sure the radius is a number of kilometres '
+                   'between 0 and {}'.format(max_radius))
+
+    found = Ride.nearby_rides(float(args['lat']), float(args['lon']),
+                              radius, page_limit())
+    response = {
+        'rides': [{'ride': ride, 'distance_km': round(distance, 3)}
+                  for ride, distance in found],
+        'radius_km': radius
+    }
+    return json_response(response)
+
+
+def plan_journey():
+    """Finds the best journey between the origin and the destination
+    in the query string, optimised for price or for the number of legs"""
+    args = request.args
+    origin = args.get('origin', '').strip()
+    destination = args.get('destination', '').strip()
+    if not origin or not destination:
+        abort(400, 'Make sure you have specified an origin and a destination')
+
+    optimize = args.get('optimize', 'price')
+    if optimize not in journeys.COSTS:
+        abort(400, 'Make sure optimize is one of ' +
+              ', '.join(sorted(journeys.COSTS)))
+
+    most_legs = current_app.config['JOURNEY_MAX_LEGS']
+    max_legs = args.get('max_legs', 3)
+    if not Validate.validate_int(max_legs) or \
+            not 1 <= int(max_legs) <= most_legs:
+        abort(400, 'Make sure max_legs is an integer between 1 and {}'
+              .format(most_legs))
+
+    found = journeys.planner().search(origin, destination, optimize,
+                                      int(max_legs))
+    if found is None:
+        abort(404, 'No journey from {} to {} was found'
+              .format(origin, destination))
+    ride_ids, total_price = found
+    response = {
+        'journey': {
+            'legs': [Ride.get_one_ride(ride_id) for ride_id in ride_ids],
+            'total_price': total_price
+        }
+    }
+    return json_response(response)
+
+
+def set_coordinates(ride, data):
+    """Copies the optional coordinates of a ride offer from its
+    (validated) json data"""
+    for field in Ride.COORDINATES:
+        value = data.get(field)
+        setattr(ride, field, float(value) if value is not None else None)
+
+
+def wants_stream():
+    """Tells whether the client asked for a streamed response"""
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def stream_rides(username=None):
+    """
+    Returns a response that streams every ride offer (of username if
+    given) as json. Rides are read from the database in batches while
+    the response is sent, so memory use does not grow with the number
+    of rides.
+    """
+    after = request.args.get('after', None)
+    if after is not None and not Validate.validate_int(after):
+        abort(400, 'Make sure the after cursor is an integer')
+
+    rides = Ride.stream_rides(username, after,
+                              current_app.config['STREAM_BATCH_SIZE'])
+
+    def generate():
+        yield b'{"rides":['
+        separator = b''
+        for ride in rides:
+            yield separator + dumps(ride)
+            separator = b','
+        yield b'],"next_cursor":null}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def request_events(username):
+    """
+    Returns a response that streams the new ride requests and decisions
+    concerning username as server-sent events. The stream ends after
+    EVENTS_STREAM_DURATION seconds or when notifications were lost, and
+    the client reconnects; it should then fetch the requests again since
+    notifications are not replayed.
+    """
+    from app.notifications import get_listener, ListenerUnavailable
+    config = current_app.config
+    listener = get_listener()
+    try:
+        subscription = listener.subscribe(username,
+                                          config['EVENTS_QUEUE_SIZE'],
+                                          config['DATABASE_POOL_TIMEOUT'])
+    except ListenerUnavailable:
+        abort(503, 'Notifications are not available, try again later')
+
+    keepalive = config['EVENTS_KEEPALIVE']
+    end = time.time() + config['EVENTS_STREAM_DURATION']
+
+    def generate():
+        yield 'retry: {}\n\n'.format(
+            config['EVENTS_RETRY_DELAY']).encode()
+        while not subscription.lost:
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            event = subscription.get(min(keepalive, remaining))
+            if event is None:
+                yield b': keepalive\n\n'
+            else:
+                name, data = event
+                yield 'event: {}\ndata: {}\n\n'.format(name, data).encode()
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stops proxies like nginx from buffering the events
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(lambda: listener.unsubscribe(subscription))
+    return response
+
+
+def whole_second(moment):
+    """Rounds a time up to the next whole second, as sent in
+    Last-Modified, so that a client echoing it back is answered with 304"""
+    if moment is None or not moment.microsecond:
+        return moment
+    return moment.replace(microsecond=0) + timedelta(seconds=1)
+
+
+def not_modified(etag, last_modified):
+    """Tells whether the client already has the current version,
+    according to its If-None-Match or If-Modified-Since header.
+    If-None-Match uses the weak comparison, as proxies compressing the
+    response mark its ETag weak. last_modified is in whole seconds"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    if since is None or last_modified is None:
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return last_modified <= since
+
+
+def conditional_listing(collection, viewer, build):
+    """
+    Answers a listing request, using the version marker of the collection
+    to skip building the listing when the client has the current version.
+    build returns the json payload of the listing. The ETag depends on the
+    version, the user viewing the listing and the query string
+    """
+    version, last_modified = collection_version(collection)
+    last_modified = whole_second(last_modified)
+    tag = "{}:{}:{}:{}".format(collection, version, viewer,
+                               request.full_path)
+    etag = hashlib.md5(tag.encode()).hexdigest()
+
+    if not_modified(etag, last_modified):
+        response = make_response('', 304)
+    else:
+        response = json_response(build())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def list_rides(username=None):
+    """Returns a page of the ride offers (of username if given)"""
+    limit, after = page_arguments()
+    ride_offers = Ride.get_all_rides(username, after, limit + 1)
+    ride_offers, next_cursor = paginate(ride_offers, limit)
+    return {
+        'rides': ride_offers,
+        'next_cursor': next_cursor
+    }
+
+
+def list_requests(ride_id):
+    """Returns a page of the ride requests of a ride offer"""
+    limit, after = page_arguments()
+    requests_list = Request.get_ride_requests(ride_id, after, limit + 1)
+    requests_list, next_cursor = paginate(requests_list, limit)
+    return {
+        'ride_requests': requests_list,
+        'next_cursor': next_cursor
+    }
+
+
 def return_requests(ride_id, ride, username):
     #  Check if this user is the one that created the ride request
     if ride.name == username:
-        requests_list = Request.get_ride_requests(ride_id)
-        requests_list = [req.__dict__ for req in requests_list]
-        response = {
-            'ride_requests': requests_list
-        }
-        return make_response(jsonify(response)), 200
+        return conditional_listing(Request.collection(ride_id), username,
+                                   lambda: list_requests(ride_id))
     else:
         abort(401,
               'You are not authorized to view these '
               'ride requests because you did not create this ride offer.')
 
 
-def accept_or_reject(request_id, data):
+def accept_or_reject(ride_id, request_id, data):
     if 'decision' not in data:
         abort(400,
               'Make sure you have a decision key in your request')
@@ -81,26 +387,117 @@ def accept_or_reject(request_id, data):
               'decision key to accept or reject'
               )
 
-    success = Request.accept_reject_ride_request(decision, request_id)
-    if success:
-        if decision == 'accept':
-            message = 'You have accepted this ride request'
-            req_info = Request.get_one_ride_request(request_id)
-            passenger_name = req_info[0].name
-            driver_name = Ride.get_one_ride(req_info[1]).name
-
-            passenger = User.get_user(passenger_name)
-            driver = User.get_user(driver_name)
-            passenger.update_rides('rides_taken')
-            driver.update_rides('rides_given')
-        else:
-            message = 'You have rejected this ride request'
-
+    ride_request = Request.accept_reject_ride_request(decision,
+                                                      request_id,
+                                                      ride_id)
+    if ride_request:
         response = {
-            'status': message
+            'status': DECISION_MESSAGES[decision],
+            'ride_request': ride_request
         }
     else:
         response = {
             'status': 'Failed to accept or reject the ride request'
         }
-    return make_response(jsonify(response)), 200
+    return json_response(response)
+
+
+def batch_items(data, key):
+    """Returns the list of items of a batch request"""
+    items = data.get(key) if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        abort(400, 'Make sure your request contains a list of ' + key)
+    if len(items) > current_app.config['MAX_BATCH_SIZE']:
+        abort(400, 'A batch can contain at most {} {}'
+              .format(current_app.config['MAX_BATCH_SIZE'], key))
+    return items
+
+
+def create_ride_offers(username, data):
+    """Creates all the valid ride offers of a batch in one statement
+    and reports the result of every item"""
+    items = batch_items(data, 'rides')
+
+    results = []
+    rides = []
+    for index, item in enumerate(items):
+        val = Validate.validate_ride_offer(item)
+        if not val[0]:
+            results.append({'index': index, 'error': val[1]})
+            continue
+        ride = Ride(username,
+                    item['origin'],
+                    item['destination'],
+                    int(item.get('price', 0)))
+        set_coordinates(ride, item)
+        rides.append(ride)
+        results.append({'index': index, 'ride': ride})
+
+    if rides:
+        user = User.get_user(username)
+        if not user:
+            abort(401, 'User account does not exist')
+        if not Ride.add_new_ride_offers(user.user_id, rides):
+            response = {
+                'message': 'Failed to create the ride offers'
+            }
+            return make_response(jsonify(response)), 500
+
+    for result in results:
+        if 'ride' in result:
+            result['ride_id'] = result['ride'].id
+
+    response = {
+        'message': '{} of {} rides created successfully'
+                   .format(len(rides), len(items)),
+        'results': results
+    }
+    return json_response(response, 201 if rides else 400)
+
+
+def accept_or_reject_batch(ride_id, data):
+    """Records all the valid decisions of a batch in one transaction
+    and reports the result of every item"""
+    items = batch_items(data, 'decisions')
+
+    results = []
+    decisions = []
+    seen = set()
+    for item in items:
+        val = Validate.validate_decision(item)
+        request_id = item.get('request_id') if isinstance(item, dict) \
+            else None
+        if not val[0]:
+            results.append({'request_id': request_id, 'error': val[1]})
+            continue
+        request_id = int(request_id)
+        if request_id in seen:
+            results.append({'request_id': request_id,
+                            'error': 'Duplicate decision for this request'})
+            continue
+        seen.add(request_id)
+        decisions.append((request_id, item['decision']))
+        results.append({'request_id': request_id,
+                        'decision': item['decision']})
+
+    decided = {}
+    if decisions:
+        decided = Request.accept_reject_ride_requests(ride_id, decisions)
+        if decided is None:
+            response = {
+                'status': 'Failed to accept or reject the ride requests'
+            }
+            return make_response(jsonify(response)), 500
+
+    for result in results:
+        if 'decision' not in result:
+            continue
+        decision = result.pop('decision')
+        ride_request = decided.get(result['request_id'])
+        if ride_request is None:
+            result['error'] = 'Ride request does not exist'
+        else:
+            result['status'] = DECISION_MESSAGES[decision]
+            result['ride_request'] = ride_request
+
+    return json_response({'results': results})
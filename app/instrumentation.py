@@ -0,0 +1,100 @@
+"""
+This file contains the instrumentation of the database access.
+Every statement is timed; statements slower than SLOW_QUERY_THRESHOLD
+seconds are logged with their normalised text. The statement count,
+database time and connection checkout time of each request are kept on
+flask.g and, when DATABASE_TIMING_HEADERS is set, sent back in X-DB-*
+response headers.
+"""
+import logging
+import re
+from flask import current_app, g, has_app_context, has_request_context
+from app.database_pool import add_statement_listener, add_checkout_listener
+
+logger = logging.getLogger('app.database')
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """Returns sql on one line with its literal values replaced by ?,
+    so that the same query is logged the same way whatever its values"""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = _LITERALS.sub('?', sql)
+    return _SPACES.sub(' ', sql).strip()
+
+
+class RequestStats:
+    """Database usage of one request"""
+
+    __slots__ = ('statements', 'rows', 'time', 'checkout_time')
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.time = 0.0
+        self.checkout_time = 0.0
+
+
+def request_stats():
+    """Returns the database usage of the current request"""
+    stats = getattr(g, 'database_stats', None)
+    if stats is None:
+        stats = g.database_stats = RequestStats()
+    return stats
+
+
+def record_statement(sql, duration, rowcount):
+    """Statement listener keeping the per request totals
+    and logging slow statements"""
+    if has_request_context():
+        stats = request_stats()
+        stats.statements += 1
+        stats.time += duration
+        if rowcount > 0:
+            stats.rows += rowcount
+
+    if not has_app_context():
+        return
+    threshold = current_app.config['SLOW_QUERY_THRESHOLD']
+    if threshold is not None and duration >= threshold:
+        logger.warning("Slow query (%.1f ms, %d rows): %s",
+                       duration * 1000, rowcount, normalize_sql(sql))
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Query (%.1f ms, %d rows): %s",
+                     duration * 1000, rowcount, normalize_sql(sql))
+
+
+def record_checkout(duration):
+    """Checkout listener adding the time spent waiting for a connection
+    to the totals of the current request"""
+    if has_request_context():
+        request_stats().checkout_time += duration
+
+
+def add_timing_headers(response):
+    """Sends the database usage of the request in response headers"""
+    stats = getattr(g, 'database_stats', None)
+    if stats is not None and current_app.config['DATABASE_TIMING_HEADERS']:
+        response.headers['X-DB-Statements'] = str(stats.statements)
+        response.headers['X-DB-Rows'] = str(stats.rows)
+        response.headers['X-DB-Time'] = '{:.3f}'.format(stats.time * 1000)
+        response.headers['X-DB-Checkout-Time'] = \
+            '{:.3f}'.format(stats.checkout_time * 1000)
+    return response
+
+
+_installed = False
+
+
+def install(app):
+    """Starts instrumenting the database access of the application.
+    The listeners are shared by every application of the process"""
+    global _installed
+    if not _installed:
+        _installed = True
+        add_statement_listener(record_statement)
+        add_checkout_listener(record_checkout)
+    app.after_request(add_timing_headers)
@@ -0,0 +1,226 @@
+"""
+This file contains the journey planner, which finds the rides taking a
+passenger from one place to another with one or more legs.
+
+The places linked by ride offers are kept in memory as a graph: a place
+is a node and the rides from one place to another are an edge, of which
+only the cheapest ride is kept since it makes the best leg whatever the
+journey is optimised for. Place names are compared ignoring case and
+extra spaces.
+
+The graph is loaded on the first journey query. Rides added by this
+process are added to it at once. Rides added by other processes are read
+by id at most every JOURNEY_REFRESH_INTERVAL seconds, and the graph is
+rebuilt every JOURNEY_REBUILD_INTERVAL seconds to pick up the rides whose
+transactions committed after those of rides with greater ids.
+"""
+import heapq
+import threading
+import time
+from flask import current_app
+from app.database_helper import Database
+
+# Columns of the rides read into the graph
+COLUMNS = ("ride_id", "origin", "destination", "price")
+
+# The cost compared between journeys for each optimisation
+COSTS = {
+    'price': lambda price, legs: (price, legs),
+    'legs': lambda price, legs: (legs, price)
+}
+
+
+def place_key(name):
+    """Returns the name a place is known by in the graph"""
+    return ' '.join(name.lower().split())
+
+
+class RideGraph:
+    """The places linked by ride offers"""
+
+    def __init__(self):
+        self.edges = {}  # place -> {place: (price, ride id)}
+        self.reverse = {}  # The same legs by destination then origin
+        self.last_ride_id = 0  # Greatest id of the rides read
+
+    def add(self, ride_id, origin, destination, price):
+        """Adds a ride. Adding a ride more than once changes nothing"""
+        try:
+            price = int(price)
+            origin = place_key(str(origin))
+            destination = place_key(str(destination))
+        except (TypeError, ValueError):
+            # The ride is saved already, it is only left out of journeys
+            return
+        if origin == destination or price < 0:
+            # The search relies on legs never lowering the price
+            return
+        leg = (price, ride_id)
+        current = self.edges.get(origin, {}).get(destination)
+        if current is None or leg < current:
+            self.edges.setdefault(origin, {})[destination] = leg
+            self.reverse.setdefault(destination, {})[origin] = leg
+
+    def add_rows(self, rows):
+        """Adds the rides of rows with the columns in COLUMNS"""
+        for ride_id, origin, destination, price in rows:
+            self.add(ride_id, origin, destination, price)
+            if ride_id > self.last_ride_id:
+                self.last_ride_id = ride_id
+
+    @staticmethod
+    def _layers(edges, start, count):
+        """
+        Returns, for 0 to count legs, the cheapest way of reaching each place
+        from start along edges with exactly that many legs, as a dictionary
+        of place to (price, previous place, ride id). A place is left out of
+        a layer when it is reached as cheaply with fewer legs
+        """
+        layers = [{start: (0, None, None)}]
+        cheapest = {start: 0}
+        for _ in range(count):
+            layer = {}
+            for place, (price, _, _) in layers[-1].items():
+                for next_place, (leg_price, ride_id) in \
+                        edges.get(place, {}).items():
+                    next_price = price + leg_price
+                    known = cheapest.get(next_place)
+                    if known is not None and known <= next_price:
+                        continue
+                    reached = layer.get(next_place)
+                    if reached is None or next_price < reached[0]:
+                        layer[next_place] = (next_price, place, ride_id)
+            for place, (price, _, _) in layer.items():
+                cheapest[place] = price
+            layers.append(layer)
+        return layers
+
+    @staticmethod
+    def _rides(layers, legs, place):
+        """Returns the ride ids of the way to place with legs legs,
+        from the start of the layers"""
+        rides = []
+        while legs:
+            _, place, ride_id = layers[legs][place]
+            rides.append(ride_id)
+            legs -= 1
+        return rides
+
+    def search(self, origin, destination, optimize='price', max_legs=3):
+        """
+        Returns the (ride ids, total price) of the best journey from origin
+        to destination with at most max_legs rides, None if there is none.
+        The best journey is the cheapest (then the one with the fewest
+        legs) when optimize is 'price', and the one with the fewest legs
+        (then the cheapest) when it is 'legs'
+        """
+        cost = COSTS[optimize]
+        start = place_key(origin)
+        goal = place_key(destination)
+        if start == goal or start not in self.edges or \
+                goal not in self.reverse:
+            return None
+
+        # The first half of the legs is searched from the origin and the
+        # second half from the destination, and the two meet at a place.
+        # This reads far fewer legs than searching all of them from the
+        # origin, as the number of journeys grows with each leg
+        forward = self._layers(self.edges, start, (max_legs + 1) // 2)
+        backward = self._layers(self.reverse, goal, max_legs // 2)
+        best = None
+        for forward_legs, reached in enumerate(forward):
+            for backward_legs, left in enumerate(backward):
+                legs = forward_legs + backward_legs
+                smaller, larger = sorted((reached, left), key=len)
+                for place in smaller:
+                    if place not in larger:
+                        continue
+                    price = reached[place][0] + left[place][0]
+                    journey = (cost(price, legs), price, forward_legs,
+                               backward_legs, place)
+                    if best is None or journey < best:
+                        best = journey
+        if best is None:
+            return None
+
+        _, price, forward_legs, backward_legs, place = best
+        rides = self._rides(forward, forward_legs, place)
+        rides.reverse()
+        rides.extend(self._rides(backward, backward_legs, place))
+        return rides, price
+
+
+class JourneyPlanner:
+    """Keeps the ride graph of a process up to date and searches it"""
+
+    def __init__(self):
+        self.graph = None
+        self.built_at = 0.0
+        self.refreshed_at = 0.0
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    @staticmethod
+    def build(batch_size):
+        """Returns a new graph of every ride"""
+        graph = RideGraph()
+        graph.add_rows(Database().stream("rides", COLUMNS,
+                                         where={"ride_id >": 0},
+                                         order_by="ride_id",
+                                         batch_size=batch_size))
+        return graph
+
+    def refresh(self, config):
+        """Rebuilds the graph or reads the new rides when it is time to"""
+        now = time.time()
+        if now - self.built_at >= config['JOURNEY_REBUILD_INTERVAL']:
+            # The graph is built without holding the lock, so searches go
+            # on with the previous graph; waiting is only needed at first
+            if self._build_lock.acquire(self.graph is None):
+                try:
+                    if now - self.built_at >= \
+                            config['JOURNEY_REBUILD_INTERVAL']:
+                        graph = self.build(config['STREAM_BATCH_SIZE'])
+                        with self._lock:
+                            self.graph = graph
+                            self.built_at = self.refreshed_at = now
+                finally:
+                    self._build_lock.release()
+                return
+
+        if now - self.refreshed_at >= config['JOURNEY_REFRESH_INTERVAL']:
+            with self._lock:
+                if now - self.refreshed_at < \
+                        config['JOURNEY_REFRESH_INTERVAL']:
+                    return
+                self.refreshed_at = now
+                where = {"ride_id >": self.graph.last_ride_id}
+            # Searches go on while the new rides are read
+            rows = Database().select("rides", COLUMNS, where=where,
+                                     order_by="ride_id") or []
+            with self._lock:
+                self.graph.add_rows(rows)
+
+    def add_ride(self, ride):
+        """Adds a ride offer just saved to the graph, if it was loaded"""
+        with self._lock:
+            if self.graph is not None:
+                self.graph.add(ride.id, ride.origin, ride.destination,
+                               ride.price)
+
+    def search(self, origin, destination, optimize='price', max_legs=3):
+        """Searches the up to date graph, see RideGraph.search"""
+        self.refresh(current_app.config)
+        with self._lock:
+            return self.graph.search(origin, destination, optimize,
+                                     max_legs)
+
+
+def init_app(app):
+    """Creates the journey planner of an application"""
+    app.extensions['journeys'] = JourneyPlanner()
+
+
+def planner():
+    """Returns the journey planner of the current application"""
+    return current_app.extensions['journeys']
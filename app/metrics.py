@@ -0,0 +1,356 @@
+"""
+This file contains the request metrics exposed at /metrics in the
+Prometheus text format: request counters by route, method and status,
+latency and payload size histograms and the number of requests in flight.
+
+Every thread records into its own store, so recording takes no lock; the
+stores are only merged when the metrics are scraped. When METRICS_DIR is
+set, each worker process regularly saves its totals there and a scrape
+served by any worker reports the totals of the workers still running.
+A worker removes its file when it exits, and the files of workers that
+ended without doing so are removed by the next scrape.
+"""
+import atexit
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from flask import current_app, request, Response
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# Environ key the route template of a request is saved under
+ROUTE_KEY = 'ridemyway.route'
+UNMATCHED = 'unmatched'
+
+
+class Store:
+    """The metrics recorded by one thread (or merged from several)"""
+
+    __slots__ = ('requests', 'latency', 'request_size', 'response_size',
+                 'in_flight')
+
+    def __init__(self):
+        self.requests = {}  # (route, method, status) -> count
+        # (route, method) -> bucket counts followed by the sum
+        self.latency = {}
+        self.request_size = {}
+        self.response_size = {}
+        self.in_flight = 0
+
+    def observe(self, histograms, key, buckets, value):
+        counts = histograms.get(key)
+        if counts is None:
+            counts = histograms[key] = [0] * (len(buckets) + 2)
+        counts[bisect.bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    def add(self, other):
+        """Adds the metrics of another store to this one"""
+        for key, count in list(other.requests.items()):
+            self.requests[key] = self.requests.get(key, 0) + count
+        for name in ('latency', 'request_size', 'response_size'):
+            mine = getattr(self, name)
+            for key, counts in list(getattr(other, name).items()):
+                counts = list(counts)
+                total = mine.get(key)
+                if total is None:
+                    mine[key] = counts
+                else:
+                    mine[key] = [a + b for a, b in zip(total, counts)]
+        self.in_flight += other.in_flight
+
+    def to_json(self):
+        data = {'requests': [list(key) + [count] for key, count
+                             in self.requests.items()],
+                'in_flight': self.in_flight}
+        for name in ('latency', 'request_size', 'response_size'):
+            data[name] = [list(key) + [counts] for key, counts
+                          in getattr(self, name).items()]
+        return data
+
+    @classmethod
+    def from_json(cls, data):
+        store = cls()
+        for route, method, status, count in data['requests']:
+            store.requests[(route, method, status)] = count
+        for name in ('latency', 'request_size', 'response_size'):
+            histograms = getattr(store, name)
+            for route, method, counts in data[name]:
+                histograms[(route, method)] = counts
+        store.in_flight = data['in_flight']
+        return store
+
+
+class Registry:
+    """Hands out one store per thread and merges them on demand"""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._local = threading.local()
+        self._stores = []  # (thread, store)
+        self._retired = Store()  # Totals of the threads that have ended
+        self._lock = threading.Lock()
+
+    def store(self):
+        store = getattr(self._local, 'store', None)
+        if store is None:
+            store = self._local.store = Store()
+            with self._lock:
+                self._stores.append((threading.current_thread(), store))
+        return store
+
+    def collect(self):
+        """Returns a store with the totals of every thread"""
+        total = Store()
+        with self._lock:
+            alive = []
+            for thread, store in self._stores:
+                if thread.is_alive():
+                    alive.append((thread, store))
+                else:
+                    self._retired.add(store)
+            self._stores = alive
+            total.add(self._retired)
+        for _, store in alive:
+            total.add(store)
+        return total
+
+
+_registry = Registry()
+_registry_lock = threading.Lock()
+_last_save = 0.0
+_save_lock = threading.Lock()
+_saved_pid = None  # Process whose file is removed at exit
+
+
+def registry():
+    """Returns the registry of this process"""
+    global _registry
+    if _registry.pid != os.getpid():
+        with _registry_lock:
+            if _registry.pid != os.getpid():
+                # Requests counted by the parent are reported by the parent
+                _registry = Registry()
+    return _registry
+
+
+def metrics_file(directory, pid):
+    return os.path.join(directory, 'metrics_{}.json'.format(pid))
+
+
+def remove(path):
+    """Removes a saved file, if it still exists"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def save(directory):
+    """Saves the totals of this process to its file in directory.
+    The file is removed when the process exits"""
+    global _saved_pid
+    path = metrics_file(directory, os.getpid())
+    if _saved_pid != os.getpid():
+        _saved_pid = os.getpid()
+        atexit.register(remove, path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as tmp:
+        json.dump(registry().collect().to_json(), tmp)
+    os.replace(tmp_path, path)
+
+
+def maybe_save(config):
+    """Saves the totals when METRICS_FLUSH_INTERVAL has passed"""
+    global _last_save
+    directory = config['METRICS_DIR']
+    if not directory:
+        return
+    now = time.time()
+    if now - _last_save < config['METRICS_FLUSH_INTERVAL']:
+        return
+    if not _save_lock.acquire(False):
+        return  # Another thread is saving
+    try:
+        _last_save = now
+        save(directory)
+    finally:
+        _save_lock.release()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect_all():
+    """Returns the totals of this process, plus those saved by the other
+    running worker processes when METRICS_DIR is set"""
+    total = registry().collect()
+    directory = current_app.config['METRICS_DIR']
+    if not directory:
+        return total
+    for path in glob.glob(os.path.join(directory, 'metrics_*.json')):
+        try:
+            pid = int(os.path.basename(path)[8:-5])
+            if pid == os.getpid():
+                continue
+            if not _pid_alive(pid):
+                # The worker ended without removing its file
+                remove(path)
+                continue
+            with open(path) as saved:
+                store = Store.from_json(json.load(saved))
+        except (ValueError, OSError):
+            continue
+        total.add(store)
+    return total
+
+
+class _Body:
+    """Wraps a response body to count its size and
+    record the request when the body has been sent"""
+
+    def __init__(self, body, finish):
+        self.body = body
+        self.finish = finish
+        self.size = 0
+        self.done = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.body:
+                self.size += len(chunk)
+                yield chunk
+        finally:
+            self._finish()
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        if not self.done:
+            self.done = True
+            self.finish(self.size)
+
+
+class MetricsMiddleware:
+    """WSGI middleware recording the metrics of every request.
+    It runs outside of the application context, so it keeps the
+    configuration of the application"""
+
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        store = registry().store()
+        store.in_flight += 1
+        status = ['500']
+
+        def record_status(status_line, headers, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def finish(size):
+            store.in_flight -= 1
+            route = environ.get(ROUTE_KEY, UNMATCHED)
+            method = environ.get('REQUEST_METHOD', '')
+            key = (route, method)
+            requests = store.requests
+            status_key = (route, method, status[0])
+            requests[status_key] = requests.get(status_key, 0) + 1
+            store.observe(store.latency, key, LATENCY_BUCKETS,
+                          time.perf_counter() - start)
+            store.observe(store.request_size, key, SIZE_BUCKETS,
+                          int(environ.get('CONTENT_LENGTH') or 0))
+            store.observe(store.response_size, key, SIZE_BUCKETS, size)
+            maybe_save(self.config)
+
+        try:
+            body = self.wsgi_app(environ, record_status)
+        except Exception:
+            finish(0)
+            raise
+        return _Body(body, finish)
+
+
+def remember_route():
+    """Saves the route template of the request for the middleware"""
+    if request.url_rule is not None:
+        request.environ[ROUTE_KEY] = request.url_rule.rule
+
+
+def _labels(names, values):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(name, value))
+    return ','.join(pairs)
+
+
+def _histogram(lines, name, help_text, histograms, buckets):
+    lines.append('# HELP {} {}'.format(name, help_text))
+    lines.append('# TYPE {} histogram'.format(name))
+    for key, counts in sorted(histograms.items()):
+        labels = _labels(('route', 'method'), key)
+        cumulative = 0
+        for bound, count in zip(buckets + ('+Inf',), counts[:-1]):
+            cumulative += count
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                name, labels, bound, cumulative))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, counts[-1]))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, cumulative))
+
+
+def render(store):
+    """Returns the metrics of store in the Prometheus text format"""
+    lines = ['# HELP ridemyway_http_requests_total Requests handled',
+             '# TYPE ridemyway_http_requests_total counter']
+    for key, count in sorted(store.requests.items()):
+        lines.append('ridemyway_http_requests_total{{{}}} {}'.format(
+            _labels(('route', 'method', 'status'), key), count))
+    lines.append('# HELP ridemyway_http_requests_in_flight '
+                 'Requests being handled')
+    lines.append('# TYPE ridemyway_http_requests_in_flight gauge')
+    lines.append('ridemyway_http_requests_in_flight {}'.format(
+        store.in_flight))
+    _histogram(lines, 'ridemyway_http_request_duration_seconds',
+               'Time taken to handle requests', store.latency,
+               LATENCY_BUCKETS)
+    _histogram(lines, 'ridemyway_http_request_size_bytes',
+               'Size of the request bodies', store.request_size,
+               SIZE_BUCKETS)
+    _histogram(lines, 'ridemyway_http_response_size_bytes',
+               'Size of the response bodies', store.response_size,
+               SIZE_BUCKETS)
+    return '\n'.join(lines) + '\n'
+
+
+def metrics():
+    """Endpoint returning the metrics of all the workers"""
+    return Response(render(collect_all()),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def install(app):
+    """Starts recording the request metrics and serves them at /metrics"""
+    app.before_request(remember_route)
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, app.config)
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -1,12 +1,65 @@
-from passlib.apps import custom_app_context as pwd_context
-import jwt
 import datetime
+import random
+import jwt
+from flask import current_app
+from werkzeug.local import LocalProxy
 from app.database_helper import Database
-from app import app
+from app import passwords, counters, serializers, geo, journeys
+from app.token_cache import TokenCache
+from app.cache import build_cache
+
+# Caches of the current application, created by init_app
+token_cache = LocalProxy(lambda: current_app.extensions['token_cache'])
+# Rows of users and rides, see User.get_user and Ride.get_one_ride
+cache = LocalProxy(lambda: current_app.extensions['cache'])
+
+
+def init_app(app):
+    """Creates the caches used by the models of an application"""
+    app.extensions['token_cache'] = TokenCache(app.config['TOKEN_CACHE_SIZE'])
+    app.extensions['cache'] = build_cache(app.config)
+
+
+def map_rows(model, rows):
+    """Converts the rows returned by a query into model objects"""
+    if not rows:
+        return []
+    from_row = model.from_row
+    return [from_row(row) for row in rows]
+
+
+def like_prefix(text):
+    """Returns the LIKE pattern matching values that start with text,
+    ignoring case"""
+    if not text:
+        return None
+    text = text.lower().replace('\\', '\\\\')
+    text = text.replace('%', '\\%').replace('_', '\\_')
+    return text + '%'
+
+
+def given(where):
+    """Returns the entries of a where dictionary of optional filters
+    whose value was given, so that the filters left as None are skipped"""
+    return dict((key, value) for key, value in where.items()
+                if value is not None)
+
+
+def collection_version(collection):
+    """Returns the version of a collection and
+    the time it last changed"""
+    return Database().collection_version(collection)
 
 
 class User:
 
+    __slots__ = ('username', 'user_id', 'password_hash', 'email',
+                 'rides_taken', 'rides_given')
+
+    # Columns selected for a user, in the order expected by from_row
+    COLUMNS = ("user_id", "username", "user_password",
+               "rides_taken", "rides_given", "email")
+
     def __init__(self, username=None, password=None,
                  rides_taken=0, rides_given=0):
         self.username = username
@@ -15,14 +68,40 @@ class User:
         self.email = None  # Default value
         self.rides_taken = rides_taken
         self.rides_given = rides_given
-        self.conn = None
-        self.cur = None
+
+    @classmethod
+    def from_row(cls, row):
+        """Creates a user from a row with the columns in User.COLUMNS"""
+        user_id, username, password, rides_taken, rides_given, email = row
+        user = cls(username, password, rides_taken, rides_given)
+        user.email = email
+        user.user_id = user_id
+        return user
 
     def hash_password(self, password):
-        self.password_hash = pwd_context.hash(password)
+        self.password_hash = passwords.hash_password(password)
 
     def verify_password(self, password):
-        return pwd_context.verify(password, self.password_hash)
+        """Checks the password. A stored hash made with outdated
+        settings is replaced with a new one when the password matches"""
+        valid, new_hash = passwords.verify_password(password,
+                                                    self.password_hash)
+        if valid and new_hash:
+            self.password_hash = new_hash
+            self.update_password()
+        return valid
+
+    def update_password(self):
+        """Saves the password hash of the user"""
+        database_conn = Database()
+        return_val = database_conn.update('users',
+                                          {"user_password":
+                                           self.password_hash},
+                                          {"username": self.username})
+        cache.invalidate(User.cache_key(self.username))
+        if return_val:
+            return True
+        return False
 
     def add_new_user(self):
         """Adds a new user to the database"""
@@ -43,8 +122,9 @@ class User:
                                              columns,
                                              values,
                                              "user_id")
+        cache.invalidate(User.cache_key(self.username))
         user_id = None
-        for row in data_returned:
+        for row in data_returned or []:
             user_id = row[0]
 
         return user_id
@@ -53,60 +133,82 @@ class User:
     def get_user(username):
         """Gets a user from the database
         whose username matches the one given"""
-        database_conn = Database()
-        columns = "*"
-        where = "username = \'" + username + "\'"
-        data_returned = database_conn.select("users",
-                                             columns,
-                                             where=where)
-
-        row = None
-        if data_returned and len(data_returned) > 0:
-            row = data_returned[0]
-        user = None
+        def load():
+            database_conn = Database()
+            where = {"username": username}
+            data_returned = database_conn.select("users",
+                                                 User.COLUMNS,
+                                                 where=where,
+                                                 prepare=True)
+            if data_returned:
+                return tuple(data_returned[0])
+            return None
+
+        row = cache.get(User.cache_key(username), load)
         if row:
-            user_id = row[0]
-            username = row[1]
-            password = row[2]
-            rides_taken = row[3]
-            rides_given = row[4]
-            email = row[5]
-            user = User(username, password, rides_taken, rides_given)
-            user.email = email
-            user.user_id = user_id
+            return User.from_row(row)
+        return None
 
-        return user
+    @staticmethod
+    def cache_key(username):
+        """Key of the cached row of a user"""
+        return "user:" + username
+
+    # Returns a user with the numbers of rides taken and given that
+    # include the logged increments not yet flushed, see app.counters
+    TOTALS_SQL = """
+        SELECT u.user_id, u.username, u.user_password,
+               u.rides_taken + coalesce(sum(l.rides_taken), 0),
+               u.rides_given + coalesce(sum(l.rides_given), 0), u.email
+        FROM users u
+        LEFT JOIN ride_counter_log l ON (l.user_id = u.user_id)
+        WHERE u.username = %s
+        GROUP BY u.user_id
+        """
 
-    def update_rides(self, field):
-        """Updates the rides taken and given by a user"""
+    @staticmethod
+    def get_user_totals(username):
+        """Gets a user with exact ride counters. Unlike get_user
+        the user is always read from the database"""
         database_conn = Database()
-        sett = field + " = " + field + " + 1"
-        where = "username = '" + self.username + "'"
-
-        return_val = database_conn.update('users',
-                                          sett,
-                                          where)
+        data_returned = database_conn.execute_sql(User.TOTALS_SQL,
+                                                  (username,),
+                                                  prepare=True)
+        if data_returned:
+            return User.from_row(data_returned[0])
+        return None
 
-        if return_val:
-            return True
-        return False
+    @staticmethod
+    def flush_ride_counters():
+        """Adds the logged ride counter increments to the users table"""
+        usernames = counters.flush()
+        cache.invalidate(*[User.cache_key(name) for name in usernames])
 
     def generate_auth_token(self):
         payload = {
             'user': self.username,
             'exp': datetime.datetime.utcnow() + datetime.timedelta(days=1),
         }
-        token = jwt.encode(payload, app.config['SECRET'], algorithm='HS256')
+        token = jwt.encode(payload, current_app.config['SECRET'],
+                           algorithm='HS256')
 
         return token
 
     @staticmethod
     def decode_token(token):
-        """Used to decode a token obtained from the authorization header"""
+        """Used to decode a token obtained from the authorization header.
+        Tokens that were decoded before are looked up in token_cache
+        instead of verifying their signature again"""
+        key = (current_app.config['SECRET'], token)
+        username = token_cache.get(key)
+        if username is not None:
+            return username
+
         try:
             payload = jwt.decode(token,
-                                 app.config['SECRET'],
+                                 current_app.config['SECRET'],
                                  algorithms='HS256')
+            token_cache.put(key, payload['user'], payload.get('exp', 0))
             return payload['user']
         except jwt.ExpiredSignature:
             return "Token is expired. Please login again"
@@ -116,231 +218,500 @@ class User:
 
 class Ride:
 
+    __slots__ = ('id', 'name', 'origin', 'destination', 'price',
+                 'origin_lat', 'origin_lon', 'destination_lat',
+                 'destination_lon', 'requests')
+
+    # Optional coordinates of the origin and the destination
+    COORDINATES = ('origin_lat', 'origin_lon',
+                   'destination_lat', 'destination_lon')
+    # Columns selected for a ride, in the order expected by from_row
+    COLUMNS = ("r.ride_id", "u.username", "r.origin",
+               "r.destination", "r.price", "r.origin_lat", "r.origin_lon",
+               "r.destination_lat", "r.destination_lon")
+    # Columns written when a ride is added, see insert_values
+    INSERT_COLUMNS = ("user_id", "origin", "destination", "price",
+                      "origin_lat", "origin_lon", "destination_lat",
+                      "destination_lon", "origin_cell")
+    TABLE = "rides r"
+    JOIN = "users u on (u.user_id=r.user_id)"
+    # Names of the version markers of the ride listings. Each insert bumps
+    # one of them at random, so concurrent inserts do not all wait for the
+    # lock of the same row; the version of the listings is their sum
+    COLLECTION = tuple("rides#{}".format(shard) for shard in range(16))
+
     def __init__(self, name, origin, destination, price=0):
         self.id = 0  # Default value
         self.name = name
         self.origin = origin
         self.destination = destination
         self.price = price
+        self.origin_lat = None
+        self.origin_lon = None
+        self.destination_lat = None
+        self.destination_lon = None
         self.requests = []
 
+    @classmethod
+    def from_row(cls, row):
+        """Creates a ride from a row with the columns in Ride.COLUMNS"""
+        ride_id, username, origin, destination, price, origin_lat, \
+            origin_lon, destination_lat, destination_lon = row[:9]
+        ride = cls(username, origin, destination, price)
+        ride.id = ride_id
+        ride.origin_lat = origin_lat
+        ride.origin_lon = origin_lon
+        ride.destination_lat = destination_lat
+        ride.destination_lon = destination_lon
+        return ride
+
+    def insert_values(self, user_id):
+        """Returns the values of Ride.INSERT_COLUMNS for this ride"""
+        origin_cell = None
+        if self.origin_lat is not None and self.origin_lon is not None:
+            origin_cell = geo.cell_of(self.origin_lat, self.origin_lon)
+        return (user_id, self.origin, self.destination, self.price,
+                self.origin_lat, self.origin_lon, self.destination_lat,
+                self.destination_lon, origin_cell)
+
+    def to_dict(self):
+        """Returns a json serializable copy of the ride offer"""
+        return serializers.to_dict(self)
+
     def add_new_ride_offer(self, user_id):
         """Adds a new ride offer associated with a specific user"""
         database_conn = Database()
-        columns = ("user_id",
-                   "origin",
-                   "destination",
-                   "price")
-
-        values = (user_id,
-                  self.origin,
-                  self.destination,
-                  self.price)
-
         data_returned = database_conn.insert("rides",
-                                             columns,
-                                             values,
-                                             "ride_id")
+                                             Ride.INSERT_COLUMNS,
+                                             self.insert_values(user_id),
+                                             "ride_id",
+                                             bump=(Ride.version_marker(),))
 
         ride_id = None
-        for row in data_returned:
+        for row in data_returned or []:
             ride_id = row[0]
+            cache.invalidate(Ride.cache_key(ride_id))
 
         self.id = ride_id
+        if ride_id is not None:
+            journeys.planner().add_ride(self)
         return self.id
 
+    @staticmethod
+    def add_new_ride_offers(user_id, rides):
+        """Adds several ride offers of a user with one statement
+        and sets their ids. Returns False if nothing was saved"""
+        database_conn = Database()
+        rows = [ride.insert_values(user_id) for ride in rides]
+        bump = (Ride.version_marker(),)
+
+        data_returned = database_conn.insert_many("rides",
+                                                  Ride.INSERT_COLUMNS,
+                                                  rows,
+                                                  "ride_id",
+                                                  bump=bump)
+        if not data_returned:
+            return False
+
+        planner = journeys.planner()
+        for ride, row in zip(rides, data_returned):
+            ride.id = row[0]
+            cache.invalidate(Ride.cache_key(ride.id))
+            planner.add_ride(ride)
+        return True
+
     @staticmethod
     def get_one_ride(ride_id):
         """Gets only one ride"""
-        database_conn = Database()
-        columns = ("r.*", "u.username")
-        table = "rides r"
-        left_join = "users u on (u.user_id=r.user_id)"
-        where = "r.ride_id = " + str(ride_id)
+        def load():
+            database_conn = Database()
+            where = {"r.ride_id": ride_id}
+            data_returned = database_conn.select(Ride.TABLE,
+                                                 Ride.COLUMNS,
+                                                 Ride.JOIN,
+                                                 where,
+                                                 prepare=True)
+            if data_returned:
+                return tuple(data_returned[0])
+            return None
+
+        row = cache.get(Ride.cache_key(ride_id), load)
+        if row:
+            return Ride.from_row(row)
+        return None
 
-        data_returned = database_conn.select(table,
-                                             columns,
-                                             left_join,
-                                             where)
-        ride = None
-        if len(data_returned) == 0:
-            return ride
-
-        for row in data_returned[0]:
-            row = tuple(row.replace("(", "").replace(")", "").split(","))
-            origin = row[2]
-            destination = row[3]
-            price = row[4]
-            username = row[5].replace("\"", "")
-            ride = Ride(username, origin, destination, price)
-            ride.id = row[0]
+    @staticmethod
+    def version_marker():
+        """Returns the version marker bumped by an insert of rides"""
+        return random.choice(Ride.COLLECTION)
 
-        return ride
+    @staticmethod
+    def cache_key(ride_id):
+        """Key of the cached row of a ride. The prefix changes with
+        Ride.COLUMNS so that a shared cache never returns old rows"""
+        return "ride.v2:" + str(int(ride_id))
 
     @staticmethod
-    def get_all_rides(where=None):
-        """Retrieves all the rides from the database"""
+    def get_all_rides(where=None, after=None, limit=None):
+        """Retrieves the rides from the database ordered by id.
+        Only rides with an id greater than after are returned,
+        at most limit of them"""
         database_conn = Database()
-        columns = ("r.*", "u.username")
-        table = "rides r"
-        left_join = "users u on (u.user_id=r.user_id)"
-        if where:
-            where = 'u.username = \'' + where + '\''
+        where = given({"u.username": where,
+                       "r.ride_id >": after})
+
+        data_returned = database_conn.select(Ride.TABLE,
+                                             Ride.COLUMNS,
+                                             Ride.JOIN,
+                                             where,
+                                             order_by="r.ride_id",
+                                             limit=limit)
+
+        return map_rows(Ride, data_returned)
+
+    # Orderings available to search_rides: the ORDER BY clause and the
+    # where key that continues after the cursor of the previous page
+    SORTS = {
+        'id': ("r.ride_id", "r.ride_id >"),
+        'price': ("r.price, r.ride_id", "(r.price, r.ride_id) >"),
+        '-price': ("r.price DESC, r.ride_id DESC", "(r.price, r.ride_id) <")
+    }
 
-        data_returned = database_conn.select(table,
-                                             columns,
-                                             left_join,
-                                             where)
+    @staticmethod
+    def search_rides(origin=None, destination=None, min_price=None,
+                     max_price=None, sort='id', after=None, limit=None):
+        """
+        Finds the rides whose origin and destination start with the given
+        text, ignoring case, and whose price is within the given range.
+        after is the ride id, or (price, ride id) when sorting by price,
+        of the last ride of the previous page
+        """
+        database_conn = Database()
+        order_by, after_key = Ride.SORTS[sort]
+        where = given({"lower(r.origin) LIKE": like_prefix(origin),
+                       "lower(r.destination) LIKE": like_prefix(destination),
+                       "r.price >=": min_price,
+                       "r.price <=": max_price,
+                       after_key: after})
+
+        data_returned = database_conn.select(Ride.TABLE,
+                                             Ride.COLUMNS,
+                                             Ride.JOIN,
+                                             where,
+                                             order_by=order_by,
+                                             limit=limit)
+
+        return map_rows(Ride, data_returned)
+
+    # Rides whose origin is within a radius of a point, closest first. The
+    # candidates are read from the cells of app.geo covering the circle
+    # and their distance is computed with the haversine formula. Only the
+    # closest ones are joined with the rest of the ride and its driver
+    NEARBY_SQL = """
+        SELECT {columns}, nearby.distance
+        FROM (
+          SELECT ride_id, distance
+          FROM (
+            SELECT r.ride_id, 2 * %(earth_radius)s * asin(least(1, sqrt(
+                     power(sin(radians(r.origin_lat - %(lat)s) / 2), 2) +
+                     cos(radians(%(lat)s)) * cos(radians(r.origin_lat)) *
+                     power(sin(radians(r.origin_lon - %(lon)s) / 2), 2))))
+                   AS distance
+            FROM unnest(%(first_cells)s::integer[],
+                        %(last_cells)s::integer[])
+              AS cells (first_cell, last_cell)
+            JOIN rides r
+              ON r.origin_cell BETWEEN cells.first_cell AND cells.last_cell
+            -- Keeps the planner from moving the distance condition into
+            -- a scan of every ride instead of reading the cells
+            OFFSET 0
+          ) candidates
+          WHERE distance <= %(radius)s
+          ORDER BY distance, ride_id
+          LIMIT %(limit)s
+        ) nearby
+        JOIN rides r ON r.ride_id = nearby.ride_id
+        JOIN users u ON u.user_id = r.user_id
+        ORDER BY nearby.distance, r.ride_id
+        """
 
-        rides = []
-        if len(data_returned) == 0:
-            return rides
+    @staticmethod
+    def nearby_rides(lat, lon, radius_km, limit):
+        """Returns the (ride, distance in km) pairs of the rides starting
+        within radius_km of a point, closest first, at most limit of them"""
+        ranges = geo.cell_ranges(lat, lon, radius_km)
+        params = {"earth_radius": geo.EARTH_RADIUS_KM,
+                  "lat": lat,
+                  "lon": lon,
+                  "first_cells": [first for first, _ in ranges],
+                  "last_cells": [last for _, last in ranges],
+                  "radius": radius_km,
+                  "limit": limit}
+        sql = Ride.NEARBY_SQL.format(columns=", ".join(Ride.COLUMNS))
+        data_returned = Database().execute_sql(sql, params)
+        return [(Ride.from_row(row), row[-1]) for row in data_returned or []]
 
-        for row in data_returned:
-            row = tuple(row[0].replace("(", "").replace(")", "").split(","))
-            origin = row[2]
-            destination = row[3]
-            price = row[4]
-            username = row[5].replace("\"", "")
-            new_ride = Ride(username, origin, destination, price)
-            new_ride.id = row[0]
-            rides.append(new_ride)
+    @staticmethod
+    def stream_rides(where=None, after=None, batch_size=1000):
+        """Yields the rides ordered by id without loading them all at once.
+        Rows are fetched from the database batch_size at a time"""
+        database_conn = Database()
+        where = given({"u.username": where,
+                       "r.ride_id >": after})
 
-        return rides
+        rows = database_conn.stream(Ride.TABLE,
+                                    Ride.COLUMNS,
+                                    Ride.JOIN,
+                                    where,
+                                    order_by="r.ride_id",
+                                    batch_size=batch_size)
+        from_row = Ride.from_row
+        for row in rows:
+            yield from_row(row)
 
 
 class Request:
 
+    __slots__ = ('id', 'name', 'accepted', 'rejected')
+
+    # Columns selected for a request, in the order expected by from_row
+    COLUMNS = ("r.request_id", "u.username", "r.accepted", "r.rejected")
+    TABLE = "riderequests r"
+    JOIN = "users u on (u.user_id=r.passenger_id)"
+
     def __init__(self, name):
         self.id = 0  # Default id value
         self.name = name  # Name of the requester
         self.accepted = False
         self.rejected = False
 
-    def add_ride_request(self, ride_id, passenger_id):
-        """Adds a new request into the database"""
-        database_conn = Database()
-        columns = ("ride_id",
-                   "passenger_id",
-                   "accepted",
-                   "rejected")
-
-        values = (ride_id,
-                  passenger_id,
-                  self.accepted,
-                  self.rejected)
+    @classmethod
+    def from_row(cls, row):
+        """Creates a request from a row with the columns
+        in Request.COLUMNS"""
+        request_id, username, accepted, rejected = row[:4]
+        ride_req = cls(username)
+        ride_req.id = request_id
+        ride_req.accepted = accepted
+        ride_req.rejected = rejected
+        return ride_req
 
-        data_returned = database_conn.insert("riderequests",
-                                             columns,
-                                             values,
-                                             "request_id")
-
-        req_id = None
-        for row in data_returned:
-            req_id = row[0]
+    @staticmethod
+    def collection(ride_id):
+        """Name of the version marker of the requests of a ride"""
+        return "ride_requests:" + str(int(ride_id))
+
+    def to_dict(self):
+        """Returns a json serializable copy of the ride request"""
+        return serializers.to_dict(self)
+
+    # Outcomes of add_ride_request
+    CREATED = 'created'
+    OWN_RIDE = 'own ride'
+    ALREADY_REQUESTED = 'already requested'
+    RIDE_MISSING = 'ride missing'
+    USER_MISSING = 'user missing'
+
+    # Inserts the request unless the ride or the requester is missing, the
+    # ride belongs to the requester or was already requested by them, and
+    # reports which. A new request bumps the version marker of the
+    # requests of the ride (see Request.collection) and is announced to
+    # the listeners of app.notifications
+    ADD_SQL = """
+        WITH ride AS (
+          SELECT ride_id, user_id FROM rides WHERE ride_id = %(ride_id)s
+        ), passenger AS (
+          SELECT user_id FROM users WHERE username = %(username)s
+        ), inserted AS (
+          INSERT INTO riderequests (ride_id, passenger_id,
+                                    accepted, rejected)
+          SELECT ride.ride_id, passenger.user_id,
+                 %(accepted)s, %(rejected)s
+          FROM ride, passenger
+          WHERE ride.user_id <> passenger.user_id
+          ON CONFLICT (ride_id, passenger_id) DO NOTHING
+          RETURNING request_id
+        ), notified AS (
+          SELECT pg_notify('ride_requests', json_build_object(
+            'event', 'created',
+            'ride_id', ride.ride_id,
+            'driver', driver.username,
+            'request', json_build_object(
+              'id', inserted.request_id, 'name', %(username)s::text,
+              'accepted', %(accepted)s, 'rejected', %(rejected)s))::text)
+          FROM inserted, ride JOIN users driver
+            ON driver.user_id = ride.user_id
+        ), bumped AS (
+          INSERT INTO collection_versions (name, version)
+          SELECT 'ride_requests:' || ride.ride_id, 1 FROM inserted, ride
+          ON CONFLICT (name) DO UPDATE
+          SET version = collection_versions.version + 1, updated_at = now()
+        )
+        SELECT (SELECT ride_id FROM ride),
+               EXISTS (SELECT 1 FROM passenger),
+               (SELECT ride.user_id = passenger.user_id
+                FROM ride, passenger),
+               (SELECT request_id FROM inserted),
+               (SELECT count(*) FROM notified)
+        """
+
+    def add_ride_request(self, ride_id):
+        """Adds a new request by this requester into the database.
+        Returns one of the outcomes CREATED, OWN_RIDE,
+        ALREADY_REQUESTED, RIDE_MISSING or USER_MISSING"""
+        database_conn = Database()
+        params = {"ride_id": ride_id,
+                  "username": self.name,
+                  "accepted": self.accepted,
+                  "rejected": self.rejected}
+        data_returned = database_conn.execute_sql(Request.ADD_SQL, params)
+        return self._added(data_returned)
+
+    def _added(self, data_returned):
+        """Returns the outcome of the ADD_SQL statement"""
+        if not data_returned:
+            return None
+
+        found_ride, found_user, own_ride, req_id = data_returned[0][:4]
+        if found_ride is None:
+            return Request.RIDE_MISSING
+        if not found_user:
+            return Request.USER_MISSING
+        if own_ride:
+            return Request.OWN_RIDE
+        if req_id is None:
+            return Request.ALREADY_REQUESTED
 
         self.id = req_id
-        return self.id
+        return Request.CREATED
 
     @staticmethod
     def get_one_ride_request(request_id):
         """Returns a particular ride request
         and the ride id on which the request was made"""
         database_conn = Database()
-        columns = ("r.*", "u.username")
-        table = "riderequests r"
-        left_join = "users u on (u.user_id=r.passenger_id)"
-        where = 'r.request_id = ' + str(request_id)
+        columns = Request.COLUMNS + ("r.ride_id",)
+        where = {"r.request_id": request_id}
 
-        data_returned = database_conn.select(table,
+        data_returned = database_conn.select(Request.TABLE,
                                              columns,
-                                             left_join,
+                                             Request.JOIN,
                                              where)
 
-        request = None
-        ride_id = None
-        if len(data_returned) == 0:
-            return request, ride_id
-
-        for row in data_returned[0]:
-            row = tuple(row.replace("(", "").replace(")", "").split(","))
-            ride_id = row[1]
-            requester_name = row[5].replace("\"", "")
-            request = Request(requester_name)
-            request.id = row[0]
+        if not data_returned:
+            return None, None
 
-        return request, ride_id
+        row = data_returned[0]
+        return Request.from_row(row), row[4]
 
     @staticmethod
-    def get_ride_requests(ride_id):
-        """Gets all the ride requests for a particular ride offer"""
-        columns = ("r.*",
-                   "u.username")
-
-        table = "riderequests r"
-        left_join = "users u on r.passenger_id = u.user_id"
-        where = "r.ride_id = " + str(ride_id)
+    def get_ride_requests(ride_id, after=None, limit=None):
+        """Gets the ride requests for a particular ride offer ordered by id.
+        Only requests with an id greater than after are returned,
+        at most limit of them"""
+        where = {"r.ride_id": ride_id}
+        if after is not None:
+            where["r.request_id >"] = after
         database_conn = Database()
-        data_returned = database_conn.select(table,
-                                             columns,
-                                             left_join,
-                                             where)
-
-        ride_requests = []
-        if len(data_returned) == 0:
-            return ride_requests
-
-        for row in data_returned:
-            row = tuple(row[0].replace("(", "").replace(")", "").split(","))
-            rq_name = row[5].replace("\"", "")
-            ride_req = Request(rq_name)
-            ride_req.id = row[0]
-            ride_req.accepted = row[3]
-            ride_req.rejected = row[4]
-            ride_requests.append(ride_req)
-
-        return ride_requests
+        data_returned = database_conn.select(Request.TABLE,
+                                             Request.COLUMNS,
+                                             Request.JOIN,
+                                             where,
+                                             order_by="r.request_id",
+                                             limit=limit)
+
+        return map_rows(Request, data_returned)
+
+    # Records the decisions on requests of one ride and logs the accepted
+    # rides of the passengers and the driver, all in one statement. Each
+    # decision that changes a request is announced to the listeners of
+    # app.notifications; requests already in the decided state are
+    # returned unchanged, so deciding twice logs and notifies once
+    DECIDE_SQL = """
+        WITH input AS (
+          SELECT * FROM unnest(%(request_ids)s::integer[],
+                               %(accepted)s::boolean[])
+            AS i (request_id, accepted)
+        ), decided AS (
+          UPDATE riderequests r
+          SET accepted = input.accepted, rejected = NOT input.accepted
+          FROM input
+          WHERE r.request_id = input.request_id AND r.ride_id = %(ride_id)s
+            AND (r.accepted, r.rejected) IS DISTINCT FROM
+                (input.accepted, NOT input.accepted)
+          RETURNING r.request_id, r.ride_id, r.passenger_id,
+                    r.accepted, r.rejected
+        ), unchanged AS (
+          SELECT r.request_id, r.passenger_id, r.accepted, r.rejected
+          FROM riderequests r JOIN input ON input.request_id = r.request_id
+          WHERE r.ride_id = %(ride_id)s
+            AND (r.accepted, r.rejected) IS NOT DISTINCT FROM
+                (input.accepted, NOT input.accepted)
+        ), counted AS (
+          INSERT INTO ride_counter_log (user_id, rides_taken, rides_given)
+          SELECT passenger_id, count(*), 0 FROM decided
+          WHERE accepted GROUP BY passenger_id
+          UNION ALL
+          SELECT rides.user_id, 0, count(*) FROM decided
+          JOIN rides ON rides.ride_id = decided.ride_id
+          WHERE decided.accepted GROUP BY rides.user_id
+        )
+        SELECT d.request_id, u.username, d.accepted, d.rejected, TRUE,
+               pg_notify('ride_requests', json_build_object(
+                 'event', CASE WHEN d.accepted THEN 'accepted'
+                               ELSE 'rejected' END,
+                 'ride_id', d.ride_id,
+                 'driver', driver.username,
+                 'request', json_build_object(
+                   'id', d.request_id, 'name', u.username,
+                   'accepted', d.accepted, 'rejected', d.rejected))::text)
+        FROM decided d JOIN users u ON u.user_id = d.passenger_id
+        JOIN rides ON rides.ride_id = d.ride_id
+        JOIN users driver ON driver.user_id = rides.user_id
+        UNION ALL
+        SELECT r.request_id, u.username, r.accepted, r.rejected, FALSE,
+               NULL
+        FROM unchanged r JOIN users u ON u.user_id = r.passenger_id
+        """
 
     @staticmethod
-    def user_requested(ride_id, username):
-        """Determines if a user has already requested a ride"""
-        columns = ("r.*",
-                   "u.username")
-
-        table = "riderequests r"
-        left_join = "users u on r.passenger_id = u.user_id"
-        where = "r.ride_id = " + str(ride_id) + \
-                " and u.username = \'" + username + "\'"
-
+    def accept_reject_ride_requests(ride_id, decisions):
+        """
+        Accepts/rejects several requests of a ride offer in one transaction.
+        decisions is a list of (request_id, decision) pairs with distinct
+        request ids. Returns a dictionary of request id to updated request
+        for the requests that exist, None if the statement failed
+        """
         database_conn = Database()
-        data_returned = database_conn.select(table,
-                                             columns,
-                                             left_join,
-                                             where)
-
-        if data_returned:
-            return True
-        return False
+        params = {"request_ids": [int(req_id) for req_id, _ in decisions],
+                  "accepted": [decision == 'accept'
+                               for _, decision in decisions],
+                  "ride_id": ride_id}
+        data_returned = database_conn.execute_sql(
+            Request.DECIDE_SQL, params, bump=(Request.collection(ride_id),))
+        if data_returned is None:
+            return None
+
+        # Each newly accepted request counts a ride for the passenger and
+        # the driver
+        accepted = sum(1 for row in data_returned if row[2] and row[4])
+        if accepted and counters.logged(2 * accepted):
+            User.flush_ride_counters()
+
+        return dict((req.id, req)
+                    for req in map_rows(Request, data_returned))
 
     @staticmethod
-    def accept_reject_ride_request(decision, request_id):
-        """Method to accept/reject a ride request"""
-        database_conn = Database()
-        if decision == 'accept':
-            accepted = True
-            rejected = False
-        else:
-            accepted = False
-            rejected = True
-
-        sett = "accepted = " + str(accepted)
-        where = "riderequests.request_id = " + str(request_id)
-        sett = sett + ", rejected = " + str(rejected)
-        return_val = database_conn.update("riderequests",
-                                          sett,
-                                          where)
-
-        #  True means statement has been successfully executed
-        if return_val:
-            return True
-        return False
+    def accept_reject_ride_request(decision, request_id, ride_id):
+        """Method to accept/reject a ride request of a ride offer.
+        Returns the updated request, None if it does not exist"""
+        decided = Request.accept_reject_ride_requests(
+            ride_id, [(request_id, decision)])
+        if decided:
+            return decided.get(int(request_id))
+        return None
+
+
+serializers.register(User, private=('user_id', 'password_hash', 'email'))
+serializers.register(Request)
+serializers.register(Ride, nested={'requests': Request})
@@ -0,0 +1,161 @@
+"""
+This file contains the live notifications of ride requests. The
+statements adding and deciding ride requests send a NOTIFY on the
+ride_requests channel (see Request.ADD_SQL and Request.DECIDE_SQL) when
+their transaction commits.
+
+Each process has one listener thread per database, started by the first
+subscription. It keeps its own connection LISTENing on the channel and
+hands every notification to the subscriptions of the driver and of the
+passenger concerned, so the number of clients waiting for notifications
+does not change the number of database connections.
+"""
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from app.database_pool import connection_params
+
+CHANNEL = 'ride_requests'
+
+logger = logging.getLogger('app.notifications')
+
+
+class ListenerUnavailable(Exception):
+    """Raised when the listener could not start listening in time"""
+
+
+class Subscription:
+    """The notifications waiting to be sent to one client"""
+
+    def __init__(self, username, size):
+        self.username = username
+        self.events = queue.Queue(size)
+        # Set when notifications were dropped, because the client did not
+        # read them fast enough or the listener had to reconnect
+        self.lost = False
+
+    def put(self, event):
+        """Queues an (event name, json data) notification"""
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.lost = True
+
+    def get(self, timeout):
+        """Returns the next notification, None if none came in time"""
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Listener:
+    """A thread listening to the notifications of one database"""
+
+    def __init__(self, params, check_interval=60.0, retry_delay=1.0):
+        self.params = params
+        self.check_interval = check_interval
+        self.retry_delay = retry_delay
+        self.pid = os.getpid()
+        self._subscriptions = {}  # username -> set of subscriptions
+        self._lock = threading.Lock()
+        self._listening = threading.Event()
+        thread = threading.Thread(target=self._run, name="notifications",
+                                  daemon=True)
+        thread.start()
+
+    def subscribe(self, username, size=100, timeout=5.0):
+        """Returns a new subscription to the notifications of username.
+        Every notification sent after this returns is delivered"""
+        subscription = Subscription(username, size)
+        with self._lock:
+            self._subscriptions.setdefault(username, set()).add(subscription)
+        if not self._listening.wait(timeout):
+            self.unsubscribe(subscription)
+            raise ListenerUnavailable("not listening after {}s"
+                                      .format(timeout))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.username)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.username]
+
+    def dispatch(self, payload):
+        """Hands a notification to the subscriptions of its driver
+        and passenger"""
+        try:
+            event = json.loads(payload)
+            usernames = set((event['driver'], event['request']['name']))
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignored notification: %s", payload)
+            return
+        with self._lock:
+            targets = [subscription for username in usernames
+                       for subscription
+                       in self._subscriptions.get(username, ())]
+        for subscription in targets:
+            subscription.put((event['event'], payload))
+
+    def _connection_lost(self):
+        self._listening.clear()
+        with self._lock:
+            for subscriptions in self._subscriptions.values():
+                for subscription in subscriptions:
+                    subscription.lost = True
+
+    def _listen(self):
+        conn = psycopg2.connect(**self.params)
+        try:
+            conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            cur.execute("LISTEN " + CHANNEL)
+            self._listening.set()
+            while True:
+                if select.select([conn], [], [], self.check_interval)[0]:
+                    conn.poll()
+                else:
+                    # Nothing was received for a while, check that the
+                    # connection still works
+                    cur.execute("SELECT 1")
+                while conn.notifies:
+                    self.dispatch(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except (psycopg2.Error, OSError) as error:
+                logger.error("Listening to %s failed: %s", CHANNEL, error)
+            self._connection_lost()
+            time.sleep(self.retry_delay)
+
+
+_listeners = {}  # connection parameters -> listener
+_listeners_lock = threading.Lock()
+
+
+def get_listener():
+    """Returns the listener of this process for the database of the
+    application, starting it when needed"""
+    params = connection_params()
+    key = tuple(sorted(params.items()))
+    with _listeners_lock:
+        listener = _listeners.get(key)
+        if listener is None or listener.pid != os.getpid():
+            # The thread of an inherited listener does not exist after fork
+            listener = _listeners[key] = Listener(params)
+        return listener
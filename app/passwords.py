@@ -0,0 +1,118 @@
+"""
+This file contains the password hashing used for signing up and logging in.
+Hashing is deliberately slow, so it runs on a small pool of worker
+processes instead of the process serving the request. The hashing scheme
+and its cost are set in config.py; hashes made with older settings are
+replaced the next time their owner logs in, unless the new hash would be
+cheaper to guess than the old one.
+"""
+import atexit
+import os
+import threading
+from flask import current_app
+
+# Rounds of each scheme costing about as much to guess, used to compare
+# the cost of hashes made with different schemes. The crypt schemes are at
+# the passlib defaults the baseline hashed with, pbkdf2_sha256 at the
+# OWASP recommendation
+EQUIVALENT_ROUNDS = {
+    'pbkdf2_sha256': 600000,
+    'sha512_crypt': 656000,
+    'sha256_crypt': 535000
+}
+
+_contexts = {}
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def current_settings():
+    """Returns the hashing settings from the app configuration"""
+    return (tuple(current_app.config['PASSWORD_SCHEMES']),
+            current_app.config['PASSWORD_ROUNDS'])
+
+
+def _context(settings):
+    """Returns the passlib context for the settings, built once per process"""
+    context = _contexts.get(settings)
+    if context is None:
+        from passlib.context import CryptContext
+        schemes, rounds = settings
+        options = {
+            schemes[0] + '__default_rounds': rounds,
+            schemes[0] + '__min_rounds': rounds
+        }
+        context = CryptContext(schemes=list(schemes),
+                               default=schemes[0],
+                               deprecated='auto',
+                               **options)
+        _contexts[settings] = context
+    return context
+
+
+def _hash(settings, password):
+    return _context(settings).hash(password)
+
+
+def hash_cost(context, password_hash):
+    """Returns the cost of guessing a hash relative to EQUIVALENT_ROUNDS,
+    None for a scheme whose cost is not known"""
+    handler = context.identify(password_hash, resolve=True)
+    if handler.name not in EQUIVALENT_ROUNDS:
+        return None
+    rounds = handler.from_string(password_hash).rounds
+    return rounds / EQUIVALENT_ROUNDS[handler.name]
+
+
+def _verify_and_update(settings, password, password_hash):
+    context = _context(settings)
+    valid, new_hash = context.verify_and_update(password, password_hash)
+    if new_hash is not None:
+        old_cost = hash_cost(context, password_hash)
+        new_cost = hash_cost(context, new_hash)
+        if old_cost is None or new_cost is None or new_cost < old_cost:
+            # The stored hash is kept rather than replaced by a weaker one
+            new_hash = None
+    return valid, new_hash
+
+
+def _get_executor():
+    """Returns the process pool of this process, None if hashing
+    should happen in the current process"""
+    global _executor, _executor_pid
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+    if workers <= 0:
+        return None
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            # A pool inherited through fork can not be used by the child
+            # Imported on first use, multiprocessing is slow to import
+            from concurrent.futures import ProcessPoolExecutor
+            _executor = ProcessPoolExecutor(max_workers=workers)
+            atexit.register(_executor.shutdown)
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _run(function, *args):
+    executor = _get_executor()
+    if executor is None:
+        return function(*args)
+    future = executor.submit(function, *args)
+    return future.result(timeout=current_app.config['PASSWORD_HASH_TIMEOUT'])
+
+
+def hash_password(password):
+    """Returns the hash of password using the configured scheme"""
+    return _run(_hash, current_settings(), password)
+
+
+def verify_password(password, password_hash):
+    """
+    Checks a password against its hash.
+    Returns whether it matches and, when the hash was made with outdated
+    settings, a new hash that should be stored in its place (else None)
+    """
+    return _run(_verify_and_update, current_settings(),
+                password, password_hash)
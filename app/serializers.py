@@ -0,0 +1,108 @@
+"""
+This file contains the JSON serialisation of the API responses.
+
+Each model registers the fields it shows in its __slots__ order once, and
+gets a converter reading exactly those fields with one attrgetter.
+Converting an object reads its attributes into a new dictionary; the
+object itself is never copied or modified.
+
+The JSON encoder is chosen when the application is created, with
+JSON_BACKEND: 'orjson' or 'ujson' (when installed), 'json' for the
+standard library, or 'auto' to use the fastest one available. Model
+objects can be put directly in the payloads given to dumps and
+json_response.
+"""
+import json
+import operator
+from flask import current_app, Response
+
+_converters = {}  # model class -> converter
+
+
+def fields_of(model, private=()):
+    """Returns the public fields of a model in the order of its __slots__"""
+    return tuple(name for name in model.__slots__ if name not in private)
+
+
+def register(model, nested=None, private=()):
+    """
+    Builds and registers the converter of a model. nested maps the
+    fields holding lists of other (registered) models to their class.
+    Fields listed in private are left out.
+    """
+    names = fields_of(model, private)
+    # Appending a field that always exists makes attrgetter return a
+    # tuple whatever the number of fields
+    values = operator.attrgetter(*(names + ('__class__',)))
+    nested_fields = tuple((name, _converters[nested[name]])
+                          for name in names if name in (nested or {}))
+
+    def convert(obj):
+        data = dict(zip(names, values(obj)))
+        for name, converter in nested_fields:
+            data[name] = [converter(item) for item in data[name]]
+        return data
+
+    _converters[model] = convert
+    return convert
+
+
+def to_dict(obj):
+    """Returns the json serializable form of a registered model object"""
+    return _converters[type(obj)](obj)
+
+
+def _default(obj):
+    """Hook the encoders call for values they can not encode"""
+    converter = _converters.get(type(obj))
+    if converter is None:
+        raise TypeError('{} is not JSON serializable'
+                        .format(type(obj).__name__))
+    return converter(obj)
+
+
+def _json_dumps(value):
+    return json.dumps(value, default=_default,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def load_backend(name):
+    """Returns the name and the dumps function of a JSON backend.
+    The function encodes a value to bytes"""
+    if name in ('auto', 'orjson'):
+        try:
+            import orjson
+            return 'orjson', lambda value: orjson.dumps(value,
+                                                        default=_default)
+        except ImportError:
+            if name == 'orjson':
+                raise
+    if name in ('auto', 'ujson'):
+        try:
+            import ujson
+            # Older ujson releases have no default hook for the models
+            ujson.dumps(None, default=_default)
+            return 'ujson', lambda value: ujson.dumps(
+                value, default=_default, ensure_ascii=False).encode('utf-8')
+        except (ImportError, TypeError):
+            if name == 'ujson':
+                raise
+    if name not in ('auto', 'json'):
+        raise ValueError('Unknown JSON backend: ' + str(name))
+    return 'json', _json_dumps
+
+
+def init_app(app):
+    """Chooses the JSON backend of the application"""
+    app.extensions['json_backend'] = load_backend(app.config['JSON_BACKEND'])
+
+
+def dumps(value):
+    """Encodes value to json bytes with the backend of the application"""
+    return current_app.extensions['json_backend'][1](value)
+
+
+def json_response(payload, status=200):
+    """Returns a response whose body is payload encoded as json"""
+    return Response(dumps(payload), status=status,
+                    mimetype='application/json')
@@ -0,0 +1,57 @@
+"""
+This file contains a small cache for decoded access tokens.
+Clients send the same token with every request, so remembering the
+username a token decodes to saves verifying its signature each time.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenCache:
+    """A bounded least recently used cache of valid tokens.
+    Entries are dropped when the token they belong to expires"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (username, expiry time)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the username of a cached, unexpired token or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, username, expires):
+        """Caches the username of a token that is valid until expires
+        (seconds since the epoch)"""
+        if self.maxsize <= 0 or expires <= time.time():
+            return
+        with self._lock:
+            self._entries[key] = (username, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns the hit and miss counters and the current size"""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._entries)}
@@ -36,9 +36,70 @@ class Validate:
         try:
             int(value)
             return True
-        except ValueError:
+        except (TypeError, ValueError):
             return False
 
+    @staticmethod
+    def validate_ride_offer(data):
+        """Checks that a ride offer has a text origin and destination
+        and an integer price if one is given"""
+        if not isinstance(data, dict) or \
+                'origin' not in data or \
+                'destination' not in data:
+            return [False,
+                    'Make sure you have specified origin '
+                    'and destination attributes']
+        if not isinstance(data['origin'], str) or \
+                not isinstance(data['destination'], str):
+            return [False, 'Make sure the origin and destination are text']
+        if not Validate.validate_int(data.get('price', 0)):
+            return [False, 'Make sure the price is an integer']
+        return Validate.validate_ride_coordinates(data)
+
+    @staticmethod
+    def validate_coordinates(lat, lon):
+        """Checks that a latitude and a longitude are numbers
+        within their ranges"""
+        try:
+            lat = float(lat)
+            lon = float(lon)
+        except (TypeError, ValueError):
+            return [False,
+                    'Make sure the latitude and longitude are numbers']
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return [False,
+                    'Make sure the latitude is between -90 and 90 '
+                    'and the longitude between -180 and 180']
+        return [True]
+
+    @staticmethod
+    def validate_ride_coordinates(data):
+        """Checks the optional coordinates of the origin and the
+        destination of a ride offer, given as *_lat and *_lon pairs"""
+        for place in ('origin', 'destination'):
+            lat = data.get(place + '_lat')
+            lon = data.get(place + '_lon')
+            if lat is None and lon is None:
+                continue
+            val = Validate.validate_coordinates(lat, lon)
+            if not val[0]:
+                return [False, 'Invalid {} coordinates. {}'
+                        .format(place, val[1])]
+        return [True]
+
+    @staticmethod
+    def validate_decision(data):
+        """Checks that a ride request decision has an integer
+        request id and a decision that is accept or reject"""
+        if not isinstance(data, dict) or \
+                not Validate.validate_int(data.get('request_id')):
+            return [False, 'Make sure the request id is an integer']
+        if data.get('decision') not in ('accept', 'reject'):
+            return [False,
+                    'Specify your decision by setting the '
+                    'decision key to accept or reject']
+        return [True]
+
     @staticmethod
     def validate_date(date):
         """Checks if date is in correct format"""
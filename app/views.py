@@ -1,22 +1,18 @@
-from app import app
 from app.models import User, Ride, Request
-from flask import request, abort, jsonify, make_response
+from flask import Blueprint, request, abort, jsonify, make_response
 from app.helper_functions import sign_up_user, \
-    login_user, return_requests, accept_or_reject
+    login_user, return_requests, accept_or_reject, \
+    wants_stream, stream_rides, conditional_listing, list_rides, \
+    create_ride_offers, accept_or_reject_batch, search_rides, \
+    request_events, nearby_rides, set_coordinates, plan_journey
 from app.validators import Validate
+from app.database_pool import PoolTimeout
+from app.serializers import json_response
 
+api = Blueprint('api', __name__)
 
-def convert_ride_offer(ride_offer):
-    """Converts ride offer to json serializable object
-    by first converting requests to dict object"""
-    ride_requests_list = [ride_req.__dict__
-                          for ride_req in ride_offer.requests]
-    ride_offer_dict = ride_offer.__dict__
-    ride_offer_dict["requests"] = ride_requests_list
-    return ride_offer_dict
 
-
-@app.route('/ridemyway/api/v1/auth/signup', methods=['POST'])
+@api.route('/ridemyway/api/v1/auth/signup', methods=['POST'])
 def signup():
     if not request.is_json:
         abort(400, 'Make sure your request contains json data')
@@ -47,7 +43,7 @@ def signup():
     return sign_up_user(username, password, email)
 
 
-@app.route('/ridemyway/api/v1/auth/login', methods=['POST'])
+@api.route('/ridemyway/api/v1/auth/login', methods=['POST'])
 def login():
     """Login an existing user"""
     if not request.is_json:
@@ -72,7 +68,7 @@ def login():
     return login_user(username, password)
 
 
-@app.route('/ridemyway/api/v1/user/<username>',
+@api.route('/ridemyway/api/v1/user/<username>',
            methods=['GET'])
 def user_details(username):
     """Get the details of a specific user"""
@@ -81,7 +77,7 @@ def user_details(username):
         abort(401, 'Please provide an access token')
 
     verify_token(access_token)
-    user = User.get_user(username)
+    user = User.get_user_totals(username)
     if not user:
         response = {
             'error': 'Not found',
@@ -97,35 +93,71 @@ def user_details(username):
     return make_response(jsonify(response)), 200
 
 
-@app.route('/ridemyway/api/v1/rides', methods=['GET'])
+@api.route('/ridemyway/api/v1/rides', methods=['GET'])
 def get_rides():
     """API endpoint for getting all the ride offers"""
 
     access_token = request.headers.get('Authorization')
     if access_token:
         verify_token(access_token)
-        ride_offers = Ride.get_all_rides()
-        rides_as_dicts = [convert_ride_offer(ride) for ride in ride_offers]
-        return jsonify({'rides': rides_as_dicts}), 200
+        if wants_stream():
+            return stream_rides()
+        return conditional_listing(Ride.COLLECTION, None, list_rides)
     else:
         abort(401, 'Please provide an access token')
 
 
-@app.route('/ridemyway/api/v1/user/rides', methods=['GET'])
+@api.route('/ridemyway/api/v1/user/rides', methods=['GET'])
 def get_my_rides():
     """API endpoint for getting a particular users rides"""
     access_token = request.headers.get('Authorization')
     if access_token:
         username = verify_token(access_token)
+        if wants_stream():
+            return stream_rides(username)
+        return conditional_listing(Ride.COLLECTION, username,
+                                   lambda: list_rides(username))
+    else:
+        abort(401, 'Please provide an access token')
+
+
+@api.route('/ridemyway/api/v1/rides/search', methods=['GET'])
+def search():
+    """API endpoint for searching ride offers by origin, destination
+    and price"""
+    access_token = request.headers.get('Authorization')
+    if access_token:
+        verify_token(access_token)
+        return search_rides()
+    else:
+        abort(401, 'Please provide an access token')
+
+
+@api.route('/ridemyway/api/v1/rides/nearby', methods=['GET'])
+def nearby():
+    """API endpoint for the ride offers starting near a point,
+    closest first"""
+    access_token = request.headers.get('Authorization')
+    if access_token:
+        verify_token(access_token)
+        return nearby_rides()
+    else:
+        abort(401, 'Please provide an access token')
 
-        ride_offers = Ride.get_all_rides(username)
-        rides_as_dicts = [convert_ride_offer(ride) for ride in ride_offers]
-        return jsonify({'rides': rides_as_dicts}), 200
+
+@api.route('/ridemyway/api/v1/journeys', methods=['GET'])
+def journeys():
+    """API endpoint for the best journey, over one or more ride offers,
+    from an origin to a destination"""
+    access_token = request.headers.get('Authorization')
+    if access_token:
+        verify_token(access_token)
+        return plan_journey()
     else:
         abort(401, 'Please provide an access token')
 
 
-@app.route('/ridemyway/api/v1/rides/<ride_id>')
+@api.route('/ridemyway/api/v1/rides/<ride_id>')
 def get_ride(ride_id):
     """API endpoint to retrieve a single ride"""
     try:
@@ -141,14 +173,14 @@ def get_ride(ride_id):
         verify_token(access_token)
         ride = Ride.get_one_ride(ride_id)
         if ride:
-            return jsonify({'ride': convert_ride_offer(ride)}), 200
+            return json_response({'ride': ride})
         else:
             abort(400, 'Ride does not exist.')
     else:
         abort(401, 'Please provide an access token')
 
 
-@app.route('/ridemyway/api/v1/users/rides', methods=['POST'])
+@api.route('/ridemyway/api/v1/users/rides', methods=['POST'])
 def create_ride():
     """Endpoint for creating a new ride offer"""
     if not request.is_json:
@@ -167,27 +199,46 @@ def create_ride():
             abort(400,
                   'Make sure you have specified name, '
                   'origin and destination attributes in your json request.')
+        val = Validate.validate_ride_offer(data)
+        if not val[0]:
+            abort(400, val[1])
 
         ride_offer = Ride(username,
                           data['origin'],
                           data['destination'],
-                          data.get('price', 0))
+                          int(data.get('price', 0)))
+        set_coordinates(ride_offer, data)
 
-        print(username)
         user = User.get_user(username)
+        if not user:
+            abort(401, 'User account does not exist')
         ride_id = ride_offer.add_new_ride_offer(user.user_id)
         response = {
             'message': 'Ride created successfully',
             'ride_id': ride_id,
-            'ride': convert_ride_offer(ride_offer)
+            'ride': ride_offer
         }
 
-        return make_response(jsonify(response)), 201
+        return json_response(response, 201)
     else:
         abort(401, 'Please provide an access token')
 
 
-@app.route('/ridemyway/api/v1/rides/<ride_id>/requests', methods=['POST'])
+@api.route('/ridemyway/api/v1/users/rides/batch', methods=['POST'])
+def create_rides():
+    """Endpoint for creating several ride offers at once"""
+    if not request.is_json:
+        abort(400, 'Make sure your request contains json data')
+
+    access_token = request.headers.get('Authorization')
+    if access_token:
+        username = verify_token(access_token)
+        return create_ride_offers(username, request.get_json())
+    else:
+        abort(401, 'Please provide an access token')
+
+
+@api.route('/ridemyway/api/v1/rides/<ride_id>/requests', methods=['POST'])
 def create_ride_request(ride_id):
     if not Validate.validate_int(ride_id):
         abort(400, 'Make sure the ride id is an integer')
@@ -195,29 +246,31 @@ def create_ride_request(ride_id):
     access_token = request.headers.get('Authorization')
     if access_token:
         username = verify_token(access_token)
-        requester = User.get_user(username)
-        ride = Ride.get_one_ride(ride_id)
-        offerer = ride.name
+        ride_req = Request(username)
+        outcome = ride_req.add_ride_request(ride_id)
 
-        if offerer == username:
+        if outcome == Request.RIDE_MISSING:
+            abort(400, 'Ride does not exist.')
+        if outcome == Request.USER_MISSING:
+            abort(401, 'User account does not exist')
+        if outcome == Request.OWN_RIDE:
             abort(401, "You can't request a ride that you created")
-
-        if Request.user_requested(ride_id, username):
+        if outcome == Request.ALREADY_REQUESTED:
             abort(401, "You already requested this ride")
+        if outcome != Request.CREATED:
+            abort(500, 'Failed to create the ride request')
 
-        ride_req = Request(username)
-        req_id = ride_req.add_ride_request(ride_id, requester.user_id)
         response = {
             'message': 'Ride request created successfully',
-            'request_id': req_id,
-            'ride_request': ride_req.__dict__
+            'request_id': ride_req.id,
+            'ride_request': ride_req
         }
-        return make_response(jsonify(response)), 201
+        return json_response(response, 201)
     else:
         abort(401, 'Please provide an access token')
 
 
-@app.route('/ridemyway/api/v1/users/rides/<ride_id>/requests', methods=['GET'])
+@api.route('/ridemyway/api/v1/users/rides/<ride_id>/requests', methods=['GET'])
 def view_ride_requests(ride_id):
     if not Validate.validate_int(ride_id):
         abort(400, 'Make sure the ride id is an integer')
@@ -234,7 +287,7 @@ def view_ride_requests(ride_id):
         abort(401, 'Please provide an access token')
 
 
-@app.route('/ridemyway/api/v1/users/rides/<ride_id>/requests/<request_id>',
+@api.route('/ridemyway/api/v1/users/rides/<ride_id>/requests/<request_id>',
            methods=['PUT'])
 def accept_reject_request(ride_id, request_id):
     if not Validate.validate_int(ride_id) or \
@@ -252,7 +305,7 @@ def accept_reject_request(ride_id, request_id):
                 abort(400, 'Make sure your request contains json data')
 
             data = request.get_json()
-            return accept_or_reject(request_id, data)
+            return accept_or_reject(ride_id, request_id, data)
         else:
             abort(401,
                   'You are not authorized to respond to this '
@@ -262,6 +315,49 @@ def accept_reject_request(ride_id, request_id):
         abort(401, 'Please provide an access token')
 
 
+@api.route('/ridemyway/api/v1/users/rides/<ride_id>/requests/batch',
+           methods=['PUT'])
+def accept_reject_requests(ride_id):
+    """Endpoint for accepting/rejecting several ride requests at once"""
+    if not Validate.validate_int(ride_id):
+        abort(400, 'Make sure the ride id is an integer')
+
+    access_token = request.headers.get('Authorization')
+    if access_token:
+        username = verify_token(access_token)
+        ride = Ride.get_one_ride(ride_id)
+        if not ride:
+            abort(400, 'Ride does not exist.')
+
+        #  Check if this user is the one that created the ride offer
+        if ride.name == username:
+            if not request.is_json:
+                abort(400, 'Make sure your request contains json data')
+
+            return accept_or_reject_batch(int(ride_id), request.get_json())
+        else:
+            abort(401,
+                  'You are not authorized to respond to these '
+                  'ride requests because you did not create this ride offer.')
+
+    else:
+        abort(401, 'Please provide an access token')
+
+
+@api.route('/ridemyway/api/v1/users/requests/events', methods=['GET'])
+def ride_request_events():
+    """Streams the ride requests made and decided on rides of the user,
+    and the decisions on the requests of the user, as server-sent events"""
+    # Browsers can not set headers on EventSource connections
+    access_token = request.headers.get('Authorization') or \
+        request.args.get('access_token')
+    if access_token:
+        username = verify_token(access_token)
+        return request_events(username)
+    else:
+        abort(401, 'Please provide an access token')
+
+
 def verify_token(access_token):
     """Determine if the access token is correct"""
     username = User.decode_token(access_token)
@@ -273,31 +369,44 @@ def verify_token(access_token):
     return username
 
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(error):
     return make_response(jsonify({"error": 'Resource Not Found',
                                   "message": error.description}), 404)
 
 
-@app.errorhandler(400)
+@api.app_errorhandler(400)
 def bad_request(error):
     return make_response(jsonify({"error": 'Bad request.',
                                   'message': error.description}), 400)
 
 
-@app.errorhandler(409)
+@api.app_errorhandler(409)
 def conflict(error):
     return make_response(jsonify({"error": 'Conflict.',
                                   'message': error.description}), 409)
 
 
-@app.errorhandler(401)
+@api.app_errorhandler(401)
 def unauthorized(error):
     return make_response(jsonify({"error": 'Unauthorized access.',
                                   'message': error.description}), 401)
 
 
-@app.errorhandler(405)
+@api.app_errorhandler(503)
+def service_unavailable(error):
+    return make_response(jsonify({"error": 'Service unavailable.',
+                                  'message': error.description}), 503)
+
+
+@api.app_errorhandler(PoolTimeout)
+def database_busy(error):
+    return make_response(jsonify({"error": 'Service unavailable.',
+                                  'message': 'The database is busy, '
+                                             'try again later'}), 503)
+
+
+@api.app_errorhandler(405)
 def method_not_allowed(error):
     message = "{} Check the documentation for allowed methods".\
         format(error.description)
@@ -0,0 +1,398 @@
+"""
+This file benchmarks every endpoint of the API through the Flask test
+client. The testing database is emptied and seeded with the requested
+numbers of users, rides and ride requests, then each scenario is run a
+number of times. For every scenario the latency percentiles, the
+throughput and the number of SQL statements per request are reported.
+
+Run the benchmark with:
+    python -m benchmarks.api_benchmark [--output results.json]
+
+Compare two saved runs, for example from two commits, with:
+    python -m benchmarks.api_benchmark --compare before.json after.json
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from app import create_app, passwords
+from app.database_helper import Database
+from app.database_pool import add_statement_listener, \
+    remove_statement_listener
+from app.database_setup import migrate
+from app.models import Ride, Request, cache, token_cache
+
+API = '/ridemyway/api/v1'
+PASSWORD = 'benchmark'
+PLACES = ('Kampala', 'Entebbe', 'Jinja', 'Mbarara', 'Gulu', 'Masaka',
+          'Mbale', 'Lira', 'Fort Portal', 'Kabale', 'Arua', 'Soroti')
+# Latitude and longitude of the places, around which the seeded rides start
+POINTS = {
+    'Kampala': (0.3476, 32.5825), 'Entebbe': (0.0512, 32.4637),
+    'Jinja': (0.4479, 33.2026), 'Mbarara': (-0.6072, 30.6545),
+    'Gulu': (2.7724, 32.2881), 'Masaka': (-0.3338, 31.7341),
+    'Mbale': (1.0827, 34.1753), 'Lira': (2.2499, 32.8999),
+    'Fort Portal': (0.6710, 30.2750), 'Kabale': (-1.2486, 29.9899),
+    'Arua': (3.0303, 30.9073), 'Soroti': (1.7146, 33.6111)
+}
+
+
+class StatementCounter:
+    """Statement listener counting the SQL statements executed"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, sql, duration, rowcount):
+        self.count += 1
+
+
+def percentile(sorted_values, percent):
+    """Returns the nearest-rank percentile of a sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def reset_database():
+    """Empties the testing database and applies the migrations"""
+    Database().execute_sql("DROP SCHEMA public CASCADE; "
+                           "CREATE SCHEMA public", fetch=False)
+    migrate()
+    cache.clear()
+    token_cache.clear()
+
+
+def near(place, rng):
+    """Returns a point within about 5 km of a place"""
+    lat, lon = POINTS[place]
+    return lat + rng.uniform(-0.05, 0.05), lon + rng.uniform(-0.05, 0.05)
+
+
+def ride_row(user_id, origin, destination, price, rng):
+    """Returns the values of Ride.INSERT_COLUMNS of a ride between two
+    places, with coordinates"""
+    ride = Ride(None, origin, destination, price)
+    ride.origin_lat, ride.origin_lon = near(origin, rng)
+    ride.destination_lat, ride.destination_lon = near(destination, rng)
+    return ride.insert_values(user_id)
+
+
+def seed(users, rides, requests, rng):
+    """
+    Fills the database with users, their ride offers and ride requests.
+    Returns a dictionary describing the seeded data used by the scenarios
+    """
+    database_conn = Database()
+    password_hash = passwords.hash_password(PASSWORD)
+
+    names = ['bench_user_{:06d}'.format(i) for i in range(users)]
+    names += ['bench_driver', 'bench_rider']
+    rows = [(name, password_hash, 0, 0, name + '@example.com')
+            for name in names]
+    user_ids = [row[0] for row in database_conn.insert_many(
+        'users',
+        ('username', 'user_password', 'rides_taken', 'rides_given', 'email'),
+        rows, 'user_id')]
+    passenger_ids = user_ids[:users]
+    driver_id, rider_id = user_ids[users:]
+
+    # The driver owns the first ride; the rider requests the others
+    rows = [ride_row(driver_id, 'Kampala', 'Entebbe', 5000, rng)]
+    rows += [ride_row(rng.choice(passenger_ids), rng.choice(PLACES),
+                      rng.choice(PLACES), rng.randrange(1000, 50000, 500),
+                      rng)
+             for _ in range(max(rides - 1, 1))]
+    ride_rows = database_conn.insert_many(
+        'rides', Ride.INSERT_COLUMNS, rows, 'ride_id',
+        bump=(Ride.version_marker(),))
+    ride_ids = [row[0] for row in ride_rows]
+    owners = dict((ride_id, row[0]) for ride_id, row in zip(ride_ids, rows))
+
+    # Every passenger asks for the ride of the driver, the remaining
+    # requests go to random rides
+    pairs = set((ride_ids[0], passenger) for passenger in passenger_ids)
+    attempts = 0
+    while len(pairs) < requests and attempts < requests * 10:
+        attempts += 1
+        ride_id = rng.choice(ride_ids)
+        passenger = rng.choice(passenger_ids)
+        if owners[ride_id] != passenger:
+            pairs.add((ride_id, passenger))
+    pairs = sorted(pairs)
+    request_rows = database_conn.insert_many(
+        'riderequests',
+        ('ride_id', 'passenger_id', 'accepted', 'rejected'),
+        [pair + (False, False) for pair in pairs], 'request_id',
+        bump=set(Request.collection(ride_id) for ride_id, _ in pairs))
+    driver_requests = [row[0] for row, pair in zip(request_rows, pairs)
+                       if pair[0] == ride_ids[0]]
+
+    return {
+        'usernames': names[:users],
+        'ride_ids': ride_ids,
+        'driver_ride': ride_ids[0],
+        'driver_requests': driver_requests,
+        'requestable_rides': ride_ids[1:]
+    }
+
+
+def login(client, username):
+    resp = client.post(API + '/auth/login',
+                       data=json.dumps({'username': username,
+                                        'password': PASSWORD}),
+                       content_type='application/json')
+    return json.loads(resp.get_data(as_text=True))['access_token']
+
+
+def scenarios(client, data, rng):
+    """
+    Returns the benchmarked scenarios as (name, build) pairs.
+    build(i) returns the keyword arguments of client.open for the
+    i-th request of the scenario
+    """
+    driver = {'Authorization': login(client, 'bench_driver')}
+    rider = {'Authorization': login(client, 'bench_rider')}
+    ride_ids = data['ride_ids']
+    requestable = data['requestable_rides']
+    driver_requests = data['driver_requests'] or [0]
+    driver_ride = data['driver_ride']
+    usernames = data['usernames']
+
+    def as_json(method, path, body, headers=None):
+        return {'method': method, 'path': path, 'headers': headers,
+                'data': json.dumps(body),
+                'content_type': 'application/json'}
+
+    listing = client.get(API + '/rides', headers=rider)
+    etag = listing.headers.get('ETag', '')
+    rides_not_modified = dict(rider, **{'If-None-Match': etag})
+
+    return [
+        ('signup', lambda i: as_json(
+            'POST', API + '/auth/signup',
+            {'username': 'bench_new_{:06d}'.format(i),
+             'password': PASSWORD,
+             'email': 'bench_new_{:06d}@example.com'.format(i)})),
+        ('login', lambda i: as_json(
+            'POST', API + '/auth/login',
+            {'username': rng.choice(usernames), 'password': PASSWORD})),
+        ('user_details', lambda i: {
+            'method': 'GET',
+            'path': API + '/user/' + rng.choice(usernames),
+            'headers': rider}),
+        ('list_rides', lambda i: {
+            'method': 'GET', 'path': API + '/rides', 'headers': rider}),
+        ('list_rides_not_modified', lambda i: {
+            'method': 'GET', 'path': API + '/rides',
+            'headers': rides_not_modified}),
+        ('stream_rides', lambda i: {
+            'method': 'GET', 'path': API + '/rides?stream=true',
+            'headers': rider}),
+        ('list_my_rides', lambda i: {
+            'method': 'GET', 'path': API + '/user/rides',
+            'headers': driver}),
+        ('search_rides', lambda i: {
+            'method': 'GET',
+            'path': API + '/rides/search?origin={}&sort=price'.format(
+                rng.choice(PLACES)[:3]),
+            'headers': rider}),
+        ('nearby_rides', lambda i: {
+            'method': 'GET',
+            'path': API + '/rides/nearby?lat={}&lon={}&radius=20'.format(
+                *POINTS[rng.choice(PLACES)]),
+            'headers': rider}),
+        ('plan_journey', lambda i: {
+            'method': 'GET',
+            'path': API + '/journeys?origin={}&destination={}'.format(
+                *rng.sample(PLACES, 2)),
+            'headers': rider}),
+        ('get_ride', lambda i: {
+            'method': 'GET',
+            'path': API + '/rides/{}'.format(rng.choice(ride_ids)),
+            'headers': rider}),
+        ('create_ride', lambda i: as_json(
+            'POST', API + '/users/rides',
+            {'origin': rng.choice(PLACES),
+             'destination': rng.choice(PLACES),
+             'price': rng.randrange(1000, 50000, 500)}, driver)),
+        ('create_rides_batch', lambda i: as_json(
+            'POST', API + '/users/rides/batch',
+            {'rides': [{'origin': rng.choice(PLACES),
+                        'destination': rng.choice(PLACES),
+                        'price': rng.randrange(1000, 50000, 500)}
+                       for _ in range(10)]}, driver)),
+        ('create_ride_request', lambda i: {
+            'method': 'POST',
+            'path': API + '/rides/{}/requests'.format(
+                requestable[i % len(requestable)]),
+            'headers': rider}),
+        ('view_ride_requests', lambda i: {
+            'method': 'GET',
+            'path': API + '/users/rides/{}/requests'.format(driver_ride),
+            'headers': driver}),
+        ('decide_ride_request', lambda i: as_json(
+            'PUT', API + '/users/rides/{}/requests/{}'.format(
+                driver_ride, rng.choice(driver_requests)),
+            {'decision': rng.choice(('accept', 'reject'))}, driver)),
+        ('decide_ride_requests_batch', lambda i: as_json(
+            'PUT', API + '/users/rides/{}/requests/batch'.format(
+                driver_ride),
+            {'decisions': [{'request_id': req_id,
+                            'decision': rng.choice(('accept', 'reject'))}
+                           for req_id in rng.sample(
+                               driver_requests,
+                               min(10, len(driver_requests)))]}, driver)),
+        ('metrics', lambda i: {'method': 'GET', 'path': '/metrics'}),
+    ]
+
+
+def run_scenario(client, build, iterations, warmup, counter):
+    """Sends the requests of one scenario and summarizes their timings"""
+    for i in range(warmup):
+        client.open(**build(-1 - i)).get_data()
+
+    latencies = []
+    statements = 0
+    statuses = {}
+    started = time.perf_counter()
+    for i in range(iterations):
+        kwargs = build(i)
+        counter.count = 0
+        start = time.perf_counter()
+        resp = client.open(**kwargs)
+        resp.get_data()  # Streamed responses are produced while read
+        latencies.append(time.perf_counter() - start)
+        statements += counter.count
+        status = str(resp.status_code)
+        statuses[status] = statuses.get(status, 0) + 1
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': iterations,
+        'statuses': statuses,
+        'latency_ms': {
+            'mean': 1000 * sum(latencies) / len(latencies),
+            'p50': 1000 * percentile(latencies, 50),
+            'p95': 1000 * percentile(latencies, 95),
+            'p99': 1000 * percentile(latencies, 99),
+            'max': 1000 * latencies[-1]
+        },
+        'throughput_rps': iterations / elapsed if elapsed else 0.0,
+        'statements_per_request': float(statements) / iterations
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """Seeds the database, runs the scenarios and returns the report"""
+    app = create_app('testing')
+    rng = random.Random(args.seed)
+    counter = StatementCounter()
+    only = set(args.only.split(',')) if args.only else None
+
+    with app.app_context():
+        reset_database()
+        data = seed(args.users, args.rides, args.requests, rng)
+        client = app.test_client()
+        results = {}
+        add_statement_listener(counter)
+        try:
+            for name, build in scenarios(client, data, rng):
+                if only is not None and name not in only:
+                    continue
+                results[name] = run_scenario(client, build,
+                                             args.iterations,
+                                             args.warmup, counter)
+        finally:
+            remove_statement_listener(counter)
+
+    return {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'settings': {
+            'users': args.users,
+            'rides': args.rides,
+            'requests': args.requests,
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'seed': args.seed
+        },
+        'results': results
+    }
+
+
+def print_report(report, out=sys.stdout):
+    out.write('{:<28} {:>9} {:>9} {:>9} {:>9} {:>8}\n'.format(
+        'scenario', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'sql/req'))
+    for name, result in sorted(report['results'].items()):
+        latency = result['latency_ms']
+        out.write('{:<28} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>8.1f}\n'
+                  .format(name, latency['p50'], latency['p95'],
+                          latency['p99'], result['throughput_rps'],
+                          result['statements_per_request']))
+
+
+def print_comparison(before, after, out=sys.stdout):
+    """Prints the change of every scenario between two reports"""
+    out.write('{} -> {}\n'.format(before.get('commit'), after.get('commit')))
+    out.write('{:<28} {:>17} {:>17} {:>13}\n'.format(
+        'scenario', 'p50 ms', 'p95 ms', 'sql/req'))
+    for name in sorted(set(before['results']) & set(after['results'])):
+        old, new = before['results'][name], after['results'][name]
+        out.write('{:<28} {:>7.2f} -> {:>6.2f} {:>7.2f} -> {:>6.2f} '
+                  '{:>5.1f} -> {:>4.1f}\n'
+                  .format(name,
+                          old['latency_ms']['p50'], new['latency_ms']['p50'],
+                          old['latency_ms']['p95'], new['latency_ms']['p95'],
+                          old['statements_per_request'],
+                          new['statements_per_request']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the API endpoints against the testing "
+                    "database. The testing database is emptied first")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rides', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--iterations', type=int, default=100,
+                        help="Requests sent per scenario")
+    parser.add_argument('--warmup', type=int, default=5,
+                        help="Unmeasured requests sent before each scenario")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only',
+                        help="Comma separated names of the scenarios to run")
+    parser.add_argument('--output', help="File the JSON report is saved to")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="Compare two saved reports instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            print_comparison(json.load(before), json.load(after))
+        return
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+This file compares the time taken to encode a listing of ride offers as
+json by Flask's jsonify, as the listings were encoded before
+app.serializers, and by app.serializers with each available backend.
+
+Run the benchmark with:
+    python -m benchmarks.serialization_benchmark [--rides 1000]
+"""
+import argparse
+import json
+import sys
+import timeit
+
+from flask import jsonify
+from app import create_app, serializers
+from app.models import Ride, Request
+
+
+def make_rides(count, requests_per_ride):
+    rides = []
+    for i in range(count):
+        ride = Ride('driver_{}'.format(i), 'Kampala', 'Entebbe', i * 100)
+        ride.id = i
+        for j in range(requests_per_ride):
+            ride_request = Request('passenger_{}'.format(j))
+            ride_request.id = i * requests_per_ride + j
+            ride.requests.append(ride_request)
+        rides.append(ride)
+    return rides
+
+
+def jsonify_listing(rides):
+    """The listings before app.serializers: dictionaries written out
+    by hand for every ride and request, encoded by jsonify"""
+    payload = {
+        'rides': [{'id': ride.id,
+                   'name': ride.name,
+                   'origin': ride.origin,
+                   'destination': ride.destination,
+                   'price': ride.price,
+                   'requests': [{'id': req.id,
+                                 'name': req.name,
+                                 'accepted': req.accepted,
+                                 'rejected': req.rejected}
+                                for req in ride.requests]}
+                  for ride in rides],
+        'next_cursor': None
+    }
+    return jsonify(payload).get_data()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the json encoding of ride listings")
+    parser.add_argument('--rides', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=3,
+                        help="Requests of every ride")
+    parser.add_argument('--number', type=int, default=50,
+                        help="Encodings timed per repetition")
+    args = parser.parse_args()
+
+    rides = make_rides(args.rides, args.requests)
+    candidates = [('jsonify', jsonify_listing)]
+    for name in ('json', 'ujson', 'orjson'):
+        try:
+            _, dumps = serializers.load_backend(name)
+        except ImportError:
+            sys.stdout.write('{} is not installed\n'.format(name))
+            continue
+        candidates.append(
+            ('serializers/' + name,
+             lambda rides, dumps=dumps: dumps({'rides': rides,
+                                               'next_cursor': None})))
+
+    with create_app('testing').test_request_context():
+        expected = json.loads(jsonify_listing(rides).decode('utf-8'))
+        for name, encode in candidates:
+            assert json.loads(encode(rides).decode('utf-8')) == expected
+            best = min(timeit.repeat(lambda: encode(rides),
+                                     number=args.number, repeat=5))
+            sys.stdout.write('{:<22} {:>8.2f} ms per listing\n'
+                             .format(name, 1000 * best / args.number))
+
+
+if __name__ == '__main__':
+    main()
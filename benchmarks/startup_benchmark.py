@@ -0,0 +1,116 @@
+"""
+This file measures how long a worker takes to start: the time taken to
+import the application package and to create the application, and the
+modules whose import takes longest. Every run starts a new interpreter,
+since modules are only imported once per process. The import times come
+from -X importtime from Python 3.7, and from IMPORT_TIMER, which reports
+them in the same format, before that.
+
+Run the benchmark with:
+    python -m benchmarks.startup_benchmark [--config production] [--top 15]
+"""
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+
+STARTUP = """
+import time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app({config!r})
+created = time.perf_counter()
+print(imported - start, created - imported)
+"""
+
+# Times the imports of a Python older than 3.7 by wrapping the function
+# that imports a module not imported yet, and writes them to stderr as
+# -X importtime does: a module is reported once its import is done, after
+# the modules it imported, and indented by two spaces per nesting level
+IMPORT_TIMER = """
+import importlib._bootstrap as _bootstrap
+import sys as _sys
+import time as _time
+_find_and_load = _bootstrap._find_and_load
+_children = [0.0]
+
+def _timed_find_and_load(name, import_):
+    _children.append(0.0)
+    start = _time.perf_counter()
+    try:
+        return _find_and_load(name, import_)
+    finally:
+        cumulative = _time.perf_counter() - start
+        self_time = cumulative - _children.pop()
+        _children[-1] += cumulative
+        _sys.stderr.write('import time: {:>9} | {:>10} | {}{}\\n'.format(
+            int(self_time * 1e6), int(cumulative * 1e6),
+            '  ' * (len(_children) - 1), name))
+
+_bootstrap._find_and_load = _timed_find_and_load
+"""
+
+# import time: self [us] | cumulative | imported package
+_IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def start_worker(config, importtime=False):
+    """Starts an interpreter that creates the application.
+    Returns the import and creation times and the -X importtime report"""
+    command = [sys.executable]
+    startup = STARTUP.format(config=config)
+    if importtime and sys.version_info >= (3, 7):
+        command += ['-X', 'importtime']
+    elif importtime:
+        startup = IMPORT_TIMER + startup
+    command += ['-c', startup]
+    done = subprocess.run(command, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, check=True)
+    import_time, create_time = map(float, done.stdout.split())
+    return import_time, create_time, done.stderr.decode()
+
+
+def slowest_imports(report, top):
+    """Returns the (cumulative us, module) of the modules imported directly
+    by the application or the interpreter that took longest"""
+    imports = []
+    for line in report.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        _, cumulative, indent, module = match.groups()
+        if len(indent) <= 3 or module.startswith('app.'):
+            imports.append((int(cumulative), module))
+    imports.sort(reverse=True)
+    return imports[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the startup time of a worker")
+    parser.add_argument('--config', default='production',
+                        help="Configuration the application is created with")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=15,
+                        help="Number of slowest imports listed")
+    args = parser.parse_args()
+
+    runs = [start_worker(args.config) for _ in range(args.runs)]
+    import_times = [run[0] * 1000 for run in runs]
+    create_times = [run[1] * 1000 for run in runs]
+    sys.stdout.write('import app     {:>8.1f} ms (median of {})\n'.format(
+        statistics.median(import_times), args.runs))
+    sys.stdout.write('create_app()   {:>8.1f} ms\n'.format(
+        statistics.median(create_times)))
+
+    report = start_worker(args.config, importtime=True)[2]
+    sys.stdout.write('\n{:<40} {:>12}\n'.format('module', 'cumulative'))
+    for cumulative, module in slowest_imports(report, args.top):
+        sys.stdout.write('{:<40} {:>9.1f} ms\n'.format(
+            module, cumulative / 1000))
+
+
+if __name__ == '__main__':
+    main()
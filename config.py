@@ -1,8 +1,71 @@
+import os
+
+
 class Config:
     """Parent configuration class"""
     DEBUG = False
     CSRF_ENABLED = True
     SECRET = "this_is_the_secret_key"
+    # Number of decoded access tokens kept in memory per process
+    TOKEN_CACHE_SIZE = 4096
+    # Cache of user and ride lookups: 'lru' (in-process), 'redis' or 'none'
+    CACHE_BACKEND = 'lru'
+    CACHE_SIZE = 10000
+    CACHE_TTL = 60  # seconds, bounds staleness across worker processes
+    CACHE_URL = 'redis://localhost:6379/0'  # used by the redis backend
+    # Password hashing. The first scheme hashes new passwords, the others
+    # are only accepted for existing hashes, which are upgraded on login
+    # unless the new hash would be cheaper, see app.passwords.
+    PASSWORD_SCHEMES = ("pbkdf2_sha256", "sha512_crypt", "sha256_crypt")
+    PASSWORD_ROUNDS = 600000
+    # Processes used for hashing, 0 hashes in the request process
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_TIMEOUT = 10  # seconds
+    # Threads of a gunicorn worker, see the Procfile
+    WEB_THREADS = int(os.environ.get('WEB_THREADS', 10))
+    # Connection pool settings (per process), a connection per thread
+    DATABASE_POOL_MIN = 1
+    DATABASE_POOL_MAX = WEB_THREADS
+    DATABASE_POOL_TIMEOUT = 5  # seconds to wait for a free connection
+    DATABASE_POOL_IDLE_CHECK = 30  # ping connections idle this long
+    # Use server side PREPARE for hot lookups on pooled connections
+    DATABASE_PREPARE_STATEMENTS = True
+    # Connections per event loop used by app.async_database
+    ASYNC_DATABASE_POOL_MAX = 5
+    # Time statements and keep per request totals, see app.instrumentation
+    DATABASE_INSTRUMENTATION = True
+    SLOW_QUERY_THRESHOLD = 0.5  # seconds, None turns the slow query log off
+    DATABASE_TIMING_HEADERS = False  # send the totals as X-DB-* headers
+    # Request metrics served at /metrics, see app.metrics. Workers of the
+    # same deployment share their totals through files in METRICS_DIR
+    METRICS_ENABLED = True
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = 5  # seconds between saves of a worker's totals
+    # Pagination of the ride and ride request listings
+    DEFAULT_PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 500
+    # Rows fetched per round trip when a listing is streamed
+    STREAM_BATCH_SIZE = 500
+    # Encoder of the json responses: 'auto', 'orjson', 'ujson' or 'json'
+    JSON_BACKEND = 'auto'
+    # Largest number of items accepted by the batch endpoints
+    MAX_BATCH_SIZE = 500
+    # Ride counters of the users are logged and added to the users table
+    # in batches, see app.counters
+    COUNTER_FLUSH_SIZE = 100  # increments logged by a process
+    COUNTER_FLUSH_INTERVAL = 10  # seconds
+    # Server-sent events of ride requests, see app.notifications
+    EVENTS_QUEUE_SIZE = 100  # notifications kept for a slow client
+    EVENTS_KEEPALIVE = 15  # seconds between keepalive comments
+    EVENTS_STREAM_DURATION = 300  # seconds before the client reconnects
+    EVENTS_RETRY_DELAY = 3000  # milliseconds the client waits to reconnect
+    # Radius in km of GET /rides/nearby when none is given, and its maximum
+    NEARBY_DEFAULT_RADIUS = 10
+    NEARBY_MAX_RADIUS = 100
+    # Journey planner, see app.journeys
+    JOURNEY_MAX_LEGS = 4  # most legs a journey query may ask for
+    JOURNEY_REFRESH_INTERVAL = 1  # seconds between reads of new rides
+    JOURNEY_REBUILD_INTERVAL = 600  # seconds between full rebuilds
 
 
 class DevelopmentConfig(Config):
@@ -13,6 +76,9 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     """Configurations for Testing, with a separate database."""
     TESTING = True
+    # Short streams, so a test waiting for a missing event fails quickly
+    EVENTS_KEEPALIVE = 1
+    EVENTS_STREAM_DURATION = 5
 
 
 class ProductionConfig(Config):
@@ -1,5 +1,11 @@
-from app import app
+import os
+from app import create_app
+from app.database_setup import migrate
+
+app = create_app(os.environ.get('APP_SETTINGS', 'development'))
 
 
 if __name__ == '__main__':
+    with app.app_context():
+        migrate()
     app.run()
@@ -0,0 +1,109 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+import unittest
+from app.async_database import AsyncDatabase, AsyncConnectionPool, \
+    run_async
+from app.database_helper import Database
+from app.database_pool import connection_params, PoolTimeout
+from app.database_setup import migrate
+from app.models import User, Ride, cache
+from app import create_app
+
+app = create_app('testing')
+
+
+class TestAsyncDatabase(unittest.TestCase):
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        migrate()
+        cache.clear()
+        self.user = User(username="async_driver")
+        self.user.hash_password("secret")
+        self.user.email = "async@example.com"
+        self.user.user_id = self.user.add_new_user()
+        self.ride = Ride("async_driver", "Kampala", "Entebbe", 5000)
+        self.ride.add_new_ride_offer(self.user.user_id)
+
+    def test_queries_run_concurrently(self):
+        """Tests that several lookups can be awaited at once"""
+        async def sleep():
+            return await AsyncDatabase().execute_sql("SELECT pg_sleep(0.2)")
+
+        start = time.time()
+        run_async(sleep(), sleep(), sleep())
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_timeout_cancels_coroutines(self):
+        """Tests that run_async gives up on coroutines that take too long"""
+        cancelled = threading.Event()
+
+        async def stuck():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        start = time.time()
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            run_async(stuck(), timeout=0.1)
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(cancelled.wait(1))
+
+    def test_async_select_matches_sync_one(self):
+        """Tests that the coroutine version of select returns the same
+        rows as the synchronous one"""
+        where = {"r.ride_id": self.ride.id}
+        rows, = run_async(AsyncDatabase().select(Ride.TABLE, Ride.COLUMNS,
+                                                 Ride.JOIN, where))
+        self.assertEqual(Database().select(Ride.TABLE, Ride.COLUMNS,
+                                           Ride.JOIN, where), rows)
+
+    def test_insert_bumps_versions(self):
+        """Tests that an asynchronous insert bumps its collection"""
+        ride = Ride("async_driver", "Entebbe", "Kampala", 5000)
+        rows, = run_async(AsyncDatabase().insert(
+            "rides", Ride.INSERT_COLUMNS,
+            ride.insert_values(self.user.user_id), "ride_id",
+            bump=("async_rides",)))
+        self.assertEqual(self.ride.id + 1, rows[0][0])
+        self.assertEqual(1, Database().collection_version("async_rides")[0])
+
+    def test_loop_set_in_its_thread(self):
+        """Tests that the loop is the one set for its thread, which is
+        what get_event_loop returns before Python 3.5.3"""
+        async def loops():
+            return (asyncio.get_event_loop_policy().get_event_loop(),
+                    asyncio.get_event_loop())
+
+        (thread_loop, running_loop), = run_async(loops())
+        self.assertIs(running_loop, thread_loop)
+
+    def test_checkout_timeout(self):
+        """Tests that borrowing from an exhausted async pool times out"""
+        async def exhaust():
+            pool = AsyncConnectionPool(connection_params(),
+                                       maxconn=1, timeout=0.1)
+            conn = await pool.getconn()
+            try:
+                with self.assertRaises(PoolTimeout):
+                    await pool.getconn()
+            finally:
+                await pool.putconn(conn)
+                await pool.closeall()
+
+        run_async(exhaust())
+
+    def tearDown(self):
+        Database().execute_sql("DROP SCHEMA public CASCADE; "
+                               "CREATE SCHEMA public", fetch=False)
+        cache.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,14 +2,23 @@ import unittest
 import psycopg2
 from configure_database import config
 import json
-from app.models import User, Ride
-from app import app
+from datetime import timedelta
+from werkzeug.http import http_date
+from app.models import User, Ride, Request, cache, collection_version
+from app.database_setup import migrate
+from app import create_app
+
+app = create_app('testing')
 
 
 class TestAuth(unittest.TestCase):
 
     def setUp(self):
-        app.config['TESTING'] = True
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        migrate()
+        cache.clear()
         self.client = app.test_client()
         self.user = User(username='Isaac', password='python')
         self.user.email = "isaac@gmail.com"
@@ -90,6 +99,53 @@ class TestAuth(unittest.TestCase):
         self.assertIn('access_token', data)
         self.assertEqual(data['message'], "Logged in successfully")
 
+    def test_username_with_quote(self):
+        """Tests that usernames are passed to the database as parameters"""
+        user = User(username="O'Neill", password='haskell')
+        user.email = "oneill@gmail.com"
+        token = self.login_signup(user)
+        self.assertTrue(token)
+
+    def test_outdated_hash_upgraded_on_login(self):
+        """Tests that a hash made with an old scheme is replaced on login"""
+        from passlib.hash import sha512_crypt
+        user = User(username='Kintu', password=sha512_crypt.hash('erlang'))
+        user.email = "kintu@gmail.com"
+        user.add_new_user()
+
+        user.password_hash = 'erlang'
+        resp = self.login_user(user)
+        self.assertEqual(200, resp.status_code)
+        stored = User.get_user('Kintu').password_hash
+        self.assertTrue(stored.startswith('$pbkdf2-sha256$'))
+
+        resp = self.login_user(user)
+        self.assertEqual(200, resp.status_code)
+
+    def test_hash_never_replaced_by_cheaper_one(self):
+        """Tests that verify_and_update only replaces a hash with one that
+        costs at least as much to guess"""
+        from passlib.hash import sha512_crypt, pbkdf2_sha256
+        from app import passwords
+        schemes = app.config['PASSWORD_SCHEMES']
+        context = passwords._context(passwords.current_settings())
+        for old_hash in (sha512_crypt.hash('erlang'),
+                         pbkdf2_sha256.using(rounds=1000).hash('erlang')):
+            valid, new_hash = passwords._verify_and_update(
+                passwords.current_settings(), 'erlang', old_hash)
+            self.assertTrue(valid)
+            self.assertIsNotNone(new_hash)
+            self.assertGreaterEqual(passwords.hash_cost(context, new_hash),
+                                    passwords.hash_cost(context, old_hash))
+
+        # Settings cheaper than the stored hashes keep them as they are
+        for old_hash in (sha512_crypt.hash('erlang'),
+                         pbkdf2_sha256.using(rounds=700000).hash('erlang')):
+            valid, new_hash = passwords._verify_and_update(
+                (schemes, 29000), 'erlang', old_hash)
+            self.assertTrue(valid)
+            self.assertIsNone(new_hash)
+
     def test_rides_with_token(self):
         """Tests whether a user can view rides when logged in"""
         token = self.token
@@ -137,6 +193,53 @@ class TestAuth(unittest.TestCase):
         data = json.loads(str(resp.data.decode()))
         self.assertIn('ride', data)
 
+    def test_ride_columns_decoded(self):
+        """Tests that ride columns keep their types and commas"""
+        ride = Ride("Owomugisha", "Mbarara, Uganda", "Kampala", 15000)
+        resp = self.create_ride(ride, self.token)
+        self.assertEqual(201, resp.status_code)
+        resp = self.client.get("/ridemyway/api/v1/rides/{}".format(1),
+                               headers={'Authorization': self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual(1, data['ride']['id'])
+        self.assertEqual("Mbarara, Uganda", data['ride']['origin'])
+        self.assertEqual(15000, data['ride']['price'])
+        self.assertEqual("Owomugisha", data['ride']['name'])
+
+    def test_rides_pagination(self):
+        """Tests that rides are returned page by page"""
+        for _ in range(3):
+            resp = self.create_ride(self.ride_1, self.token)
+            self.assertEqual(201, resp.status_code)
+
+        resp = self.client.get("/ridemyway/api/v1/rides?limit=2",
+                               headers={'Authorization': self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual([1, 2], [ride['id'] for ride in data['rides']])
+        self.assertEqual(2, data['next_cursor'])
+
+        resp = self.client.get("/ridemyway/api/v1/rides?limit=2&after=2",
+                               headers={'Authorization': self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual([3], [ride['id'] for ride in data['rides']])
+        self.assertIsNone(data['next_cursor'])
+
+        resp = self.client.get("/ridemyway/api/v1/user/rides?limit=0",
+                               headers={'Authorization': self.token})
+        self.assertEqual(400, resp.status_code)
+
+    def test_rides_stream(self):
+        """Tests that all rides can be streamed in one response"""
+        for _ in range(3):
+            resp = self.create_ride(self.ride_1, self.token)
+            self.assertEqual(201, resp.status_code)
+
+        resp = self.client.get("/ridemyway/api/v1/rides?stream=true&after=1",
+                               headers={'Authorization': self.token})
+        self.assertEqual(200, resp.status_code)
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual([2, 3], [ride['id'] for ride in data['rides']])
+
     def test_create_ride_request(self):
         """Tests whether a user can create a ride request"""
         token = self.login_signup(self.user)
@@ -152,6 +255,37 @@ class TestAuth(unittest.TestCase):
         self.assertIn('request_id', data)
         self.assertIn('ride_request', data)
 
+    def test_create_ride_request_outcomes(self):
+        """Tests the errors returned when a ride can not be requested"""
+        token = self.login_signup(self.user)
+        resp = self.create_request(token)
+        self.assertEqual(400, resp.status_code)
+
+        resp = self.create_ride(self.ride_1, token)
+        self.assertEqual(201, resp.status_code)
+        resp = self.create_request(token)
+        self.assertEqual(401, resp.status_code)
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual("You can't request a ride that you created",
+                         data['message'])
+
+        resp = self.create_request(self.token)
+        self.assertEqual(201, resp.status_code)
+        version = collection_version(Request.collection(1))
+        resp = self.create_request(self.token)
+        self.assertEqual(401, resp.status_code)
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual("You already requested this ride", data['message'])
+
+        # A token of a user that no longer exists
+        ghost = User(username='Ghost').generate_auth_token().decode('UTF-8')
+        resp = self.create_request(ghost)
+        self.assertEqual(401, resp.status_code)
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual("User account does not exist", data['message'])
+        # Nothing was inserted, so the listing did not change
+        self.assertEqual(version, collection_version(Request.collection(1)))
+
     def test_view_ride_requests(self):
         """Tests whether a user that created a ride request can view the ride requests"""
         token = self.login_signup(self.user)
@@ -186,6 +320,273 @@ class TestAuth(unittest.TestCase):
         self.assertIn('status', data)
         self.assertEqual(data['status'],
                          'You have accepted this ride request')
+        self.assertTrue(data['ride_request']['accepted'])
+        self.assertEqual('Isaac', data['ride_request']['name'])
+
+        resp = self.client.get("/ridemyway/api/v1/user/Isaac",
+                               headers={"Authorization": self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual(1, data['rides_taken'])
+        resp = self.client.get("/ridemyway/api/v1/user/Owomugisha",
+                               headers={"Authorization": self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual(1, data['ride_given'])
+
+    def test_create_rides_batch(self):
+        """Tests that several rides can be created with one request"""
+        rides = [{'origin': 'Ibanda', 'destination': 'Mbarara',
+                  'price': 5000},
+                 {'origin': 'Mbarara'},
+                 {'origin': 'Mbarara', 'destination': 'Kampala'}]
+        resp = self.client.post("/ridemyway/api/v1/users/rides/batch",
+                                content_type="application/json",
+                                data=json.dumps({'rides': rides}),
+                                headers={'Authorization': self.token})
+        self.assertEqual(201, resp.status_code)
+        results = json.loads(str(resp.data.decode()))['results']
+        self.assertEqual(1, results[0]['ride_id'])
+        self.assertEqual('Mbarara', results[0]['ride']['destination'])
+        self.assertIn('error', results[1])
+        self.assertEqual(2, results[2]['ride_id'])
+
+        # A token of a user that no longer exists
+        ghost = User(username='Ghost').generate_auth_token().decode('UTF-8')
+        resp = self.client.post("/ridemyway/api/v1/users/rides/batch",
+                                content_type="application/json",
+                                data=json.dumps({'rides': rides}),
+                                headers={'Authorization': ghost})
+        self.assertEqual(401, resp.status_code)
+        resp = self.create_ride(self.ride_1, ghost)
+        self.assertEqual(401, resp.status_code)
+
+    def test_accept_reject_requests_batch(self):
+        """Tests that several requests can be decided with one request"""
+        token = self.login_signup(self.user)
+        token3 = self.login_signup(self.user3)
+        resp = self.create_ride(self.ride_1, self.token)
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual(201, self.create_request(token).status_code)
+        self.assertEqual(201, self.create_request(token3).status_code)
+
+        decisions = [{'request_id': 1, 'decision': 'accept'},
+                     {'request_id': 2, 'decision': 'reject'},
+                     {'request_id': 3, 'decision': 'accept'},
+                     {'request_id': 1, 'decision': 'reject'}]
+        resp = self.client.put(
+            "/ridemyway/api/v1/users/rides/1/requests/batch",
+            content_type="application/json",
+            data=json.dumps({'decisions': decisions}),
+            headers={"Authorization": self.token})
+        self.assertEqual(200, resp.status_code)
+        results = json.loads(str(resp.data.decode()))['results']
+        self.assertTrue(results[0]['ride_request']['accepted'])
+        self.assertTrue(results[1]['ride_request']['rejected'])
+        self.assertIn('error', results[2])
+        self.assertIn('error', results[3])
+
+        resp = self.client.get("/ridemyway/api/v1/user/Owomugisha",
+                               headers={"Authorization": self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual(1, data['ride_given'])
+
+    def test_search_rides(self):
+        """Tests searching rides by origin, destination and price"""
+        for origin, destination, price in (("Kampala", "Ibanda", 20000),
+                                           ("kampala", "Mbarara", 15000),
+                                           ("Kabale", "Mbarara", 30000),
+                                           ("Kampala", "Mbale", 10000)):
+            ride = Ride("Owomugisha", origin, destination, price)
+            self.assertEqual(201, self.create_ride(ride, self.token)
+                             .status_code)
+
+        url = "/ridemyway/api/v1/rides/search?origin=KAMP&sort=price&limit=2"
+        resp = self.client.get(url, headers={'Authorization': self.token})
+        self.assertEqual(200, resp.status_code)
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual([4, 2], [ride['id'] for ride in data['rides']])
+        self.assertEqual("15000:2", data['next_cursor'])
+
+        resp = self.client.get(url + "&after=" + data['next_cursor'],
+                               headers={'Authorization': self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual([1], [ride['id'] for ride in data['rides']])
+
+        url = "/ridemyway/api/v1/rides/search?destination=mbarara" \
+              "&max_price=20000"
+        resp = self.client.get(url, headers={'Authorization': self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual([2], [ride['id'] for ride in data['rides']])
+
+        url = "/ridemyway/api/v1/rides/search?origin=%25"
+        resp = self.client.get(url, headers={'Authorization': self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual([], data['rides'])
+
+    def test_nearby_rides(self):
+        """Tests that rides near a point are listed closest first"""
+        for origin, lat, lon in (("Entebbe", 0.0512, 32.4637),
+                                 ("Kampala", 0.3476, 32.5825),
+                                 ("Mukono", 0.3533, 32.7553),
+                                 ("Jinja", 0.4244, 33.2041)):
+            req_data = {'origin': origin, 'destination': 'Gulu',
+                        'origin_lat': lat, 'origin_lon': lon}
+            resp = self.client.post("/ridemyway/api/v1/users/rides",
+                                    content_type="application/json",
+                                    data=json.dumps(req_data),
+                                    headers={'Authorization': self.token})
+            self.assertEqual(201, resp.status_code)
+        self.assertEqual(201, self.create_ride(self.ride_1, self.token)
+                         .status_code)
+
+        url = "/ridemyway/api/v1/rides/nearby?lat=0.3136&lon=32.5811" \
+              "&radius=35"
+        resp = self.client.get(url, headers={'Authorization': self.token})
+        self.assertEqual(200, resp.status_code)
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual(['Kampala', 'Mukono', 'Entebbe'],
+                         [item['ride']['origin'] for item in data['rides']])
+        self.assertAlmostEqual(3.78, data['rides'][0]['distance_km'], 1)
+        self.assertEqual(0.3476, data['rides'][0]['ride']['origin_lat'])
+
+        resp = self.client.get(url + "&limit=1",
+                               headers={'Authorization': self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual(1, len(data['rides']))
+
+        for query in ("lat=91&lon=0", "lat=0", "lat=0&lon=0&radius=1000"):
+            resp = self.client.get("/ridemyway/api/v1/rides/nearby?" + query,
+                                   headers={'Authorization': self.token})
+            self.assertEqual(400, resp.status_code)
+
+        req_data = {'origin': 'Kampala', 'destination': 'Gulu',
+                    'origin_lat': 0.3476}
+        resp = self.client.post("/ridemyway/api/v1/users/rides",
+                                content_type="application/json",
+                                data=json.dumps(req_data),
+                                headers={'Authorization': self.token})
+        self.assertEqual(400, resp.status_code)
+
+    def test_journeys(self):
+        """Tests planning journeys over rides added before and after
+        the ride graph was loaded"""
+        url = "/ridemyway/api/v1/journeys?origin=Ibanda&destination=Kampala"
+        for origin, destination, price in (("Ibanda", "Mbarara", 10000),
+                                           ("Mbarara", "Kampala", 20000),
+                                           ("Ibanda", "Kampala", 40000)):
+            ride = Ride("Owomugisha", origin, destination, price)
+            self.assertEqual(201, self.create_ride(ride, self.token)
+                             .status_code)
+
+        resp = self.client.get(url, headers={'Authorization': self.token})
+        self.assertEqual(200, resp.status_code)
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual([1, 2], [leg['id']
+                                  for leg in data['journey']['legs']])
+        self.assertEqual('Owomugisha', data['journey']['legs'][0]['name'])
+        self.assertEqual(30000, data['journey']['total_price'])
+
+        resp = self.client.get(url + "&optimize=legs",
+                               headers={'Authorization': self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual([3], [leg['id'] for leg in data['journey']['legs']])
+
+        ride = Ride("Owomugisha", "Mbarara", "Kampala", 5000)
+        self.assertEqual(201, self.create_ride(ride, self.token).status_code)
+        resp = self.client.get(url, headers={'Authorization': self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual([1, 4], [leg['id']
+                                  for leg in data['journey']['legs']])
+
+        # Prices given as text are saved and planned as integers
+        for ride, status in (({'origin': 'Mbarara', 'destination': 'Kampala',
+                               'price': '3000'}, 201),
+                             ({'origin': 5, 'destination': 'Kampala'}, 400),
+                             ({'origin': 'Mbarara', 'destination': 'Kampala',
+                               'price': 'free'}, 400)):
+            resp = self.client.post("/ridemyway/api/v1/users/rides",
+                                    content_type="application/json",
+                                    data=json.dumps(ride),
+                                    headers={'Authorization': self.token})
+            self.assertEqual(status, resp.status_code)
+        resp = self.client.get(url, headers={'Authorization': self.token})
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual(13000, data['journey']['total_price'])
+
+        resp = self.client.get(url.replace("Ibanda", "Gulu"),
+                               headers={'Authorization': self.token})
+        self.assertEqual(404, resp.status_code)
+        resp = self.client.get(url + "&max_legs=9",
+                               headers={'Authorization': self.token})
+        self.assertEqual(400, resp.status_code)
+
+    def test_rides_conditional_get(self):
+        """Tests that an unchanged listing is answered with 304"""
+        self.assertEqual(201, self.create_ride(self.ride_1, self.token)
+                         .status_code)
+        resp = self.client.get("/ridemyway/api/v1/rides",
+                               headers={'Authorization': self.token})
+        self.assertEqual(200, resp.status_code)
+        etag = resp.headers['ETag']
+        self.assertIn('Last-Modified', resp.headers)
+
+        resp = self.client.get("/ridemyway/api/v1/rides",
+                               headers={'Authorization': self.token,
+                                        'If-None-Match': etag})
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(b'', resp.data)
+
+        self.assertEqual(201, self.create_ride(self.ride_1, self.token)
+                         .status_code)
+        resp = self.client.get("/ridemyway/api/v1/rides",
+                               headers={'Authorization': self.token,
+                                        'If-None-Match': etag})
+        self.assertEqual(200, resp.status_code)
+        self.assertNotEqual(etag, resp.headers['ETag'])
+
+        # Proxies compressing the response make the ETag weak
+        resp = self.client.get("/ridemyway/api/v1/rides",
+                               headers={'Authorization': self.token,
+                                        'If-None-Match':
+                                            'W/' + resp.headers['ETag']})
+        self.assertEqual(304, resp.status_code)
+
+        # The Last-Modified sent is echoed back by the client
+        resp = self.client.get("/ridemyway/api/v1/rides",
+                               headers={'Authorization': self.token})
+        last_modified = resp.last_modified
+        resp = self.client.get("/ridemyway/api/v1/rides",
+                               headers={'Authorization': self.token,
+                                        'If-Modified-Since':
+                                            resp.headers['Last-Modified']})
+        self.assertEqual(304, resp.status_code)
+
+        self.assertEqual(201, self.create_ride(self.ride_1, self.token)
+                         .status_code)
+        since = http_date(last_modified - timedelta(seconds=1))
+        resp = self.client.get("/ridemyway/api/v1/rides",
+                               headers={'Authorization': self.token,
+                                        'If-Modified-Since': since})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(3, len(json.loads(resp.data.decode())['rides']))
+
+    def test_ride_requests_conditional_get(self):
+        """Tests that new ride requests change the listing's ETag"""
+        token = self.login_signup(self.user)
+        self.assertEqual(201, self.create_ride(self.ride_1, token)
+                         .status_code)
+        url = "/ridemyway/api/v1/users/rides/1/requests"
+        resp = self.client.get(url, headers={'Authorization': token})
+        etag = resp.headers['ETag']
+        resp = self.client.get(url, headers={'Authorization': token,
+                                             'If-None-Match': etag})
+        self.assertEqual(304, resp.status_code)
+
+        self.assertEqual(201, self.create_request(self.token).status_code)
+        resp = self.client.get(url, headers={'Authorization': token,
+                                             'If-None-Match': etag})
+        self.assertEqual(200, resp.status_code)
+        data = json.loads(str(resp.data.decode()))
+        self.assertEqual(1, len(data['ride_requests']))
 
     def tearDown(self):
         """Deletes the tables in the database after using it for testing"""
@@ -0,0 +1,102 @@
+import fnmatch
+import time
+import unittest
+from app.cache import CacheBackend, LRUCache, RedisCache, ReadThroughCache
+
+
+class TestReadThroughCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ReadThroughCache(LRUCache(maxsize=2, ttl=60))
+        self.loads = []
+
+    def loader(self, value):
+        def load():
+            self.loads.append(value)
+            return value
+        return load
+
+    def test_value_loaded_once(self):
+        """Tests that a cached value is not loaded again"""
+        self.assertEqual('row', self.cache.get('key', self.loader('row')))
+        self.assertEqual('row', self.cache.get('key', self.loader('other')))
+        self.assertEqual(['row'], self.loads)
+        self.assertEqual(0.5, self.cache.stats()['hit_rate'])
+
+    def test_missing_value_not_cached(self):
+        """Tests that None is loaded every time"""
+        self.cache.get('key', self.loader(None))
+        self.cache.get('key', self.loader(None))
+        self.assertEqual([None, None], self.loads)
+
+    def test_invalidate(self):
+        """Tests that an invalidated key is loaded again"""
+        self.cache.get('key', self.loader('old'))
+        self.cache.invalidate('key')
+        self.assertEqual('new', self.cache.get('key', self.loader('new')))
+
+    def test_entries_expire(self):
+        """Tests that entries are dropped after their time to live"""
+        cache = LRUCache(maxsize=2, ttl=0.05)
+        cache.set('key', 'row')
+        self.assertEqual('row', cache.get('key'))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('key'))
+
+    def test_least_recently_used_is_evicted(self):
+        """Tests that the cache does not grow beyond its size"""
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+
+
+class FakeRedis:
+    """The part of the redis-py client used by RedisCache"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match='*', count=None):
+        return [key for key in list(self.data)
+                if fnmatch.fnmatchcase(key, match)]
+
+
+class TestRedisCache(unittest.TestCase):
+
+    def test_clear_keeps_other_keys(self):
+        """Tests that clearing only deletes the keys under the prefix"""
+        client = FakeRedis()
+        client.set('other:key', b'kept')
+        cache = RedisCache(client, prefix='ridemyway:', clear_batch_size=2)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, key)
+        self.assertEqual('b', cache.get('b'))
+        cache.clear()
+        self.assertEqual({'other:key': b'kept'}, client.data)
+
+    def test_backend_is_abstract(self):
+        """Tests that a backend must implement every method"""
+        class Partial(CacheBackend):
+            def get(self, key):
+                return None
+
+        with self.assertRaises(TypeError):
+            Partial()
+
+
+if __name__ == '__main__':
+    unittest.main()
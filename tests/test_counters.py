@@ -0,0 +1,95 @@
+import unittest
+from app.database_helper import Database
+from app.database_setup import migrate
+from app.models import User, Ride, Request, cache
+from app import create_app
+
+app = create_app('testing')
+
+
+class TestRideCounters(unittest.TestCase):
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        self.flush_settings = (app.config['COUNTER_FLUSH_SIZE'],
+                               app.config['COUNTER_FLUSH_INTERVAL'])
+        app.config['COUNTER_FLUSH_SIZE'] = 1000
+        app.config['COUNTER_FLUSH_INTERVAL'] = 3600
+        migrate()
+        cache.clear()
+        self.database = Database()
+        self.driver = self.add_user("counter_driver")
+        self.passenger = self.add_user("counter_passenger")
+        self.ride = Ride("counter_driver", "Kampala", "Entebbe", 5000)
+        self.ride.add_new_ride_offer(self.driver.user_id)
+        self.request = Request("counter_passenger")
+        self.request.add_ride_request(self.ride.id)
+
+    def add_user(self, username):
+        user = User(username=username, password="hash")
+        user.email = username + "@example.com"
+        user.user_id = user.add_new_user()
+        return user
+
+    def stored_counts(self, username):
+        return tuple(self.database.execute_sql(
+            "SELECT rides_taken, rides_given FROM users WHERE username = %s",
+            (username,))[0])
+
+    def test_accepted_rides_are_logged(self):
+        """Tests that totals include increments that were not flushed"""
+        Request.accept_reject_ride_request('accept', self.request.id,
+                                           self.ride.id)
+        self.assertEqual((0, 0), self.stored_counts("counter_passenger"))
+        passenger = User.get_user_totals("counter_passenger")
+        driver = User.get_user_totals("counter_driver")
+        self.assertEqual((1, 0), (passenger.rides_taken,
+                                  passenger.rides_given))
+        self.assertEqual((0, 1), (driver.rides_taken, driver.rides_given))
+
+    def test_accepting_twice_logs_once(self):
+        """Tests that accepting an accepted request changes nothing"""
+        for _ in range(2):
+            accepted = Request.accept_reject_ride_request(
+                'accept', self.request.id, self.ride.id)
+            self.assertTrue(accepted.accepted)
+        self.assertEqual(1, User.get_user_totals(
+            "counter_passenger").rides_taken)
+        self.assertEqual(1, User.get_user_totals(
+            "counter_driver").rides_given)
+
+    def test_flush_moves_increments(self):
+        """Tests that a flush adds the log to the users table once"""
+        self.add_user("counter_rider")
+        request = Request("counter_rider")
+        request.add_ride_request(self.ride.id)
+        for request_id in (self.request.id, request.id):
+            Request.accept_reject_ride_request('accept', request_id,
+                                               self.ride.id)
+        User.flush_ride_counters()
+        User.flush_ride_counters()
+        self.assertEqual((1, 0), self.stored_counts("counter_passenger"))
+        self.assertEqual((0, 2), self.stored_counts("counter_driver"))
+        self.assertEqual(2, User.get_user_totals("counter_driver").rides_given)
+        self.assertEqual([], self.database.execute_sql(
+            "SELECT * FROM ride_counter_log"))
+
+    def test_flush_on_size(self):
+        """Tests that the log is flushed once enough increments are logged"""
+        app.config['COUNTER_FLUSH_SIZE'] = 2
+        Request.accept_reject_ride_request('accept', self.request.id,
+                                           self.ride.id)
+        self.assertEqual((0, 1), self.stored_counts("counter_driver"))
+
+    def tearDown(self):
+        app.config['COUNTER_FLUSH_SIZE'], \
+            app.config['COUNTER_FLUSH_INTERVAL'] = self.flush_settings
+        self.database.execute_sql("DROP SCHEMA public CASCADE; "
+                                  "CREATE SCHEMA public", fetch=False)
+        cache.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
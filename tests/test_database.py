@@ -0,0 +1,296 @@
+import json
+import unittest
+import threading
+import time
+import psycopg2
+from app.database_pool import ConnectionPool, PoolTimeout, \
+    connection_params, get_pool, close_pool, add_statement_listener, \
+    remove_statement_listener
+from app.database_setup import migrate, MIGRATIONS
+from app.database_helper import Database, select_sql, select_statement, \
+    prepared_statement
+from app.models import User, Ride, Request
+from app import create_app
+
+app = create_app('testing')
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        self.pool = ConnectionPool(connection_params(),
+                                   minconn=1, maxconn=2, timeout=0.2)
+
+    def test_connection_is_reused(self):
+        """Tests that a returned connection is handed out again"""
+        with self.pool.connection() as conn:
+            first = conn
+        with self.pool.connection() as conn:
+            self.assertIs(first, conn)
+
+    def test_checkout_timeout(self):
+        """Tests that borrowing from an exhausted pool times out"""
+        conn1 = self.pool.getconn()
+        conn2 = self.pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            self.pool.getconn()
+        self.pool.putconn(conn1)
+        self.pool.putconn(conn2)
+
+    def test_failed_connect_frees_slot(self):
+        """Tests that a connection that could not be opened does not
+        use up a place in the pool"""
+        pool = ConnectionPool(connection_params(), minconn=0, maxconn=1,
+                              timeout=0.2)
+        self.addCleanup(pool.closeall)
+        connect = pool._connect
+
+        def fail():
+            pool._connect = connect
+            raise psycopg2.OperationalError("could not connect")
+
+        pool._connect = fail
+        with self.assertRaises(psycopg2.OperationalError):
+            pool.getconn()
+        pool.putconn(pool.getconn())
+
+    def test_connect_does_not_block_checkouts(self):
+        """Tests that idle connections are handed out while another
+        thread is opening a new connection"""
+        idle = self.pool.getconn()
+        connecting = threading.Event()
+        opened = threading.Event()
+        connect = self.pool._connect
+
+        def slow_connect():
+            connecting.set()
+            opened.wait(2)
+            return connect()
+
+        self.pool._connect = slow_connect
+        opener = threading.Thread(target=self.pool.getconn)
+        opener.start()
+        connecting.wait(2)
+        start = time.time()
+        self.pool.putconn(idle)
+        self.assertIs(idle, self.pool.getconn())
+        self.assertLess(time.time() - start, 1)
+        opened.set()
+        opener.join()
+
+    def test_busy_pool_answers_503(self):
+        """Tests that a request finding no free connection fails instead
+        of being answered as if nothing was found"""
+        settings = (app.config['DATABASE_POOL_MAX'],
+                    app.config['DATABASE_POOL_TIMEOUT'])
+        app.config['DATABASE_POOL_MAX'] = 1
+        app.config['DATABASE_POOL_TIMEOUT'] = 0.1
+        try:
+            close_pool()
+            with get_pool().connection():
+                resp = app.test_client().post(
+                    "/ridemyway/api/v1/auth/login",
+                    content_type="application/json",
+                    data=json.dumps({'username': 'Isaac',
+                                     'password': 'password'}))
+            self.assertEqual(503, resp.status_code)
+        finally:
+            app.config['DATABASE_POOL_MAX'], \
+                app.config['DATABASE_POOL_TIMEOUT'] = settings
+
+    def test_broken_idle_connection_is_replaced(self):
+        """Tests that closed idle connections are not handed out"""
+        conn = self.pool.getconn()
+        self.pool.putconn(conn)
+        conn.close()
+        with self.pool.connection() as new_conn:
+            self.assertIsNot(conn, new_conn)
+            self.assertFalse(new_conn.closed)
+
+    def test_pool_recreated_after_fork(self):
+        """Tests that a process with a different pid gets its own pool"""
+        pool = get_pool()
+        self.assertIs(pool, get_pool())
+        pool.pid = -1  # Pretend the pool was created by a parent process
+        self.assertIsNot(pool, get_pool())
+        pool.closeall()
+
+    def tearDown(self):
+        self.pool.closeall()
+        close_pool()
+
+
+class TestQueryBuilder(unittest.TestCase):
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+    def test_statement_text_is_cached(self):
+        """Tests that the same query shape reuses the statement text"""
+        sql = select_sql("users", "*", None, ("username",))
+        self.assertEqual("SELECT * FROM users WHERE username = %s", sql)
+        self.assertIs(sql, select_sql("users", "*", None, ("username",)))
+
+    def test_none_is_not_dropped(self):
+        """Tests that a filter on None selects NULL instead of every row"""
+        sql, params = select_statement("users", "*",
+                                       where={"username": None})
+        self.assertEqual("SELECT * FROM users WHERE username IS NULL", sql)
+        self.assertEqual([], params)
+        with self.assertRaises(ValueError):
+            select_statement("rides", "*", where={"ride_id >": None})
+
+    def test_prepared_statement_text(self):
+        """Tests the conversion of placeholders for PREPARE"""
+        name, text, count = prepared_statement(
+            "SELECT * FROM rides WHERE ride_id = %s AND price > %s")
+        self.assertTrue(name.startswith("rmw_"))
+        self.assertEqual(
+            "SELECT * FROM rides WHERE ride_id = $1 AND price > $2", text)
+        self.assertEqual(2, count)
+
+    def test_prepared_select(self):
+        """Tests that a prepared lookup is prepared once per connection"""
+        migrate()
+        database = Database()
+        where = {"username": "nobody"}
+        self.assertEqual([], database.select("users", "*", where=where,
+                                             prepare=True))
+        self.assertEqual([], database.select("users", "*", where=where,
+                                             prepare=True))
+        with get_pool().connection() as conn:
+            self.assertEqual(1, len(conn.prepared))
+
+    def test_statement_listener(self):
+        """Tests that listeners are told about executed statements"""
+        seen = []
+
+        def listener(sql, duration, rowcount):
+            seen.append((sql, rowcount))
+
+        add_statement_listener(listener)
+        try:
+            Database().execute_sql("SELECT 1 UNION ALL SELECT 2")
+        finally:
+            remove_statement_listener(listener)
+        Database().execute_sql("SELECT 3")
+        self.assertEqual([("SELECT 1 UNION ALL SELECT 2", 2)], seen)
+
+    def tearDown(self):
+        close_pool()
+
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        migrate()
+        self.database = Database()
+
+    def plan(self, sql, params):
+        return "\n".join(self.database.explain(sql, params, seqscan=False))
+
+    def select_plan(self, table, columns, left_join, where, **kwargs):
+        return self.plan(*select_statement(table, columns, left_join, where,
+                                           **kwargs))
+
+    def test_user_by_username_uses_index(self):
+        plan = self.select_plan("users", User.COLUMNS, None,
+                                {"username": "Isaac"})
+        self.assertIn("users_username_key", plan)
+
+    def test_rides_by_owner_uses_index(self):
+        """Tests the listing of the rides of a driver, found by username"""
+        plan = self.select_plan(Ride.TABLE, Ride.COLUMNS, Ride.JOIN,
+                                {"u.username": "Isaac"},
+                                order_by="r.ride_id", limit=20)
+        self.assertIn("users_username_key", plan)
+        self.assertIn("rides_user_id_idx", plan)
+
+    def test_user_requested_uses_index(self):
+        """Tests the request of a ride by a passenger, found by username"""
+        plan = self.plan(Request.ADD_SQL, {"ride_id": 1,
+                                           "username": "Isaac",
+                                           "accepted": False,
+                                           "rejected": False})
+        self.assertIn("users_username_key", plan)
+        self.assertIn("riderequests_ride_passenger_key", plan)
+
+    def test_ride_search_uses_index(self):
+        plan = self.select_plan(Ride.TABLE, Ride.COLUMNS, Ride.JOIN,
+                                {"lower(r.origin) LIKE": "kam%"})
+        self.assertIn("rides_origin_lower_idx", plan)
+
+    def tearDown(self):
+        close_pool()
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+    def test_migrations_applied_once(self):
+        """Tests that migrating an up to date database does nothing"""
+        migrate()
+        self.assertEqual([], migrate())
+        with get_pool().connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT max(version) FROM schema_migrations")
+            self.assertEqual(MIGRATIONS[-1][0], cur.fetchone()[0])
+            cur.close()
+
+    def test_duplicates_merged(self):
+        """Tests that migrating a database holding duplicate usernames and
+        requests merges them before adding the unique indexes"""
+        with get_pool().connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+            for command in MIGRATIONS[0][2]:
+                cur.execute(command)
+            cur.execute("""
+                CREATE TABLE schema_migrations (
+                  version INTEGER PRIMARY KEY,
+                  description TEXT NOT NULL,
+                  applied_at TIMESTAMP NOT NULL DEFAULT now()
+                );
+                INSERT INTO schema_migrations VALUES (1, 'Tables');
+                INSERT INTO users VALUES
+                  (1, 'Isaac', 'hash', 1, 2, 'a@example.com'),
+                  (2, 'Isaac', 'hash', 3, 4, 'b@example.com'),
+                  (3, 'Mary', 'hash', 0, 0, 'c@example.com');
+                INSERT INTO rides VALUES (1, 2, 'Kampala', 'Jinja', 100);
+                INSERT INTO riderequests VALUES
+                  (1, 1, 3, NULL, NULL), (2, 1, 3, TRUE, FALSE),
+                  (3, 1, 3, FALSE, TRUE)
+                """)
+            conn.commit()
+            cur.close()
+
+        migrate()
+        database = Database()
+        self.assertEqual([(1, 4, 6)], database.execute_sql(
+            "SELECT user_id, rides_taken, rides_given FROM users "
+            "WHERE username = 'Isaac'"))
+        self.assertEqual([(1, 1)], database.execute_sql(
+            "SELECT ride_id, user_id FROM rides"))
+        self.assertEqual([(2,)], database.execute_sql(
+            "SELECT request_id FROM riderequests"))
+
+    def tearDown(self):
+        Database().execute_sql("DROP SCHEMA public CASCADE; "
+                               "CREATE SCHEMA public", fetch=False)
+        close_pool()
+
+
+if __name__ == '__main__':
+    unittest.main()
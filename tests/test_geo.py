@@ -0,0 +1,43 @@
+import math
+import random
+import unittest
+from app import geo
+
+
+class TestGeo(unittest.TestCase):
+
+    def covered(self, ranges, lat, lon):
+        cell = geo.cell_of(lat, lon)
+        return any(first <= cell <= last for first, last in ranges)
+
+    def test_ranges_cover_the_circle(self):
+        """Tests that every point within the radius is in a listed cell,
+        also across the antimeridian and near the poles"""
+        rng = random.Random(7)
+        for lat, lon, radius in ((0.3476, 32.5825, 10), (-1.0, 179.99, 25),
+                                 (45.0, -179.9, 60), (89.9, 10.0, 30),
+                                 (-89.5, 0.0, 100), (51.5, -0.12, 0.5)):
+            ranges = geo.cell_ranges(lat, lon, radius)
+            span = math.degrees(radius / geo.EARTH_RADIUS_KM)
+            checked = 0
+            while checked < 500:
+                point_lat = lat + rng.uniform(-span, span)
+                point_lon = lon + rng.uniform(-180, 180) * rng.random() ** 6
+                if not -90 <= point_lat <= 90:
+                    continue
+                point_lon = (point_lon + 180) % 360 - 180
+                if geo.distance_km(lat, lon, point_lat, point_lon) > radius:
+                    continue
+                checked += 1
+                self.assertTrue(self.covered(ranges, point_lat, point_lon),
+                                (lat, lon, radius, point_lat, point_lon))
+
+    def test_small_radius_reads_few_cells(self):
+        ranges = geo.cell_ranges(0.3476, 32.5825, 10)
+        cells = sum(last - first + 1 for first, last in ranges)
+        self.assertLessEqual(len(ranges), 5)
+        self.assertLessEqual(cells, 25)
+
+
+if __name__ == '__main__':
+    unittest.main()
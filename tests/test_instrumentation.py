@@ -0,0 +1,57 @@
+import json
+import unittest
+from app.database_setup import migrate
+from app.instrumentation import normalize_sql
+from app.models import cache
+from app import create_app
+
+app = create_app('testing')
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        migrate()
+        cache.clear()
+        self.client = app.test_client()
+
+    def login(self):
+        return self.client.post('/ridemyway/api/v1/auth/login',
+                                data=json.dumps({'username': 'nobody',
+                                                 'password': 'secret'}),
+                                content_type='application/json')
+
+    def test_normalize_sql(self):
+        """Tests that literal values are left out of logged statements"""
+        sql = b"SELECT *\n  FROM users WHERE username = 'o''neil' AND id = 12"
+        self.assertEqual("SELECT * FROM users WHERE username = ? AND id = ?",
+                         normalize_sql(sql))
+
+    def test_timing_headers(self):
+        """Tests that the database usage of a request is sent back"""
+        app.config['DATABASE_TIMING_HEADERS'] = True
+        try:
+            resp = self.login()
+        finally:
+            app.config['DATABASE_TIMING_HEADERS'] = False
+        self.assertGreaterEqual(int(resp.headers['X-DB-Statements']), 1)
+        self.assertIn('X-DB-Time', resp.headers)
+        self.assertIn('X-DB-Checkout-Time', resp.headers)
+        self.assertNotIn('X-DB-Statements', self.login().headers)
+
+    def test_slow_query_log(self):
+        """Tests that statements slower than the threshold are logged"""
+        app.config['SLOW_QUERY_THRESHOLD'] = 0
+        try:
+            with self.assertLogs('app.database', 'WARNING') as logs:
+                self.login()
+        finally:
+            app.config['SLOW_QUERY_THRESHOLD'] = 0.5
+        self.assertIn('Slow query', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from app.journeys import RideGraph
+
+
+class TestRideGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = RideGraph()
+        self.graph.add_rows([(1, "Ibanda", "Mbarara", 10000),
+                             (2, "Mbarara", "Kampala", 20000),
+                             (3, "Ibanda", "Kampala", 45000),
+                             (4, "Ibanda", "Masaka", 5000),
+                             (5, "Masaka", "Kampala", 12000),
+                             (6, "Mbarara ", "kampala", 15000)])
+
+    def test_cheapest_journey(self):
+        """Tests that the cheapest ride between two places is used and
+        place names are compared ignoring case and spaces"""
+        self.assertEqual(([4, 5], 17000),
+                         self.graph.search("ibanda", "KAMPALA"))
+
+    def test_fewest_legs(self):
+        self.assertEqual(([3], 45000),
+                         self.graph.search("Ibanda", "Kampala", 'legs'))
+
+    def test_max_legs(self):
+        """Tests that a cheaper journey with too many legs is not chosen"""
+        graph = RideGraph()
+        graph.add_rows([(1, "Ibanda", "Mbarara", 10),
+                        (2, "Mbarara", "Masaka", 10),
+                        (3, "Masaka", "Kampala", 10),
+                        (4, "Ibanda", "Masaka", 50),
+                        (5, "Ibanda", "Kampala", 100)])
+        self.assertEqual(([1, 2, 3], 30),
+                         graph.search("Ibanda", "Kampala", 'price', 3))
+        self.assertEqual(([4, 3], 60),
+                         graph.search("Ibanda", "Kampala", 'price', 2))
+        self.assertEqual(([5], 100),
+                         graph.search("Ibanda", "Kampala", 'price', 1))
+
+    def test_no_journey(self):
+        self.assertIsNone(self.graph.search("Kampala", "Ibanda"))
+        self.assertIsNone(self.graph.search("Gulu", "Kampala"))
+
+    def test_rides_added_again(self):
+        """Tests that reading a ride again changes nothing"""
+        self.graph.add_rows([(4, "Ibanda", "Masaka", 5000)])
+        self.assertEqual(6, self.graph.last_ride_id)
+        self.assertEqual(([4, 5], 17000),
+                         self.graph.search("Ibanda", "Kampala"))
+
+    def test_invalid_rides_ignored(self):
+        """Tests that rides the graph cannot compare are left out
+        instead of failing the request that saved them"""
+        self.graph.add(7, "Ibanda", "Kampala", "1000")
+        self.graph.add(8, None, "Kampala", "free")
+        self.assertEqual(([7], 1000), self.graph.search("Ibanda", "Kampala"))
+
+
+if __name__ == '__main__':
+    unittest.main()
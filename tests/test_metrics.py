@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from app.metrics import Store, registry, render, metrics_file, \
+    SIZE_BUCKETS
+from app import create_app
+
+app = create_app('testing')
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        self.client = app.test_client()
+
+    def scrape(self):
+        return self.client.get('/metrics').get_data(as_text=True)
+
+    def test_requests_counted_by_route(self):
+        """Tests that requests are counted by route template and status"""
+        line = ('ridemyway_http_requests_total{route="/ridemyway/api/v1/'
+                'rides/<ride_id>",method="GET",status="401"} ')
+        before = registry().collect().requests.get(
+            ('/ridemyway/api/v1/rides/<ride_id>', 'GET', '401'), 0)
+        self.client.get('/ridemyway/api/v1/rides/1').get_data()
+        self.client.get('/ridemyway/api/v1/rides/2').get_data()
+        self.assertIn(line + str(before + 2), self.scrape())
+
+    def test_histogram_rendering(self):
+        """Tests that histogram buckets are cumulative"""
+        store = Store()
+        for size in (50, 500, 5000):
+            store.observe(store.response_size, ('/r', 'GET'),
+                          SIZE_BUCKETS, size)
+        text = render(store)
+        labels = 'route="/r",method="GET"'
+        self.assertIn('ridemyway_http_response_size_bytes_bucket'
+                      '{' + labels + ',le="1000"} 2', text)
+        self.assertIn('ridemyway_http_response_size_bytes_bucket'
+                      '{' + labels + ',le="+Inf"} 3', text)
+        self.assertIn('ridemyway_http_response_size_bytes_count'
+                      '{' + labels + '} 3', text)
+
+    def test_workers_aggregated(self):
+        """Tests that the totals saved by other workers are reported"""
+        directory = tempfile.mkdtemp()
+        other = Store()
+        other.requests[('/other', 'GET', '200')] = 7
+        other.in_flight = 3
+        with open(metrics_file(directory, os.getppid()), 'w') as saved:
+            json.dump(other.to_json(), saved)
+        app.config['METRICS_DIR'] = directory
+        try:
+            text = self.scrape()
+        finally:
+            app.config['METRICS_DIR'] = None
+            shutil.rmtree(directory)
+        self.assertIn('ridemyway_http_requests_total{route="/other",'
+                      'method="GET",status="200"} 7', text)
+        self.assertIn('ridemyway_http_requests_in_flight 4', text)
+
+    def test_ended_workers_dropped(self):
+        """Tests that the file of a worker that ended is removed"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        ended = subprocess.Popen([sys.executable, '-c', 'pass'])
+        ended.wait()
+        other = Store()
+        other.requests[('/ended', 'GET', '200')] = 7
+        path = metrics_file(directory, ended.pid)
+        with open(path, 'w') as saved:
+            json.dump(other.to_json(), saved)
+        app.config['METRICS_DIR'] = directory
+        try:
+            text = self.scrape()
+        finally:
+            app.config['METRICS_DIR'] = None
+        self.assertNotIn('/ended', text)
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
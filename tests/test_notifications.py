@@ -0,0 +1,87 @@
+import json
+import unittest
+from app.database_helper import Database
+from app.database_setup import migrate
+from app.models import User, Ride, Request, cache
+from app import create_app
+
+app = create_app('testing')
+
+EVENTS = '/ridemyway/api/v1/users/requests/events'
+
+
+class TestNotifications(unittest.TestCase):
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        migrate()
+        cache.clear()
+        self.client = app.test_client()
+        self.driver = self.add_user("events_driver")
+        self.passenger = self.add_user("events_passenger")
+        self.ride = Ride("events_driver", "Kampala", "Entebbe", 5000)
+        self.ride.add_new_ride_offer(self.driver.user_id)
+
+    def add_user(self, username):
+        user = User(username=username, password="hash")
+        user.email = username + "@example.com"
+        user.user_id = user.add_new_user()
+        return user
+
+    def subscribe(self, user):
+        """Opens the event stream of user and returns its chunks"""
+        token = user.generate_auth_token().decode('UTF-8')
+        response = self.client.get(EVENTS, headers={'Authorization': token},
+                                   buffered=False)
+        self.addCleanup(response.close)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('text/event-stream', response.mimetype)
+        chunks = iter(response.response)
+        self.assertTrue(next(chunks).startswith(b'retry:'))
+        return chunks
+
+    def next_event(self, chunks):
+        """Returns the name and data of the next event of a stream"""
+        for chunk in chunks:
+            if chunk.startswith(b'event:'):
+                name, data = chunk.decode().strip().split('\n')
+                return name[len('event: '):], json.loads(data[len('data: '):])
+        self.fail("The stream ended")
+
+    def test_driver_and_passenger_notified(self):
+        """Tests that new requests and decisions reach both users"""
+        driver_events = self.subscribe(self.driver)
+        passenger_events = self.subscribe(self.passenger)
+
+        ride_request = Request("events_passenger")
+        ride_request.add_ride_request(self.ride.id)
+        for events in (driver_events, passenger_events):
+            name, data = self.next_event(events)
+            self.assertEqual('created', name)
+            self.assertEqual({'event': 'created', 'ride_id': self.ride.id,
+                              'driver': 'events_driver',
+                              'request': {'id': ride_request.id,
+                                          'name': 'events_passenger',
+                                          'accepted': False,
+                                          'rejected': False}}, data)
+
+        Request.accept_reject_ride_request('reject', ride_request.id,
+                                           self.ride.id)
+        for events in (driver_events, passenger_events):
+            name, data = self.next_event(events)
+            self.assertEqual('rejected', name)
+            self.assertTrue(data['request']['rejected'])
+
+    def test_token_required(self):
+        self.assertEqual(401, self.client.get(EVENTS).status_code)
+
+    def tearDown(self):
+        Database().execute_sql("DROP SCHEMA public CASCADE; "
+                               "CREATE SCHEMA public", fetch=False)
+        cache.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import json
+import unittest
+from app import create_app, serializers
+from app.models import User, Ride, Request
+
+app = create_app('testing')
+
+
+class TestSerializers(unittest.TestCase):
+
+    def setUp(self):
+        self.ride = Ride("driver", "Kampala", "Entebbe", 5000)
+        self.ride.id = 3
+        ride_request = Request("passenger")
+        ride_request.id = 7
+        self.ride.requests.append(ride_request)
+
+    def test_ride_fields(self):
+        """Tests that nested requests are converted and the ride is kept"""
+        self.assertEqual({'id': 3, 'name': 'driver', 'origin': 'Kampala',
+                          'destination': 'Entebbe', 'price': 5000,
+                          'origin_lat': None, 'origin_lon': None,
+                          'destination_lat': None, 'destination_lon': None,
+                          'requests': [{'id': 7, 'name': 'passenger',
+                                        'accepted': False,
+                                        'rejected': False}]},
+                         serializers.to_dict(self.ride))
+        self.assertIsInstance(self.ride.requests[0], Request)
+
+    def test_private_fields_left_out(self):
+        """Tests that password hashes are never serialized"""
+        user = User("someone", "secret_hash", 2, 3)
+        self.assertEqual({'username': 'someone', 'rides_taken': 2,
+                          'rides_given': 3}, serializers.to_dict(user))
+
+    def test_backends_agree(self):
+        """Tests that every installed backend encodes the same payload"""
+        payload = {'rides': [self.ride], 'next_cursor': 'é'}
+        _, dumps = serializers.load_backend('json')
+        expected = json.loads(dumps(payload).decode('utf-8'))
+        self.assertEqual('é', expected['next_cursor'])
+        for name in ('orjson', 'ujson'):
+            try:
+                _, dumps = serializers.load_backend(name)
+            except ImportError:
+                continue
+            self.assertEqual(expected,
+                             json.loads(dumps(payload).decode('utf-8')))
+
+    def test_unknown_objects_rejected(self):
+        with app.app_context(), self.assertRaises(TypeError):
+            serializers.dumps({'value': object()})
+
+
+if __name__ == '__main__':
+    unittest.main()
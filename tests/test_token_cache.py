@@ -0,0 +1,40 @@
+import time
+import unittest
+from app.token_cache import TokenCache
+
+
+class TestTokenCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TokenCache(maxsize=2)
+        self.expires = time.time() + 60
+
+    def test_hit_and_miss(self):
+        """Tests that cached tokens are found and counted"""
+        self.assertIsNone(self.cache.get('token'))
+        self.cache.put('token', 'Isaac', self.expires)
+        self.assertEqual('Isaac', self.cache.get('token'))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_least_recently_used_is_evicted(self):
+        """Tests that the cache does not grow beyond its size"""
+        self.cache.put('a', 'Isaac', self.expires)
+        self.cache.put('b', 'Allen', self.expires)
+        self.cache.get('a')
+        self.cache.put('c', 'Owomugisha', self.expires)
+        self.assertEqual('Isaac', self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(2, self.cache.stats()['size'])
+
+    def test_expired_token_is_dropped(self):
+        """Tests that a token is not returned after it expires"""
+        self.cache.put('token', 'Isaac', time.time() + 0.05)
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(0, self.cache.stats()['size'])
+
+
+if __name__ == '__main__':
+    unittest.main()